@@ -0,0 +1,198 @@
+import asyncio
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.models import OuterRef, Subquery
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework.authentication import TokenAuthentication, SessionAuthentication
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+
+from ..cache import aget_grants, alookup_content_hashes, aresolve_file_version
+from ..models import Blob, FileVersion, Folder
+from ..serving import aiterate, serve_file_version
+from .pagination import CreatedAtCursorPagination
+from .serializers import CASLookupSerializer, DirectoryListingSerializer, FileVersionSerializer
+from .views import CONTENT_HASH_RE, FileServeView, FileVersionViewSet
+
+
+class AsyncAPIView(View):
+    """
+    Async counterpart of APIView for the read endpoints served under ASGI. DRF views
+    are sync only, so the request is authenticated by the same DRF classes in a worker
+    thread and the handler then runs on the event loop. API errors are returned as
+    JSON with the status DRF would use.
+
+    At most FILE_ASYNC_CONCURRENCY requests of the process are handled at once, so a
+    burst can not open more database connections than that; responses are streamed
+    outside of the limit.
+    """
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # CSRF is enforced by SessionAuthentication, as in DRF.
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        async with request_limit():
+            return await self.handle(request, *args, **kwargs)
+
+    async def handle(self, request, *args, **kwargs):
+        authenticators = [authentication() for authentication in self.authentication_classes]
+        request = Request(request, parsers=[JSONParser()], authenticators=authenticators)
+        self.request = request
+        try:
+            if not await sync_to_async(lambda: request.user.is_authenticated)():
+                raise NotAuthenticated()
+            response = await super().dispatch(request, *args, **kwargs)
+        except APIException as error:
+            response = JsonResponse(
+                error.detail if isinstance(error.detail, (dict, list)) else {"detail": error.detail},
+                status=error.status_code,
+                safe=False,
+            )
+            if error.status_code == 401:
+                response["WWW-Authenticate"] = authenticators[0].authenticate_header(request)
+        # Django closes them when the response is finished, which for a slow download is
+        # minutes away: thousands of streams would otherwise hold as many connections.
+        await sync_to_async(close_connections)()
+        return response
+
+
+_request_limits = weakref.WeakKeyDictionary()
+
+
+def request_limit():
+    loop = asyncio.get_running_loop()
+    limit = _request_limits.get(loop)
+    if limit is None:
+        limit = _request_limits[loop] = asyncio.Semaphore(settings.FILE_ASYNC_CONCURRENCY)
+    return limit
+
+
+def close_connections():
+    """Close the calling thread's database connections that are not inside a transaction."""
+    for connection in connections.all(initialized_only=True):
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+class AsyncFileServeView(AsyncAPIView):
+    """
+    FileServeView for ASGI. Downloads and listings use the async ORM and cache, and
+    file contents are streamed by an async iterator, so a slow client holds no thread.
+    Archives run the sync view in a worker thread and only their stream is made async.
+    """
+
+    async def get(self, request, file_path=""):
+        if "list" in request.query_params:
+            return await self.get_listing(request, file_path.strip("/"))
+
+        if "archive" in request.query_params:
+            response = await sync_to_async(FileServeView.as_view())(request._request, file_path=file_path)
+            if response.streaming:
+                # The archive reads blob manifests from the database as it goes.
+                response.streaming_content = aiterate(iter(response.streaming_content), thread_sensitive=True)
+            return response
+
+        revision = request.query_params.get("revision")
+        path, _, file_name = file_path.rpartition("/")
+
+        if revision is not None:
+            revision = int(revision)
+        resolved = await aresolve_file_version(request.user, path, file_name, revision)
+
+        if resolved is None:
+            if revision is not None and await aresolve_file_version(request.user, path, file_name) is not None:
+                return JsonResponse({"error": "revision not found"}, status=404)
+            return JsonResponse({"error": "file not found"}, status=404)
+
+        file_obj, blob = resolved
+        return await sync_to_async(serve_file_version)(
+            request, file_obj, file_name, immutable=revision is not None, blob=blob, asynchronous=True
+        )
+
+    async def get_listing(self, request, directory):
+        folder = await Folder.objects.filter(user=request.user, path=directory).afirst()
+        if folder is None:
+            if directory:
+                return JsonResponse({"error": "folder not found"}, status=404)
+            folder = Folder(path="", file_count=0, size=0)
+
+        folders = Folder.objects.filter(user=request.user, parent=directory).order_by("name")
+        grants = await aget_grants(request.user)
+        files = (
+            FileVersion.objects.accessible_by(request.user, grants)
+            .filter(path=directory)
+            .order_by("file_name", "-revision")
+            .distinct("file_name")
+            .annotate(size=Subquery(Blob.objects.filter(content_hash=OuterRef("content_hash")).values("size")[:1]))
+        )
+        listing = {
+            "path": directory,
+            "file_count": folder.file_count,
+            "size": folder.size,
+            "folders": [subfolder async for subfolder in folders],
+            "files": [file_version async for file_version in files],
+        }
+        serializer = DirectoryListingSerializer(listing, context={"request": request})
+        return JsonResponse(serializer.data)
+
+
+class AsyncFileVersionListView(AsyncAPIView):
+    """
+    The list and upload endpoint of FileVersionViewSet for ASGI. Listing pages through
+    the user's versions with the async ORM. Uploads run the sync view in a worker
+    thread: Django's ASGI handler has read the whole body before any view runs, so a
+    slow uploader holds no thread either way.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        if request.method == "POST":
+            # The sync view authenticates and parses the upload itself.
+            async with request_limit():
+                return await sync_to_async(FileVersionViewSet.as_view({"post": "create"}))(request)
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request):
+        grants = await aget_grants(request.user)
+        paginator = CreatedAtCursorPagination()
+        page = await paginator.apaginate_queryset(FileVersion.objects.accessible_by(request.user, grants), request)
+        serializer = FileVersionSerializer(page, many=True, context={"request": request})
+        return JsonResponse({"next": paginator.get_next_link(), "results": serializer.data})
+
+
+class AsyncFileCASView(AsyncAPIView):
+    async def get(self, request, hash_value):
+        files = None
+        if CONTENT_HASH_RE.fullmatch(hash_value):
+            files = (await alookup_content_hashes(request.user, [hash_value])).get(hash_value)
+        if not files:
+            return JsonResponse({"error": "No files found with this hash"}, status=404)
+        serializer = FileVersionSerializer(files, many=True, context={"request": request})
+        return JsonResponse(serializer.data, safe=False)
+
+
+class AsyncFileCASLookupView(AsyncAPIView):
+    async def post(self, request):
+        serializer = CASLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        content_hashes = list(dict.fromkeys(serializer.validated_data["hashes"]))
+
+        found = await alookup_content_hashes(request.user, content_hashes)
+        files = [file_version for content_hash in found for file_version in found[content_hash]]
+        data = iter(FileVersionSerializer(files, many=True, context={"request": request}).data)
+        return JsonResponse(
+            {
+                "found": {content_hash: [next(data) for _ in found[content_hash]] for content_hash in found},
+                "missing": [content_hash for content_hash in content_hashes if content_hash not in found],
+            }
+        )
@@ -1,63 +1,445 @@
-from rest_framework import serializers
+import tarfile
+import zipfile
+from collections import Counter
+from operator import attrgetter
+
+from rest_framework import ISO_8601, serializers, status
+from rest_framework.settings import api_settings
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Max
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models, transaction
 from django.contrib.auth import authenticate
 from django.urls import reverse
+from django.utils.encoding import escape_uri_path
 
-from ..models import FileVersion, FilePermissions
+from ..cache import invalidate_user
+from ..jobs import enqueue_new_blobs
+from ..models import (
+    Blob,
+    Document,
+    FileAccess,
+    FileVersion,
+    FilePermissions,
+    Folder,
+    Grant,
+    UploadPart,
+    UploadSession,
+    validate_path,
+)
+from ..storage import blob_path, blob_storage
+from ..uploads import HashedUploadedFile
 
 User = get_user_model()
 
 
+class FileVersionListSerializer(serializers.ListSerializer):
+    """
+    Read-only output for many file versions. The file URL prefix is resolved once per
+    call and each row is built straight from model attributes, skipping the per-field
+    get_attribute()/to_representation() round trip of ModelSerializer for plain columns.
+    """
+
+    # Fields whose representation is the model attribute itself.
+    plain_field_classes = (serializers.CharField, serializers.IntegerField, serializers.ReadOnlyField)
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        file_url_prefix = self.child.get_file_url_prefix()
+        readers = [
+            (field.field_name, self.get_reader(field, file_url_prefix)) for field in self.child._readable_fields
+        ]
+        return [{field_name: read(instance) for field_name, read in readers} for instance in iterable]
+
+    def get_reader(self, field, file_url_prefix):
+        if field.field_name == "file":
+            return lambda instance: self.child.get_file_url(instance, file_url_prefix)
+        if isinstance(field, serializers.PrimaryKeyRelatedField):
+            return attrgetter(self.child.Meta.model._meta.get_field(field.source).attname)
+        if isinstance(field, self.plain_field_classes):
+            return attrgetter(field.source)
+        if isinstance(field, serializers.DateTimeField) and self.is_iso_8601(field):
+            # Resolve the output timezone once instead of on every row.
+            timezone = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+            get_value = attrgetter(field.source)
+
+            def read_datetime(instance):
+                value = get_value(instance)
+                if value is None:
+                    return None
+                value = value.astimezone(timezone).isoformat()
+                return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+            return read_datetime
+
+        get_attribute, to_representation = field.get_attribute, field.to_representation
+
+        def read(instance):
+            value = get_attribute(instance)
+            return None if value is None else to_representation(value)
+
+        return read
+
+    @staticmethod
+    def is_iso_8601(field):
+        return getattr(field, "format", api_settings.DATETIME_FORMAT) == ISO_8601
+
+
 class FileVersionSerializer(serializers.ModelSerializer):
     class Meta:
         model = FileVersion
         fields = "__all__"
         read_only_fields = ["id", "user", "created_at", "file_name", "revision", "content_hash"]
+        list_serializer_class = FileVersionListSerializer
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Sparse fieldsets: ?fields=id,file_name limits the output to those fields.
+        request = self.context.get("request")
+        requested_fields = request.query_params.get("fields") if request and request.method == "GET" else None
+        if requested_fields:
+            for field_name in set(self.fields) - set(requested_fields.split(",")):
+                self.fields.pop(field_name)
 
     def create(self, validated_data):
         request = self.context["request"]
         validated_data["user"] = request.user
         validated_data["file_name"] = validated_data["file"].name
-        validated_data["revision"] = self.get_revision(validated_data)
 
-        return super().create(validated_data)
+        # The allocated revision stays locked until the version row is committed.
+        with transaction.atomic():
+            validated_data["revision"] = self.get_revision(validated_data)
+            return super().create(validated_data)
 
     @staticmethod
     def get_revision(validated_data):
-        user = validated_data['user']
-        file_name = validated_data["file_name"]
-        path = validated_data["path"]
+        return Document.objects.allocate_revision(
+            validated_data["user"], validated_data.get("path", ""), validated_data["file_name"]
+        )
+
+    def get_file_url_prefix(self):
+        request = self.context.get("request")
 
-        existing_versions = FileVersion.objects.filter(user=user, file_name=file_name, path=path)
-        if not existing_versions.exists():
-            return 1
+        # Reverse a one character placeholder and cut it off to get the URL prefix.
+        url = reverse("serve_file", kwargs={"file_path": "-"})[:-1]
+        if request:
+            return request.build_absolute_uri(url)
+        return url
+
+    @staticmethod
+    def get_file_url(instance, file_url_prefix):
+        folder_path = ''
+        if instance.path:
+            folder_path = f'{instance.path}/'
 
-        latest_version = existing_versions.aggregate(Max("revision"))["revision__max"] or 0
-        return latest_version + 1
+        file_path = escape_uri_path(f"{folder_path}{instance.file_name}")
+        return f"{file_url_prefix}{file_path}?revision={instance.revision}"
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
+        if "file" in self.fields:
+            ret["file"] = self.get_file_url(instance, self.get_file_url_prefix())
+        return ret
 
-        request = self.context.get("request")
 
-        folder_path = ''
-        if instance.path:
-            folder_path = f'{instance.path}/'
+class FolderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Folder
+        fields = ["name", "path", "file_count", "size"]
 
-        file_path = f"{folder_path}{instance.file_name}?revision={instance.revision}"
-        url = reverse("serve_file", kwargs={"file_path": file_path})
-        if request:
-            ret["file"] = request.build_absolute_uri(url)
+
+class DirectoryFileSerializer(FileVersionSerializer):
+    size = serializers.IntegerField(read_only=True)
+
+
+class DirectoryListingSerializer(serializers.Serializer):
+    """Direct children of a folder: its subfolders and the latest revision of each file."""
+
+    path = serializers.CharField()
+    file_count = serializers.IntegerField()
+    size = serializers.IntegerField()
+    folders = FolderSerializer(many=True)
+    files = DirectoryFileSerializer(many=True)
+
+
+class SearchQuerySerializer(serializers.Serializer):
+    q = serializers.CharField()
+    path = serializers.CharField(required=False, allow_blank=True, default="", validators=[validate_path])
+    all_revisions = serializers.BooleanField(required=False, default=False)
+    limit = serializers.IntegerField(required=False, default=20, min_value=1, max_value=100)
+
+
+class CASLookupSerializer(serializers.Serializer):
+    hashes = serializers.ListField(
+        child=serializers.RegexField(r"^[0-9a-f]{64}$"), allow_empty=False, max_length=10_000
+    )
+
+
+class SearchResultSerializer(FileVersionSerializer):
+    rank = serializers.FloatField(read_only=True)
+    snippet = serializers.CharField(read_only=True)
+
+
+class BulkFileVersionUploadSerializer(serializers.Serializer):
+    """
+    Upload many files in one request, as repeated ``files`` parts and/or a zip or tar
+    ``archive`` whose folders are created under ``path``.
+
+    Revisions for the whole batch are reserved with one query and the versions, blob
+    references and owner access rows are written with bulk inserts. Every file gets
+    its own result, so one bad entry does not reject the batch.
+    """
+
+    path = serializers.CharField(required=False, allow_blank=True, default="", validators=[validate_path])
+    files = serializers.ListField(child=serializers.FileField(), required=False, default=list)
+    archive = serializers.FileField(required=False)
+
+    def validate(self, attrs):
+        if not attrs["files"] and not attrs.get("archive"):
+            raise serializers.ValidationError("Provide files or an archive.")
+        return attrs
+
+    def create(self, validated_data):
+        user = self.context["request"].user
+        base_path = validated_data["path"]
+
+        entries = [
+            {"path": base_path, "file_name": upload.name, "upload": upload} for upload in validated_data["files"]
+        ]
+        try:
+            if validated_data.get("archive"):
+                entries.extend(self.read_archive(validated_data["archive"], base_path))
+            versions = self.create_versions(user, [entry for entry in entries if "upload" in entry])
+        finally:
+            for entry in entries:
+                if "upload" in entry:
+                    entry["upload"].close()
+
+        results = []
+        for entry in entries:
+            result = {"path": entry["path"], "file_name": entry["file_name"]}
+            if "errors" in entry:
+                result.update(status=status.HTTP_400_BAD_REQUEST, errors=entry["errors"])
+            else:
+                version = versions[id(entry)]
+                result.update(
+                    status=status.HTTP_201_CREATED,
+                    id=version.id,
+                    revision=version.revision,
+                    content_hash=version.content_hash,
+                )
+            results.append(result)
+        return results
+
+    @staticmethod
+    def create_versions(user, entries):
+        revision_counts = Counter((user.pk, entry["path"], entry["file_name"]) for entry in entries)
+        blobs = {}
+        for entry in entries:
+            upload = entry["upload"]
+            size, references = blobs.get(upload.content_hash, (upload.size, 0))
+            blobs[upload.content_hash] = (size, references + 1)
+
+        with transaction.atomic():
+            next_revisions = Document.objects.allocate_revisions(revision_counts)
+            new_blobs = Blob.objects.acquire_many(blobs)
+
+            versions = {}
+            new_blob_versions = []
+            for entry in entries:
+                key = (user.pk, entry["path"], entry["file_name"])
+                upload = entry["upload"]
+                name = blob_path(upload.content_hash)
+                # Only the first entry of a blob created by this call stores its content.
+                # Existing blobs may be chunked or deltas, which a raw copy would undo.
+                new_blob = upload.content_hash in new_blobs
+                if new_blob:
+                    new_blobs.discard(upload.content_hash)
+                    # Archive members wait here with their files closed, so one is open at a time.
+                    upload.open()
+                    try:
+                        # Without eager jobs new blobs are stored as they are and packed by a worker.
+                        packed = settings.FILE_JOBS_EAGER and (
+                            settings.FILE_CHUNK_STORAGE
+                            and Blob.objects.store_chunked(upload.content_hash, upload)
+                            or settings.FILE_COMPRESSION
+                            and Blob.objects.store_compressed(upload.content_hash, upload)
+                        )
+                        if not packed:
+                            blob_storage.save(name, upload)
+                    finally:
+                        upload.file.close()
+                version = FileVersion(
+                    user=user,
+                    file=name,
+                    file_name=entry["file_name"],
+                    path=entry["path"],
+                    revision=next_revisions[key],
+                    content_hash=upload.content_hash,
+                )
+                if new_blob:
+                    new_blob_versions.append(version)
+                versions[id(entry)] = version
+                next_revisions[key] += 1
+
+            FileVersion.objects.bulk_create(versions.values())
+            FileAccess.objects.bulk_create(
+                FileAccess(user=user, file_version=version, level=FileAccess.OWNER) for version in versions.values()
+            )
+            # bulk_create() sends no signals, so the folder counts and the cached lookups of
+            # the owner and the users of their grants are updated here.
+            Folder.objects.add_file_versions(user.pk, [version.id for version in versions.values()])
+            invalidate_user(user.pk)
+            Grant.objects.add_versions(list(versions.values()))
+            if new_blob_versions:
+                enqueue_new_blobs(new_blob_versions)
+        return versions
+
+    def read_archive(self, archive, base_path):
+        max_files = settings.FILE_BULK_UPLOAD_MAX_FILES
+        too_many_files = serializers.ValidationError({"archive": f"Archive must contain at most {max_files} files."})
+
+        if zipfile.is_zipfile(archive):
+            archive.seek(0)
+            with zipfile.ZipFile(archive) as zip_file:
+                members = [member for member in zip_file.infolist() if not member.is_dir()]
+                if len(members) > max_files:
+                    raise too_many_files
+                for member in members:
+                    with zip_file.open(member) as stream:
+                        yield self.read_archive_member(member.filename, stream, base_path)
+            return
+
+        archive.seek(0)
+        try:
+            tar_file = tarfile.open(fileobj=archive, mode="r:*")
+        except tarfile.TarError:
+            raise serializers.ValidationError({"archive": "Archive must be a zip or tar file."})
+        with tar_file:
+            # A tar file has no index, so its members are counted as they are read.
+            count = 0
+            for member in tar_file:
+                if member.isfile():
+                    count += 1
+                    if count > max_files:
+                        raise too_many_files
+                    yield self.read_archive_member(member.name, tar_file.extractfile(member), base_path)
+
+    @staticmethod
+    def read_archive_member(member_name, stream, base_path):
+        folder, _, file_name = member_name.strip("/").rpartition("/")
+        path = "/".join(part for part in (base_path, folder) if part)
+        entry = {"path": path, "file_name": file_name}
+        try:
+            validate_path(path)
+        except DjangoValidationError as exc:
+            entry["errors"] = exc.messages
         else:
-            ret["file"] = url
+            entry["upload"] = HashedUploadedFile.from_stream(stream, file_name)
+        return entry
 
-        return ret
+
+class UploadPartSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadPart
+        fields = ["number", "size", "sha256", "uploaded_at"]
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    part_count = serializers.IntegerField(read_only=True)
+    parts = UploadPartSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ["id", "path", "file_name", "size", "part_size", "part_count", "parts", "created_at"]
+        read_only_fields = ["id", "part_size", "created_at"]
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.FILE_UPLOAD_SESSION_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"Size must be between 1 and {settings.FILE_UPLOAD_SESSION_MAX_SIZE} bytes."
+            )
+        return value
+
+    def create(self, validated_data):
+        validated_data["user"] = self.context["request"].user
+        validated_data["part_size"] = settings.FILE_UPLOAD_PART_SIZE
+        with transaction.atomic():
+            session = super().create(validated_data)
+            # A sparse file of the final size, which parts are written into in place.
+            with open(session.temporary_path, "xb") as session_file:
+                session_file.truncate(session.size)
+        return session
 
 
 class ShareFileSerializer(serializers.Serializer):
+    VERSION = "version"
+    DOCUMENT = "document"
+    FOLDER = "folder"
+
     email = serializers.EmailField()
     permission = serializers.ChoiceField(choices=FilePermissions.PERMISSION_CHOICES)
+    # Anything wider than the one version is shared with a Grant, by its owner only.
+    scope = serializers.ChoiceField(choices=[VERSION, DOCUMENT, FOLDER], default=VERSION)
+
+
+class BulkRevokeSerializer(serializers.Serializer):
+    # Every file is shared with or revoked from every user, one result per pair.
+    MAX_PAIRS = 10_000
+
+    emails = serializers.ListField(child=serializers.EmailField(), allow_empty=False, max_length=1000)
+    files = serializers.ListField(child=serializers.IntegerField(), required=False, default=list, max_length=1000)
+    # Documents as "path/file_name", taking their latest revision as downloads do.
+    paths = serializers.ListField(child=serializers.CharField(), required=False, default=list, max_length=1000)
+
+    def validate(self, attrs):
+        attrs["emails"] = list(dict.fromkeys(attrs["emails"]))
+        attrs["files"] = list(dict.fromkeys(attrs["files"]))
+        attrs["paths"] = list(dict.fromkeys(path.strip("/") for path in attrs["paths"]))
+        if not attrs["files"] and not attrs["paths"]:
+            raise serializers.ValidationError("Provide files or paths.")
+        if len(attrs["emails"]) * (len(attrs["files"]) + len(attrs["paths"])) > self.MAX_PAIRS:
+            raise serializers.ValidationError(f"At most {self.MAX_PAIRS} users times files at once.")
+        return attrs
+
+
+class BulkShareSerializer(BulkRevokeSerializer):
+    permission = serializers.ChoiceField(choices=FilePermissions.PERMISSION_CHOICES)
+
+
+class GrantSerializer(serializers.ModelSerializer):
+    email = serializers.EmailField(source="user.email")
+    permission = serializers.ChoiceField(source="level", choices=FilePermissions.PERMISSION_CHOICES)
+
+    class Meta:
+        model = Grant
+        fields = ["id", "email", "path", "file_name", "permission", "created_at"]
+        read_only_fields = ["id", "created_at"]
+
+    def validate_path(self, value):
+        return value.strip("/")
+
+    def validate(self, attrs):
+        email = attrs.pop("user")["email"]
+        if email == self.context["request"].user.email:
+            raise serializers.ValidationError({"email": "You can not grant access to yourself."})
+        try:
+            attrs["user"] = User.objects.get(email=email)
+        except User.DoesNotExist:
+            raise serializers.ValidationError({"email": "User not found."})
+        return attrs
+
+    def create(self, validated_data):
+        # Granting the same folder or document again changes the level of the grant.
+        grant, _ = Grant.objects.update_or_create(
+            owner=self.context["request"].user,
+            user=validated_data["user"],
+            path=validated_data.get("path", ""),
+            file_name=validated_data.get("file_name", ""),
+            defaults={"level": validated_data["level"]},
+        )
+        return grant
 
 
 class EmailAuthTokenSerializer(serializers.Serializer):
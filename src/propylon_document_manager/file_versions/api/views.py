@@ -1,40 +1,87 @@
+import re
+
 from django.contrib.auth import get_user_model
-from django.http import FileResponse
-from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from rest_framework.mixins import RetrieveModelMixin, ListModelMixin, CreateModelMixin, DestroyModelMixin
 from rest_framework.viewsets import GenericViewSet
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.authentication import TokenAuthentication, SessionAuthentication
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.generics import get_object_or_404
 from rest_framework import status
 
-from ..models import FileVersion, FilePermissions
-from .serializers import FileVersionSerializer, EmailAuthTokenSerializer, ShareFileSerializer
+from ..archives import ARCHIVE_FORMATS, serve_archive
+from ..cache import lookup_content_hashes, resolve_file_version, stats
+from ..metrics import metrics
+from ..models import (
+    Blob,
+    Document,
+    FileAccess,
+    FileVersion,
+    FilePermissions,
+    Folder,
+    Grant,
+    UploadPart,
+    UploadSession,
+    validate_path,
+)
+from ..search import search_file_versions
+from ..serving import serve_file_version
+from ..uploads import HashedUploadedFile, write_upload_part
+from .pagination import CreatedAtCursorPagination
+from .serializers import (
+    BulkFileVersionUploadSerializer,
+    BulkRevokeSerializer,
+    BulkShareSerializer,
+    CASLookupSerializer,
+    DirectoryListingSerializer,
+    EmailAuthTokenSerializer,
+    FileVersionSerializer,
+    GrantSerializer,
+    SearchQuerySerializer,
+    SearchResultSerializer,
+    ShareFileSerializer,
+    UploadPartSerializer,
+    UploadSessionSerializer,
+)
 from propylon_document_manager.utils.permissions import FileVersionPermission
 
 User = get_user_model()
 
+CONTENT_HASH_RE = re.compile("[0-9a-f]{64}")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
 
 class FileVersionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet, CreateModelMixin, DestroyModelMixin):
     authentication_classes = [TokenAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated, FileVersionPermission]
     serializer_class = FileVersionSerializer
+    pagination_class = CreatedAtCursorPagination
 
     lookup_field = "id"
 
     def get_queryset(self):
-        user = self.request.user
+        return FileVersion.objects.accessible_by(self.request.user)
 
-        owned_files = Q(user=user)
-        permitted_files = Q(file_permissions__user=user)
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        serializer = BulkFileVersionUploadSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
 
-        queryset = FileVersion.objects.filter(owned_files | permitted_files).distinct()
-        return queryset
+        failed = any(result["status"] != status.HTTP_201_CREATED for result in results)
+        return Response(results, status=status.HTTP_207_MULTI_STATUS if failed else status.HTTP_201_CREATED)
 
     @action(detail=True, methods=["post"], url_path="share")
     def share(self, request, id=None):
@@ -43,6 +90,11 @@ class FileVersionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet, Cre
         serializer.is_valid(raise_exception=True)
         target_email = serializer.validated_data["email"]
         permission = serializer.validated_data["permission"]
+        scope = serializer.validated_data["scope"]
+        if scope != ShareFileSerializer.VERSION and file_version.user_id != request.user.pk:
+            return Response(
+                {"detail": f"Only the owner can share the whole {scope}."}, status=status.HTTP_403_FORBIDDEN
+            )
 
         if target_email == request.user.email:
             return Response({"detail": "You are trying to share file to yourself."}, status=status.HTTP_400_BAD_REQUEST)
@@ -53,6 +105,17 @@ class FileVersionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet, Cre
         except User.DoesNotExist:
             return Response({"detail": "User not found"}, status=status.HTTP_400_BAD_REQUEST)
 
+        if scope != ShareFileSerializer.VERSION:
+            # One row for every revision, or everything in the folder, including later uploads.
+            Grant.objects.update_or_create(
+                owner=request.user,
+                user=target_user,
+                path=file_version.path,
+                file_name=file_version.file_name if scope == ShareFileSerializer.DOCUMENT else "",
+                defaults={"level": permission},
+            )
+            return Response({"detail": f"{scope.capitalize()} shared with {target_email}"})
+
         FilePermissions.objects.update_or_create(
             user=target_user,
             file=file_version,
@@ -60,6 +123,185 @@ class FileVersionViewSet(RetrieveModelMixin, ListModelMixin, GenericViewSet, Cre
         )
         return Response({"detail": f"File shared with {target_email}"})
 
+    @action(detail=False, methods=["post"], url_path="bulk-share")
+    def bulk_share(self, request):
+        serializer = BulkShareSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.change_shares(request, serializer.validated_data, serializer.validated_data["permission"])
+
+    @action(detail=False, methods=["post"], url_path="bulk-revoke")
+    def bulk_revoke(self, request):
+        serializer = BulkRevokeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.change_shares(request, serializer.validated_data)
+
+    def change_shares(self, request, data, permission=None):
+        """
+        Share every file with every user at ``permission``, or revoke the shares without
+        one. Users are resolved with one query and files with at most two, and the
+        shares are written set-based in one transaction. Unknown users and files, and
+        files the user may not share, get a result of their own.
+        """
+        results = []
+        users = dict(User.objects.filter(email__in=data["emails"]).values_list("email", "pk"))
+        recipients = {}
+        for email in data["emails"]:
+            if email == request.user.email:
+                errors = ["You can not share files with yourself."]
+                results.append({"email": email, "status": status.HTTP_400_BAD_REQUEST, "errors": errors})
+            elif email not in users:
+                results.append({"email": email, "status": status.HTTP_400_BAD_REQUEST, "errors": ["User not found."]})
+            else:
+                recipients[email] = users[email]
+
+        shareable = []
+        for key, file_version in self.resolve_files(request, data["files"], data["paths"]):
+            if file_version is None:
+                results.append({**key, "status": status.HTTP_404_NOT_FOUND, "errors": ["File not found."]})
+            elif file_version.access_level not in (FileAccess.OWNER, FilePermissions.READ_WRITE):
+                errors = ["You can not share this file."]
+                results.append({**key, "status": status.HTTP_403_FORBIDDEN, "errors": errors})
+            else:
+                shareable.append((key, file_version))
+
+        user_ids = list(recipients.values())
+        versions = [file_version for _, file_version in shareable]
+        if permission is None:
+            changed = FilePermissions.objects.revoke_many(user_ids, versions)
+        else:
+            changed = FilePermissions.objects.share_many(request.user, user_ids, versions, permission)
+
+        for email, user_id in recipients.items():
+            for key, file_version in shareable:
+                result = {"email": email, **key, "id": file_version.id}
+                if file_version.user_id == user_id:
+                    result.update(status=status.HTTP_400_BAD_REQUEST, errors=["The user owns this file."])
+                elif permission is None:
+                    revoked = (user_id, file_version.id) in changed
+                    result["status"] = status.HTTP_200_OK if revoked else status.HTTP_404_NOT_FOUND
+                    if not revoked:
+                        result["errors"] = ["Not shared with the user."]
+                else:
+                    created = (user_id, file_version.id) in changed
+                    result["status"] = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+                results.append(result)
+
+        failed = any(result["status"] >= status.HTTP_400_BAD_REQUEST for result in results)
+        return Response(results, status=status.HTTP_207_MULTI_STATUS if failed else status.HTTP_200_OK)
+
+    def resolve_files(self, request, ids, paths):
+        """
+        Yield ({"file": id} or {"path": path}, version or None) for the given ids and
+        for the latest revision of the given "path/file_name" documents.
+        """
+        accessible = FileVersion.objects.accessible_by(request.user).only("id", "user", "path", "file_name")
+        by_id = accessible.in_bulk(ids) if ids else {}
+        for file_version_id in ids:
+            yield {"file": file_version_id}, by_id.get(file_version_id)
+
+        documents = [tuple(path.rpartition("/")[::2]) for path in paths]
+        latest = {}
+        if documents:
+            matches = Q()
+            for path, file_name in documents:
+                matches |= Q(path=path, file_name=file_name)
+            latest = {
+                (file_version.path, file_version.file_name): file_version
+                for file_version in accessible.filter(matches)
+                .order_by("path", "file_name", "-revision")
+                .distinct("path", "file_name")
+            }
+        for path, document in zip(paths, documents):
+            yield {"path": path}, latest.get(document)
+
+
+class GrantViewSet(CreateModelMixin, ListModelMixin, DestroyModelMixin, GenericViewSet):
+    """
+    Grants the user gave: access for another user to all revisions of a document when
+    ``file_name`` is set, or else to everything below the folder ``path``, including
+    versions uploaded later. An empty path grants the user's whole tree.
+    """
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = GrantSerializer
+
+    def get_queryset(self):
+        return (
+            Grant.objects.filter(owner=self.request.user)
+            .select_related("user")
+            .order_by("path", "file_name", "user__email")
+        )
+
+
+class UploadSessionViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, GenericViewSet):
+    """
+    Resumable uploads. A session is created with the path, name and size of the file,
+    its parts are PUT as raw bytes to ``parts/<number>`` in any order, in parallel
+    and again after a failure, and ``complete`` turns the session into a new revision.
+    Retrieving the session lists the parts received so far.
+    """
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+    serializer_class = UploadSessionSerializer
+    lookup_value_regex = "[0-9a-f-]{36}"
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user).prefetch_related("parts")
+
+    @action(detail=True, methods=["put"], url_path=r"parts/(?P<number>[0-9]+)")
+    def part(self, request, pk=None, number=None):
+        number = int(number)
+        # The request body is read straight from the socket, never buffered by Django.
+        with transaction.atomic():
+            session = UploadSession.objects.lock_for_part(pk, request.user)
+            if session is None:
+                raise NotFound()
+            if not 1 <= number <= session.part_count:
+                return Response(
+                    {"error": f"part must be between 1 and {session.part_count}"}, status=status.HTTP_400_BAD_REQUEST
+                )
+            offset, size = session.part_range(number)
+            if request.META.get("CONTENT_LENGTH") != str(size):
+                return Response({"error": f"part {number} must be {size} bytes"}, status=status.HTTP_400_BAD_REQUEST)
+
+            sha256 = write_upload_part(session.temporary_path, offset, size, request.stream)
+            if sha256 is None:
+                return Response({"error": f"part {number} is incomplete"}, status=status.HTTP_400_BAD_REQUEST)
+            part = UploadPart(session=session, number=number, size=size, sha256=sha256)
+            UploadPart.objects.bulk_create(
+                [part],
+                update_conflicts=True,
+                unique_fields=["session", "number"],
+                update_fields=["size", "sha256", "uploaded_at"],
+            )
+        return Response(UploadPartSerializer(part).data)
+
+    @action(detail=True, methods=["post"])
+    def complete(self, request, pk=None):
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), pk=pk, user=request.user)
+            received = set(session.parts.values_list("number", flat=True))
+            missing = [number for number in range(1, session.part_count + 1) if number not in received]
+            if missing:
+                return Response(
+                    {"error": "parts missing", "missing_parts": missing[:100]}, status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # The assembled file is hashed once and renamed into the blob store.
+            upload = HashedUploadedFile.from_temporary_file(session.temporary_path, session.file_name)
+            file_version = FileVersion.objects.create(
+                user=request.user,
+                path=session.path,
+                file_name=session.file_name,
+                revision=Document.objects.allocate_revision(request.user, session.path, session.file_name),
+                file=upload,
+            )
+            session.delete()
+        serializer = FileVersionSerializer(file_version, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
 
 class EmailAuthToken(ObtainAuthToken):
     serializer_class = EmailAuthTokenSerializer
@@ -77,27 +319,93 @@ class FileServeView(APIView):
     authentication_classes = [TokenAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
-    def get(self, request, file_path):
+    def get(self, request, file_path=""):
+        if "list" in request.query_params:
+            return self.get_listing(request, file_path.strip("/"))
+
+        archive_format = request.query_params.get("archive")
+        if archive_format is not None:
+            return self.get_archive(request, file_path.strip("/"), archive_format)
+
         revision = request.query_params.get("revision")
         path, file_name = self.get_file_path_and_name(file_path)
 
-        owned_files = Q(user=request.user)
-        permitted_files = Q(file_permissions__user=request.user)
-        qs = FileVersion.objects.filter(owned_files | permitted_files).filter(path=path, file_name=file_name)
+        if revision is not None:
+            revision = int(revision)
+        resolved = resolve_file_version(request.user, path, file_name, revision)
 
-        if not qs.exists():
+        if resolved is None:
+            if revision is not None and resolve_file_version(request.user, path, file_name) is not None:
+                return Response({"error": "revision not found"}, status=404)
             return Response({"error": "file not found"}, status=404)
 
-        if revision is not None:
-            file_obj = qs.filter(revision=int(revision)).first()
-            if not file_obj:
-                return Response({"error": "revision not found"}, status=404)
-        else:
-            file_obj = qs.order_by("-revision").first()
+        file_obj, blob = resolved
+        return serve_file_version(request, file_obj, file_name, immutable=revision is not None, blob=blob)
+
+    def get_listing(self, request, directory):
+        """
+        List the subfolders of ``directory`` from the user's folder tree and the latest
+        accessible revision of each file directly in it.
+        """
+        folder = Folder.objects.filter(user=request.user, path=directory).first()
+        if folder is None:
+            if directory:
+                return Response({"error": "folder not found"}, status=404)
+            folder = Folder(path="", file_count=0, size=0)
+
+        folders = Folder.objects.filter(user=request.user, parent=directory).order_by("name")
+        files = (
+            FileVersion.objects.accessible_by(request.user)
+            .filter(path=directory)
+            .order_by("file_name", "-revision")
+            .distinct("file_name")
+            .annotate(size=Subquery(Blob.objects.filter(content_hash=OuterRef("content_hash")).values("size")[:1]))
+        )
+        listing = {"path": directory, "file_count": folder.file_count, "size": folder.size}
+        serializer = DirectoryListingSerializer(
+            {**listing, "folders": folders, "files": files}, context={"request": request}
+        )
+        return Response(serializer.data)
+
+    def get_archive(self, request, directory, archive_format):
+        """
+        Stream every accessible file under ``directory`` as one archive, taking the
+        latest revision of each file or, with ``as_of``, the latest one created by then.
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            return Response(
+                {"error": f"archive must be one of {', '.join(ARCHIVE_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            validate_path(directory)
+        except ValidationError as error:
+            return Response({"error": error.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        qs = FileVersion.objects.accessible_by(request.user)
+        if directory:
+            qs = qs.filter(Q(path=directory) | Q(path__startswith=f"{directory}/"))
 
-        response = FileResponse(file_obj.file.open("rb"))
-        response["Content-Disposition"] = f'attachment; filename="{file_name}"'
-        return response
+        as_of = request.query_params.get("as_of")
+        if as_of is not None:
+            try:
+                as_of = parse_datetime(as_of)
+            except ValueError:
+                as_of = None
+            if as_of is None:
+                return Response({"error": "as_of must be an ISO 8601 datetime"}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(as_of):
+                as_of = timezone.make_aware(as_of)
+            qs = qs.filter(created_at__lte=as_of)
+
+        # One row per file, the highest revision, as single file downloads pick it.
+        file_versions = list(
+            qs.order_by("path", "file_name", "-revision", "-created_at").distinct("path", "file_name")
+        )
+        if not file_versions:
+            return Response({"error": "no files found"}, status=404)
+
+        archive_name = directory.rsplit("/", 1)[-1] or "files"
+        return serve_archive(file_versions, archive_format, archive_name, base_path=directory)
 
     def get_file_path_and_name(self, file_path):
         folders = file_path.split('/')
@@ -111,10 +419,78 @@ class FileCASView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, hash_value):
-        owned_files = Q(user=request.user)
-        permitted_files = Q(file_permissions__user=request.user)
-        files = FileVersion.objects.filter(owned_files | permitted_files).filter(content_hash=hash_value)
-        if not files.exists():
+        files = None
+        if CONTENT_HASH_RE.fullmatch(hash_value):
+            files = lookup_content_hashes(request.user, [hash_value]).get(hash_value)
+        if not files:
             return Response({"error": "No files found with this hash"}, status=404)
         serializer = FileVersionSerializer(files, many=True, context={"request": request})
         return Response(serializer.data)
+
+
+class FileCASLookupView(APIView):
+    """
+    Tell which of up to 10,000 content hashes the user already has, so a client can
+    check a whole tree in one request before uploading what is missing.
+    """
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = CASLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        content_hashes = list(dict.fromkeys(serializer.validated_data["hashes"]))
+
+        found = lookup_content_hashes(request.user, content_hashes)
+        files = [file_version for content_hash in found for file_version in found[content_hash]]
+        data = iter(FileVersionSerializer(files, many=True, context={"request": request}).data)
+        return Response(
+            {
+                "found": {content_hash: [next(data) for _ in found[content_hash]] for content_hash in found},
+                "missing": [content_hash for content_hash in content_hashes if content_hash not in found],
+            }
+        )
+
+
+class SearchView(APIView):
+    """Ranked full-text search over the content of the files the user can read."""
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        params = SearchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        results = search_file_versions(
+            request.user,
+            params.validated_data["q"],
+            path=params.validated_data["path"].strip("/"),
+            all_revisions=params.validated_data["all_revisions"],
+            limit=params.validated_data["limit"],
+        )
+        serializer = SearchResultSerializer(results, many=True, context={"request": request})
+        return Response({"results": serializer.data})
+
+
+class CacheStatsView(APIView):
+    """Hit and miss counters of the lookup cache in the worker that serves the request."""
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(stats.snapshot())
+
+
+class MetricsView(APIView):
+    """
+    Request latencies, database, storage and hashing counters and lookup cache hits
+    of the worker that serves the request, in the Prometheus text format.
+    """
+
+    authentication_classes = [TokenAuthentication, SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,169 @@
+import tarfile
+import zipfile
+from collections import Counter
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from .metrics import metrics
+from .models import Blob
+from .storage import stream_size
+
+ZIP = "zip"
+TAR = "tar"
+
+ARCHIVE_FORMATS = (ZIP, TAR)
+CONTENT_TYPES = {ZIP: "application/zip", TAR: "application/x-tar"}
+
+CHUNK_SIZE = 64 * 1024
+# Zip has no links, so a blob used by several entries is written once per entry. Blobs
+# up to this many bytes in total are kept in memory until their last entry instead of
+# being read from storage again.
+ZIP_REUSE_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def serve_archive(file_versions, archive_format, archive_name, base_path=""):
+    """
+    Stream the given file versions as a zip or tar archive.
+
+    The archive is produced by a generator one chunk at a time, so neither the
+    archive nor any single blob is held in memory or spooled to disk. Entry names
+    are the version paths relative to ``base_path``. Entries that share a
+    content hash are read from storage once: tar repeats them as hard links and
+    zip replays a bounded in-memory copy.
+    """
+    blobs = Blob.objects.in_bulk({file_version.content_hash for file_version in file_versions})
+    entries = [
+        (_entry_name(file_version, base_path), file_version, blobs[file_version.content_hash])
+        for file_version in file_versions
+    ]
+    stream = _zip_stream(entries) if archive_format == ZIP else _tar_stream(entries)
+
+    response = StreamingHttpResponse(stream, content_type=CONTENT_TYPES[archive_format])
+    response["Content-Disposition"] = content_disposition_header(True, f"{archive_name}.{archive_format}")
+    return response
+
+
+def open_blob(blob):
+    return blob.open()
+
+
+def _entry_name(file_version, base_path):
+    path = file_version.path
+    if base_path:
+        path = path.removeprefix(base_path).lstrip("/")
+    return f"{path}/{file_version.file_name}" if path else file_version.file_name
+
+
+def _read_chunks(blob_file):
+    while chunk := blob_file.read(CHUNK_SIZE):
+        metrics.increment("storage_read_bytes_total", len(chunk))
+        yield chunk
+
+
+class _ArchiveBuffer:
+    """
+    Write-only file object handed to ZipFile. It has no seek(), which makes ZipFile
+    write data descriptors after each entry instead of going back to patch headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self.chunks:
+            data = b"".join(self.chunks)
+            self.chunks.clear()
+            yield data
+
+
+def _zip_stream(entries):
+    buffer = _ArchiveBuffer()
+    remaining = Counter(file_version.content_hash for _, file_version, _ in entries)
+    reusable = {}
+    reusable_size = 0
+
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, file_version, blob in entries:
+            content_hash = file_version.content_hash
+            remaining[content_hash] -= 1
+            info = zipfile.ZipInfo(name, date_time=_zip_date_time(file_version.created_at))
+
+            content = reusable.get(content_hash)
+            if content is not None:
+                info.file_size = len(content)
+                with archive.open(info, "w") as entry:
+                    entry.write(content)
+                yield from buffer.drain()
+            else:
+                with open_blob(blob) as blob_file:
+                    info.file_size = stream_size(blob_file)
+                    keep = (
+                        content_hash
+                        and remaining[content_hash] > 0
+                        and reusable_size + info.file_size <= ZIP_REUSE_BUFFER_SIZE
+                    )
+                    kept = []
+                    with archive.open(info, "w") as entry:
+                        for chunk in _read_chunks(blob_file):
+                            entry.write(chunk)
+                            if keep:
+                                kept.append(chunk)
+                            yield from buffer.drain()
+                    if keep:
+                        reusable[content_hash] = b"".join(kept)
+                        reusable_size += info.file_size
+                yield from buffer.drain()
+
+            if not remaining[content_hash] and content_hash in reusable:
+                reusable_size -= len(reusable.pop(content_hash))
+
+    yield from buffer.drain()
+
+
+def _zip_date_time(created_at):
+    # Zip timestamps are local time and can not go before 1980.
+    return max(timezone.localtime(created_at).timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def _tar_stream(entries):
+    first_entries = {}
+
+    for name, file_version, blob in entries:
+        info = tarfile.TarInfo(name)
+        info.mode = 0o644
+        info.mtime = int(file_version.created_at.timestamp())
+
+        content_hash = file_version.content_hash
+        if content_hash in first_entries:
+            info.type = tarfile.LNKTYPE
+            info.linkname = first_entries[content_hash]
+            yield info.tobuf(tarfile.PAX_FORMAT)
+            continue
+        if content_hash:
+            first_entries[content_hash] = name
+
+        with open_blob(blob) as blob_file:
+            info.size = stream_size(blob_file)
+            yield info.tobuf(tarfile.PAX_FORMAT)
+            yield from _read_chunks(blob_file)
+
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    # End-of-archive marker: two empty blocks.
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
@@ -0,0 +1,303 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Blob, FileVersion, Grant
+
+PREFIX = "file_versions"
+# Stored for lookups that found nothing, since the cache can not hold None.
+MISSING = ""
+
+
+class CacheStats:
+    """Hit and miss counters of this process, per kind of lookup."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, hit, count=1):
+        with self._lock:
+            counts = self._counts.setdefault(kind, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += count
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                kind: {**counts, "hit_rate": counts["hits"] / (counts["hits"] + counts["misses"])}
+                for kind, counts in self._counts.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.FILE_VERSION_CACHE]
+
+
+def user_generation(user_id):
+    """
+    Current generation of a user's cached entries; every key includes it, so bumping
+    it invalidates all of them at once. A missing generation starts from the clock
+    rather than zero, so an evicted counter never brings old entries back.
+    """
+    cache = get_cache()
+    key = f"{PREFIX}:generation:{user_id}"
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+async def auser_generation(user_id):
+    cache = get_cache()
+    key = f"{PREFIX}:generation:{user_id}"
+    generation = await cache.aget(key)
+    if generation is None:
+        await cache.aadd(key, time.time_ns(), timeout=None)
+        generation = await cache.aget(key)
+    return generation
+
+
+def invalidate_user(user_id):
+    """
+    Drop every cached lookup of a user. The generation is bumped again after commit,
+    so an entry filled from data the transaction had not committed yet is dropped too.
+    """
+    _bump_generation(user_id)
+    transaction.on_commit(lambda: _bump_generation(user_id))
+
+
+def _bump_generation(user_id):
+    try:
+        get_cache().incr(f"{PREFIX}:generation:{user_id}")
+    except ValueError:
+        pass  # No generation yet: the next lookup starts a fresh one.
+
+
+def get_grants(user):
+    """
+    The grants the user received, as (owner_id, path, file_name, level) tuples, cached
+    per user. FileVersion.objects.accessible_by() needs them for every query, and most
+    users have none.
+    """
+    key = f"{PREFIX}:grants:{user.pk}:{user_generation(user.pk)}"
+    cache = get_cache()
+
+    grants = cache.get(key)
+    stats.record("grants", grants is not None)
+    if grants is None:
+        grants = list(_grant_queryset(user))
+        cache.set(key, grants, timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return grants
+
+
+async def aget_grants(user):
+    key = f"{PREFIX}:grants:{user.pk}:{await auser_generation(user.pk)}"
+    cache = get_cache()
+
+    grants = await cache.aget(key)
+    stats.record("grants", grants is not None)
+    if grants is None:
+        grants = [grant async for grant in _grant_queryset(user)]
+        await cache.aset(key, grants, timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return grants
+
+
+def _grant_queryset(user):
+    return Grant.objects.filter(user=user).order_by("pk").values_list("owner_id", "path", "file_name", "level")
+
+
+def resolve_file_version(user, path, file_name, revision=None):
+    """
+    Return (file_version, blob) for the version of ``path/file_name`` the user can
+    read, the latest one unless ``revision`` is given, or None.
+
+    The result is cached per user with everything needed to serve the file, so hot
+    documents resolve without a database query. Only the fields used for serving are
+    set on the returned, unsaved instances.
+    """
+    key = _version_key(user.pk, user_generation(user.pk), path, file_name, revision)
+    cache = get_cache()
+
+    entry = cache.get(key)
+    stats.record("version", entry is not None)
+    if entry is None:
+        file_version = _version_queryset(user, path, file_name, revision).first()
+        blob = None
+        if file_version is not None:
+            blob = Blob.objects.get(content_hash=file_version.content_hash)
+        entry = _version_entry(file_version, blob)
+        cache.set(key, entry, timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return _version_from_entry(entry, path, file_name)
+
+
+async def aresolve_file_version(user, path, file_name, revision=None):
+    """resolve_file_version() for async views, sharing its cache entries."""
+    key = _version_key(user.pk, await auser_generation(user.pk), path, file_name, revision)
+    cache = get_cache()
+
+    entry = await cache.aget(key)
+    stats.record("version", entry is not None)
+    if entry is None:
+        grants = await aget_grants(user)
+        file_version = await _version_queryset(user, path, file_name, revision, grants).afirst()
+        blob = None
+        if file_version is not None:
+            blob = await Blob.objects.aget(content_hash=file_version.content_hash)
+        entry = _version_entry(file_version, blob)
+        await cache.aset(key, entry, timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return _version_from_entry(entry, path, file_name)
+
+
+def _version_key(user_id, generation, path, file_name, revision):
+    digest = hashlib.sha1(f"{path}\0{file_name}".encode()).hexdigest()
+    return f"{PREFIX}:version:{user_id}:{generation}:{'latest' if revision is None else revision}:{digest}"
+
+
+def _version_queryset(user, path, file_name, revision, grants=None):
+    queryset = FileVersion.objects.accessible_by(user, grants).filter(path=path, file_name=file_name)
+    if revision is not None:
+        queryset = queryset.filter(revision=revision)
+    return queryset.order_by("-revision")
+
+
+def _version_entry(file_version, blob):
+    if file_version is None:
+        return MISSING
+    return {
+        "id": file_version.id,
+        "revision": file_version.revision,
+        "content_hash": file_version.content_hash,
+        "created_at": file_version.created_at,
+        "file": file_version.file.name,
+        "size": blob.size,
+        "codec": blob.codec,
+        "base_id": blob.base_id,
+        "chunked": blob.chunked,
+    }
+
+
+def _version_from_entry(entry, path, file_name):
+    if entry == MISSING:
+        return None
+
+    file_version = FileVersion(
+        id=entry["id"],
+        path=path,
+        file_name=file_name,
+        revision=entry["revision"],
+        content_hash=entry["content_hash"],
+        created_at=entry["created_at"],
+        file=entry["file"],
+    )
+    blob = Blob(
+        content_hash=entry["content_hash"],
+        size=entry["size"],
+        codec=entry["codec"],
+        base_id=entry["base_id"],
+        chunked=entry["chunked"],
+    )
+    return file_version, blob
+
+
+# FileVersion fields cached by lookup_content_hashes(), enough to serialize a version.
+CAS_FIELDS = ("id", "user_id", "file", "file_name", "path", "revision", "content_hash", "created_at")
+
+
+def lookup_content_hashes(user, content_hashes):
+    """
+    Map each of ``content_hashes`` that the user can read a version of to those
+    versions, newest first, as unsaved instances. Hashes without any are left out.
+
+    Results are cached per user and hash, including the hashes found nowhere, so a
+    client syncing a tree again mostly gets its answer from one get_many(). The
+    remaining hashes are looked up with a single indexed query.
+    """
+    cache = get_cache()
+    keys = _cas_keys(user.pk, user_generation(user.pk), content_hashes)
+    cached = cache.get_many(keys.values())
+    found, misses = _cas_hits(keys, cached)
+    if misses:
+        loaded = _group_by_hash(_cas_queryset(user, misses))
+        found.update(loaded)
+        cache.set_many(_cas_entries(keys, misses, loaded), timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return _cas_result(found)
+
+
+async def alookup_content_hashes(user, content_hashes):
+    """lookup_content_hashes() for async views, sharing its cache entries."""
+    cache = get_cache()
+    keys = _cas_keys(user.pk, await auser_generation(user.pk), content_hashes)
+    cached = await cache.aget_many(keys.values())
+    found, misses = _cas_hits(keys, cached)
+    if misses:
+        grants = await aget_grants(user)
+        loaded = _group_by_hash([row async for row in _cas_queryset(user, misses, grants)])
+        found.update(loaded)
+        await cache.aset_many(_cas_entries(keys, misses, loaded), timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return _cas_result(found)
+
+
+def _cas_keys(user_id, generation, content_hashes):
+    return {content_hash: f"{PREFIX}:cas:{user_id}:{generation}:{content_hash}" for content_hash in content_hashes}
+
+
+def _cas_hits(keys, cached):
+    misses = [content_hash for content_hash, key in keys.items() if key not in cached]
+    stats.record("cas", True, len(keys) - len(misses))
+    stats.record("cas", False, len(misses))
+    found = {content_hash: cached[key] for content_hash, key in keys.items() if cached.get(key)}
+    return found, misses
+
+
+def _cas_queryset(user, content_hashes, grants=None):
+    return (
+        FileVersion.objects.accessible_by(user, grants)
+        .filter(content_hash__in=content_hashes)
+        .order_by("-created_at", "-id")
+        .values(*CAS_FIELDS)
+    )
+
+
+def _group_by_hash(rows):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row["content_hash"], []).append(row)
+    return grouped
+
+
+def _cas_entries(keys, misses, loaded):
+    return {keys[content_hash]: loaded.get(content_hash, MISSING) for content_hash in misses}
+
+
+def _cas_result(found):
+    return {content_hash: [FileVersion(**row) for row in rows] for content_hash, rows in found.items()}
+
+
+def get_access_level(user, file_version_id):
+    """The user's access level on a version, or None, cached per user."""
+    key = f"{PREFIX}:access:{user.pk}:{user_generation(user.pk)}:{file_version_id}"
+    cache = get_cache()
+
+    level = cache.get(key)
+    stats.record("access", level is not None)
+    if level is None:
+        level = (
+            FileVersion.objects.accessible_by(user)
+            .filter(pk=file_version_id)
+            .values_list("access_level", flat=True)
+            .first()
+        ) or MISSING
+        cache.set(key, level, timeout=settings.FILE_VERSION_CACHE_TIMEOUT)
+    return level or None
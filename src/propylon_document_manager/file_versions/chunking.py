@@ -0,0 +1,128 @@
+import bisect
+import io
+from random import Random
+
+from .compression import open_compressed
+
+# Random 64-bit values for every byte, fixed so chunk boundaries never change.
+_random = Random(0x5EED)
+GEAR = [_random.getrandbits(64) for _ in range(256)]
+HASH_MASK = 2**64 - 1
+
+
+def _mask(bits):
+    # The top bits of a gear hash depend on the most bytes, so boundaries test those.
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def iter_chunks(stream, average_size):
+    """
+    Split a stream into content-defined chunks with FastCDC.
+
+    A boundary is cut where a rolling gear hash of the last bytes matches a mask, so
+    an edit only changes the chunks around it and the rest of the file splits the
+    same way as before. Chunks are between a quarter of and four times
+    ``average_size``; normalized chunking uses a stricter mask before the average
+    size and a looser one after it, which keeps most chunks close to the average.
+    """
+    min_size, max_size = average_size // 4, average_size * 4
+    bits = max(average_size.bit_length() - 1, 4)
+    strict_mask, loose_mask = _mask(bits + 2), _mask(bits - 2)
+
+    buffer = b""
+    eof = False
+    while True:
+        if not eof and len(buffer) < max_size:
+            data = stream.read(max_size * 4)
+            eof = not data
+            buffer += data
+        if not buffer:
+            return
+        if len(buffer) <= min_size and eof:
+            yield buffer
+            return
+        end = _cut_point(buffer, min_size, average_size, max_size, strict_mask, loose_mask)
+        yield buffer[:end]
+        buffer = buffer[end:]
+
+
+def _cut_point(data, min_size, average_size, max_size, strict_mask, loose_mask):
+    size = len(data)
+    if size <= min_size:
+        return size
+    normal_end, end = min(average_size, size), min(max_size, size)
+
+    gear, hash_mask = GEAR, HASH_MASK
+    rolling = 0
+    for position, byte in enumerate(data[min_size:normal_end], min_size + 1):
+        rolling = ((rolling << 1) + gear[byte]) & hash_mask
+        if not rolling & strict_mask:
+            return position
+    for position, byte in enumerate(data[normal_end:end], normal_end + 1):
+        rolling = ((rolling << 1) + gear[byte]) & hash_mask
+        if not rolling & loose_mask:
+            return position
+    return end
+
+
+class ChunkedFile(io.RawIOBase):
+    """
+    Read-only, seekable view of content stored as a sequence of chunk files.
+
+    ``chunks`` lists (offset, size, path, codec) in order. Only the chunk under the
+    read position is held in memory; compressed chunks are decompressed whole.
+    """
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+        self._offsets = [offset for offset, _, _, _ in chunks]
+        self._position = 0
+        self._current = None
+        self._current_data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._position
+        pieces = []
+        while size > 0 and self._position < self.size:
+            index = bisect.bisect_right(self._offsets, self._position) - 1
+            offset, chunk_size, _, _ = self.chunks[index]
+            data = self._chunk_data(index)
+            start = self._position - offset
+            end = min(chunk_size, start + size)
+            pieces.append(data[start:end])
+            size -= end - start
+            self._position += end - start
+        return b"".join(pieces)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+    def _chunk_data(self, index):
+        if self._current != index:
+            _, _, path, codec = self.chunks[index]
+            with open_compressed(path, codec) if codec else open(path, "rb") as chunk_file:
+                self._current_data = chunk_file.read()
+            self._current = index
+        return self._current_data
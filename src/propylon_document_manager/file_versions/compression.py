@@ -0,0 +1,135 @@
+import gzip
+import io
+import shutil
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+CODEC_CHOICES = [(GZIP, "gzip"), (ZSTD, "zstd")]
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of formats that are compressed already and would not shrink further:
+# gzip, zstd, bzip2, xz, 7z, rar, zip (and docx/xlsx/odt), PNG, JPEG, GIF and MP3.
+COMPRESSED_SIGNATURES = (
+    b"\x1f\x8b",
+    b"\x28\xb5\x2f\xfd",
+    b"BZh",
+    b"\xfd7zXZ\x00",
+    b"7z\xbc\xaf\x27\x1c",
+    b"Rar!",
+    b"PK\x03\x04",
+    b"\x89PNG",
+    b"\xff\xd8\xff",
+    b"GIF8",
+    b"ID3",
+)
+
+
+def check_codec(codec):
+    if codec not in (GZIP, ZSTD):
+        raise ImproperlyConfigured(f"Unknown compression codec {codec!r}, expected {GZIP!r} or {ZSTD!r}")
+    if codec == ZSTD and zstandard is None:
+        raise ImproperlyConfigured("zstd compression requires the zstandard package")
+
+
+def is_compressible(head):
+    """Tell from the first bytes of a file whether compressing it is worth trying."""
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return False
+    # ISO media (mp4, mov, heic) and WebP/AVI containers.
+    return head[4:8] != b"ftyp" and not (head.startswith(b"RIFF") and head[8:12] in (b"WEBP", b"AVI "))
+
+
+def compress_stream(source, destination, codec):
+    """Compress ``source`` into ``destination`` chunk by chunk."""
+    check_codec(codec)
+    if codec == GZIP:
+        # A fixed mtime keeps the output a pure function of the content.
+        with gzip.GzipFile(fileobj=destination, mode="wb", mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+    else:
+        zstandard.ZstdCompressor().copy_stream(source, destination, read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
+
+
+def compress_bytes(data, codec):
+    """Compress a buffer held in memory, with the same output as compress_stream()."""
+    check_codec(codec)
+    if codec == GZIP:
+        return gzip.compress(data, mtime=0)
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def open_compressed(path, codec):
+    check_codec(codec)
+    if codec == GZIP:
+        return gzip.open(path, "rb")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+class DecompressedFile(io.RawIOBase):
+    """
+    Read-only, seekable view of the decompressed content of a stored blob.
+
+    ``size`` is the decompressed size, so seeking to the end is free. Seeks are
+    applied lazily on the next read: going forward decompresses and drops the bytes
+    in between, going backwards reopens the blob.
+    """
+
+    def __init__(self, path, codec, size):
+        self.path = path
+        self.codec = codec
+        self.size = size
+        self._stream = open_compressed(path, codec)
+        self._stream_position = 0
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def read(self, size=-1):
+        if self._position < self._stream_position:
+            self._stream.close()
+            self._stream = open_compressed(self.path, self.codec)
+            self._stream_position = 0
+        while self._stream_position < self._position:
+            skipped = self._stream.read(min(CHUNK_SIZE, self._position - self._stream_position))
+            if not skipped:
+                break
+            self._stream_position += len(skipped)
+
+        data = self._stream.read(size if size is not None and size >= 0 else -1)
+        self._stream_position += len(data)
+        self._position = self._stream_position
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
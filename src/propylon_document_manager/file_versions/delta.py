@@ -0,0 +1,174 @@
+import struct
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+MAGIC = b"PDMDELTA1"
+COPY = 1
+LITERAL = 2
+
+HEADER = struct.Struct(">Q")
+COPY_OP = struct.Struct(">BQQ")
+LITERAL_OP = struct.Struct(">BQ")
+
+# Granularity of the base index. A copy is only found for runs of at least this many
+# equal bytes, and after an edit the encoder needs at most this many bytes to resync.
+BLOCK_SIZE = 128
+# Largest slice compared at once while extending a match.
+MATCH_STEP = 4096
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def encode_delta(base, target, max_size=None):
+    """
+    Encode ``target`` as copies from ``base`` plus literal bytes, rsync style.
+
+    Aligned blocks of the base are indexed by their contents; the target is scanned
+    for those blocks at every offset, so inserted or removed bytes only cost a resync
+    within one block. Matches are then grown in both directions, which lets long
+    unchanged runs be skipped with a few slice comparisons instead of byte by byte.
+
+    Returns None when the delta would be larger than ``max_size`` bytes; the scan
+    stops as soon as that is certain, which bounds the work spent on unrelated files.
+    """
+    index = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        end = offset + BLOCK_SIZE
+        index.setdefault(base[offset:end], offset)
+
+    ops = [MAGIC, HEADER.pack(len(target))]
+    size = len(MAGIC) + HEADER.size
+    literal_start = position = 0
+    last = len(target) - BLOCK_SIZE
+
+    while position <= last:
+        end = position + BLOCK_SIZE
+        base_offset = index.get(target[position:end])
+        if base_offset is None:
+            position += 1
+            if max_size is not None and size + position - literal_start > max_size:
+                return None
+            continue
+
+        # The block is aligned in the base only, so the match may start a little earlier.
+        start, base_start = position, base_offset
+        while start > literal_start and base_start > 0 and target[start - 1] == base[base_start - 1]:
+            start -= 1
+            base_start -= 1
+        length = position - start + BLOCK_SIZE
+        length += _match_length(base, base_offset + BLOCK_SIZE, target, position + BLOCK_SIZE)
+
+        if start > literal_start:
+            ops.append(LITERAL_OP.pack(LITERAL, start - literal_start))
+            ops.append(target[literal_start:start])
+            size += LITERAL_OP.size + start - literal_start
+        ops.append(COPY_OP.pack(COPY, base_start, length))
+        size += COPY_OP.size
+        position = literal_start = start + length
+
+    if literal_start < len(target):
+        ops.append(LITERAL_OP.pack(LITERAL, len(target) - literal_start))
+        ops.append(target[literal_start:])
+        size += LITERAL_OP.size + len(target) - literal_start
+
+    if max_size is not None and size > max_size:
+        return None
+    return b"".join(ops)
+
+
+def apply_delta(base, delta):
+    """Rebuild the target of a delta produced by encode_delta() from its base."""
+    if not delta.startswith(MAGIC):
+        raise DeltaError("Not a delta")
+    (target_size,) = HEADER.unpack_from(delta, len(MAGIC))
+
+    pieces = []
+    position = len(MAGIC) + HEADER.size
+    base = memoryview(base)
+    try:
+        while position < len(delta):
+            op = delta[position]
+            if op == COPY:
+                _, offset, length = COPY_OP.unpack_from(delta, position)
+                end = offset + length
+                pieces.append(base[offset:end])
+                position += COPY_OP.size
+            elif op == LITERAL:
+                _, length = LITERAL_OP.unpack_from(delta, position)
+                start, position = position + LITERAL_OP.size, position + LITERAL_OP.size + length
+                pieces.append(delta[start:position])
+            else:
+                raise DeltaError(f"Unknown delta op {op}")
+    except struct.error as error:
+        raise DeltaError("Truncated delta") from error
+
+    target = b"".join(pieces)
+    if len(target) != target_size:
+        raise DeltaError(f"Delta produced {len(target)} bytes, expected {target_size}")
+    return target
+
+
+def _match_length(base, base_start, target, target_start):
+    """Length of the common prefix of base[base_start:] and target[target_start:]."""
+    limit = min(len(base) - base_start, len(target) - target_start)
+    length = 0
+    step = MATCH_STEP
+    while step:
+        while length + step <= limit:
+            base_from, target_from = base_start + length, target_start + length
+            base_to, target_to = base_from + step, target_from + step
+            if base[base_from:base_to] != target[target_from:target_to]:
+                break
+            length += step
+        step //= 2
+    return length
+
+
+class RevisionCache:
+    """
+    Thread-safe LRU cache of rebuilt delta-encoded contents, keyed by content hash and
+    bounded by the total number of bytes held.
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return settings.FILE_DELTA_CACHE_SIZE if self._max_size is None else self._max_size
+
+    def get(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+            return content
+
+    def set(self, key, content):
+        max_size = self.max_size
+        if len(content) > max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = content
+            self._size += len(content)
+            while self._size > max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+revision_cache = RevisionCache()
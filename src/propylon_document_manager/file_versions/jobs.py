@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import traceback
+from functools import partial
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+from .cache import invalidate_user
+from .metrics import metrics
+from .models import Blob, BlobText, FileAccess, FileVersion, Grant, Job
+from .search import update_search_vectors
+from .storage import blob_storage
+from .text import extract_text
+
+logger = logging.getLogger(__name__)
+
+PACK = "pack"
+VERIFY = "verify"
+EXTRACT_TEXT = "extract_text"
+
+CHUNK_SIZE = 64 * 1024
+
+HANDLERS = {}
+
+
+class BlobVerificationError(Exception):
+    pass
+
+
+def handler(kind):
+    """Register a function as the handler of a job kind; the payload is passed as keyword arguments."""
+
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+
+    return register
+
+
+def enqueue(jobs):
+    """Queue (kind, payload) pairs with one insert, or run them right away with FILE_JOBS_EAGER."""
+    if settings.FILE_JOBS_EAGER:
+        for kind, payload in jobs:
+            HANDLERS[kind](**payload)
+        return
+    Job.objects.bulk_create(Job(kind=kind, payload=payload) for kind, payload in jobs)
+
+
+def enqueue_new_blobs(file_versions):
+    """Queue the processing of blobs that were first stored by the given versions."""
+    content_hashes = sorted({file_version.content_hash for file_version in file_versions})
+    jobs = []
+    # Eager setups pack a blob while its upload is written instead.
+    packing = settings.FILE_CHUNK_STORAGE or settings.FILE_DELTA_STORAGE or settings.FILE_COMPRESSION
+    if not settings.FILE_JOBS_EAGER and packing:
+        jobs.append((PACK, {"file_versions": [file_version.pk for file_version in file_versions]}))
+    jobs.append((VERIFY, {"content_hashes": content_hashes}))
+    jobs.append((EXTRACT_TEXT, {"content_hashes": content_hashes}))
+    enqueue(jobs)
+
+
+def run_pending(worker, limit=10):
+    """Claim and run up to ``limit`` due jobs. Returns how many were claimed."""
+    jobs = Job.objects.claim(worker, limit)
+    for job in jobs:
+        try:
+            HANDLERS[job.kind](**job.payload)
+        except Exception:
+            logger.exception("Job %s failed", job)
+            Job.objects.retry_or_fail(job, traceback.format_exc())
+        else:
+            job.delete()
+    return len(jobs)
+
+
+def _locked_blobs(content_hashes):
+    # Locking the rows keeps a concurrent pack job from replacing the files while they are read.
+    return Blob.objects.select_for_update().filter(pk__in=content_hashes).order_by("pk")
+
+
+def _replace_raw_blob(name, user_ids):
+    # Cached lookups of the blob still describe it as raw, so they go before its file does.
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    blob_storage.delete(name)
+
+
+@handler(PACK)
+def pack_blobs(file_versions):
+    """
+    Store the raw blobs of new versions as chunks, deltas or compressed, like
+    FileVersion.save() does inline with FILE_JOBS_EAGER. Blobs that were packed
+    already are skipped.
+    """
+    for file_version in FileVersion.objects.filter(pk__in=file_versions).order_by("revision"):
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(pk=file_version.content_hash).first()
+            if blob is None or blob.codec or blob.chunked or blob.base_id is not None:
+                continue
+            # Jobs of later revisions may have run first. A blob that deltas were built on
+            # stays a snapshot, or their depth would no longer count it.
+            allow_delta = not Blob.objects.filter(base=blob).exists()
+            with File(blob.open_stored()) as stored:
+                if not file_version.store_new_blob(blob, stored, allow_delta=allow_delta):
+                    continue
+            readers = FileAccess.objects.filter(file_version__content_hash=blob.content_hash)
+            versions = FileVersion.objects.filter(content_hash=blob.content_hash).only("user", "path", "file_name")
+            grantees = Grant.objects.covering(list(versions))
+            user_ids = {*readers.values_list("user_id", flat=True).distinct(), *grantees}
+            # The packed forms were written next to the raw file, which readers keep using
+            # until the new form is committed. A rollback leaves it as the blob's content.
+            transaction.on_commit(partial(_replace_raw_blob, blob.name, user_ids))
+
+
+@handler(VERIFY)
+def verify_blobs(content_hashes):
+    """Hash the stored content of blobs again and raise if any does not match its content hash."""
+    corrupt = []
+    with transaction.atomic():
+        for blob in _locked_blobs(content_hashes):
+            sha256 = hashlib.sha256()
+            with blob.open() as blob_file:
+                while chunk := blob_file.read(CHUNK_SIZE):
+                    metrics.increment("storage_read_bytes_total", len(chunk))
+                    sha256.update(chunk)
+            if sha256.hexdigest() != blob.content_hash:
+                corrupt.append(blob.content_hash)
+    if corrupt:
+        raise BlobVerificationError(f"Stored content does not match the hash of {', '.join(corrupt)}")
+
+
+@handler(EXTRACT_TEXT)
+def extract_blob_texts(content_hashes):
+    """Extract the plain text of blobs into BlobText rows and index it for search."""
+    texts = []
+    with transaction.atomic():
+        for blob in _locked_blobs(content_hashes):
+            with blob.open() as blob_file:
+                content = extract_text(blob_file)
+            if content is not None:
+                texts.append(BlobText(blob=blob, content=content))
+        BlobText.objects.bulk_create(texts, update_conflicts=True, unique_fields=["blob"], update_fields=["content"])
+        if texts:
+            update_search_vectors([text.blob_id for text in texts])
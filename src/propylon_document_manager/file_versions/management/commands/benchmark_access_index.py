@@ -0,0 +1,153 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from propylon_document_manager.file_versions.models import FileAccess, FilePermissions, FileVersion, User
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the OR-join permission query with the FileAccess index on a synthetic data set. "
+        "Everything is generated inside a transaction that is rolled back unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10_000)
+        parser.add_argument("--versions", type=int, default=1_000_000)
+        parser.add_argument("--shares", type=int, default=10_000_000)
+        parser.add_argument("--samples", type=int, default=50, help="Number of users to run the queries for")
+        parser.add_argument("--explain", action="store_true", help="Print the query plans of both queries")
+        parser.add_argument("--keep", action="store_true", help="Commit the generated data")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options)
+                if not options["keep"]:
+                    raise Rollback
+        except Rollback:
+            self.stdout.write("Generated data rolled back")
+
+    def _run(self, options):
+        users, versions, shares = options["users"], options["versions"], options["shares"]
+        if shares > versions * (users - 1):
+            shares = versions * (users - 1)
+            self.stdout.write(self.style.WARNING(f"Capped shares at {shares} so every share is unique"))
+
+        started = time.perf_counter()
+        first_user, first_version = self._generate(users, versions, shares)
+        self.stdout.write(
+            f"Generated {users} users, {versions} versions and {shares} shares "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+
+        sample_users = [
+            User(pk=first_user + index * users // options["samples"]) for index in range(options["samples"])
+        ]
+        queries = {
+            "or-join": lambda user: FileVersion.objects.filter(
+                Q(user=user) | Q(file_permissions__user=user)
+            ).distinct(),
+            "access-index": lambda user: FileVersion.objects.accessible_by(user),
+        }
+
+        for name, build_queryset in queries.items():
+            if options["explain"]:
+                self.stdout.write(f"\n{name} plan:\n{build_queryset(sample_users[0]).explain(analyze=True)}\n")
+
+            timings = []
+            rows = 0
+            for user in sample_users:
+                started = time.perf_counter()
+                rows += len(build_queryset(user).values_list("id", flat=True))
+                timings.append((time.perf_counter() - started) * 1000)
+
+            timings.sort()
+            self.stdout.write(
+                f"{name:>12}: {rows / len(sample_users):.0f} rows/user, "
+                f"median {statistics.median(timings):.2f}ms, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f}ms, max {timings[-1]:.2f}ms"
+            )
+
+    def _generate(self, users, versions, shares):
+        user_table = User._meta.db_table
+        version_table = FileVersion._meta.db_table
+        permission_table = FilePermissions._meta.db_table
+        access_table = FileAccess._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH inserted AS (
+                    INSERT INTO {user_table} (password, is_superuser, is_staff, is_active, date_joined, name, email)
+                    SELECT '', false, false, true, now(), '', 'benchmark-' || g || '@example.com'
+                    FROM generate_series(0, %s - 1) AS g
+                    RETURNING id
+                )
+                SELECT min(id) FROM inserted
+                """,
+                [users],
+            )
+            first_user = cursor.fetchone()[0]
+
+            # Version g is owned by user g % users; share s gives version s % versions to
+            # the (s // versions + 1)-th user after its owner, so no pair repeats.
+            cursor.execute(
+                f"""
+                WITH inserted AS (
+                    INSERT INTO {version_table} (file, file_name, path, revision, content_hash, created_at, user_id)
+                    SELECT 'blobs/benchmark', 'document-' || g, 'benchmark/' || (g %% 1000), 1,
+                           md5(g::text) || md5(g::text), now() - g * interval '1 second', %s + g %% %s
+                    FROM generate_series(0, %s - 1) AS g
+                    RETURNING id
+                )
+                SELECT min(id) FROM inserted
+                """,
+                [first_user, users, versions],
+            )
+            first_version = cursor.fetchone()[0]
+
+            cursor.execute(
+                f"""
+                INSERT INTO {permission_table} (user_id, file_id, owner_id, permissions)
+                SELECT %(first_user)s + ((s %% %(versions)s) %% %(users)s + s / %(versions)s + 1) %% %(users)s,
+                       %(first_version)s + s %% %(versions)s,
+                       %(first_user)s + (s %% %(versions)s) %% %(users)s,
+                       CASE WHEN s %% 2 = 0 THEN 'read' ELSE 'read_write' END
+                FROM generate_series(0, %(shares)s - 1) AS s
+                """,
+                {
+                    "first_user": first_user,
+                    "first_version": first_version,
+                    "users": users,
+                    "versions": versions,
+                    "shares": shares,
+                },
+            )
+
+            cursor.execute(
+                f"""
+                INSERT INTO {access_table} (user_id, file_version_id, level)
+                SELECT user_id, id, 'owner' FROM {version_table} WHERE id >= %s
+                """,
+                [first_version],
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {access_table} (user_id, file_version_id, level)
+                SELECT user_id, file_id, permissions FROM {permission_table} WHERE file_id >= %s
+                """,
+                [first_version],
+            )
+
+            for table in (user_table, version_table, permission_table, access_table):
+                cursor.execute(f"ANALYZE {table}")
+
+        return first_user, first_version
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from propylon_document_manager.file_versions.models import User
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare upload throughput of one POST per file with the bulk upload endpoint. "
+        "Files go to a temporary MEDIA_ROOT and the rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=500)
+        parser.add_argument("--size", type=int, default=16 * 1024, help="Size of every file in bytes")
+        parser.add_argument("--batch", type=int, default=500, help="Files per bulk request")
+
+    def handle(self, *args, **options):
+        with (
+            tempfile.TemporaryDirectory() as media_root,
+            override_settings(MEDIA_ROOT=media_root, ALLOWED_HOSTS=["testserver"]),
+        ):
+            try:
+                with transaction.atomic():
+                    self._run(options["files"], options["size"], options["batch"])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def _run(self, files, size, batch):
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(email="benchmark-upload@example.com"))
+
+        def make_files(prefix):
+            return [SimpleUploadedFile(f"{prefix}-{index}.bin", os.urandom(size)) for index in range(files)]
+
+        uploads = make_files("single")
+        started = time.perf_counter()
+        for upload in uploads:
+            response = client.post(reverse("api:file_versions-list"), {"path": "single", "file": upload})
+            assert response.status_code == 201, response.data
+        single = time.perf_counter() - started
+
+        uploads = make_files("bulk")
+        started = time.perf_counter()
+        for offset in range(0, files, batch):
+            chunk = uploads[offset:][:batch]
+            response = client.post(reverse("api:file_versions-bulk"), {"path": "bulk", "files": chunk})
+            assert response.status_code == 201, response.data
+        bulk = time.perf_counter() - started
+
+        self.stdout.write(f"single: {files / single:.0f} files/s ({single:.2f}s for {files} files)")
+        self.stdout.write(f"  bulk: {files / bulk:.0f} files/s ({bulk:.2f}s in batches of {batch})")
+        self.stdout.write(self.style.SUCCESS(f"Speed-up: {single / bulk:.1f}x"))
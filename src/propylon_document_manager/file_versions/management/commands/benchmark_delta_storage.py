@@ -0,0 +1,119 @@
+import os
+import statistics
+import tempfile
+import time
+from random import Random
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from propylon_document_manager.file_versions.delta import revision_cache
+from propylon_document_manager.file_versions.models import Blob, FileVersion, User
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Store a chain of document revisions with and without delta storage, then report the "
+        "bytes on disk and how long it takes to rebuild every revision with a cold cache. "
+        "Files go to a temporary MEDIA_ROOT and the rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--revisions", type=int, default=50)
+        parser.add_argument("--paragraphs", type=int, default=10_000, help="Paragraphs in the first revision")
+        parser.add_argument("--edits", type=int, default=5, help="Paragraphs changed per revision")
+        parser.add_argument("--snapshot-interval", type=int, default=16)
+
+    def handle(self, *args, **options):
+        contents = self._revisions(options["revisions"], options["paragraphs"], options["edits"])
+        self.stdout.write(
+            f"{len(contents)} revisions of ~{len(contents[0]) / 2**20:.1f}MiB, "
+            f"{options['edits']} paragraphs changed per revision"
+        )
+
+        for delta_storage in (False, True):
+            with (
+                tempfile.TemporaryDirectory() as media_root,
+                override_settings(
+                    MEDIA_ROOT=media_root,
+                    FILE_DELTA_STORAGE=delta_storage,
+                    FILE_DELTA_SNAPSHOT_INTERVAL=options["snapshot_interval"],
+                ),
+            ):
+                try:
+                    with transaction.atomic():
+                        self._run("delta" if delta_storage else "full", contents, media_root)
+                        raise Rollback
+                except Rollback:
+                    pass
+
+    def _revisions(self, revisions, paragraphs, edits):
+        random = Random(0)
+        words = [random.randbytes(random.randint(2, 6)).hex().encode() for _ in range(2000)]
+        document = [
+            b"<p id='%d'>%s</p>\n" % (index, b" ".join(random.choices(words, k=random.randint(5, 40))))
+            for index in range(paragraphs)
+        ]
+
+        contents = [b"".join(document)]
+        for _ in range(revisions - 1):
+            for _ in range(edits):
+                index = random.randrange(len(document))
+                action = random.random()
+                paragraph = b"<p>%s</p>\n" % b" ".join(random.choices(words, k=random.randint(5, 40)))
+                if action < 0.5:
+                    document[index] = paragraph
+                elif action < 0.8:
+                    document.insert(index, paragraph)
+                else:
+                    del document[index]
+            contents.append(b"".join(document))
+        return contents
+
+    def _run(self, label, contents, media_root):
+        user = User.objects.create_user(email=f"benchmark-delta-{label}@example.com")
+
+        timings = []
+        for revision, content in enumerate(contents, start=1):
+            started = time.perf_counter()
+            FileVersion.objects.create(
+                user=user,
+                path="benchmark",
+                file_name="bill.xml",
+                revision=revision,
+                file=SimpleUploadedFile("bill.xml", content),
+            )
+            timings.append((time.perf_counter() - started) * 1000)
+
+        stored = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for directory, _, names in os.walk(media_root)
+            for name in names
+        )
+        logical = sum(len(content) for content in contents)
+        self.stdout.write(
+            f"{label:>5}: {stored / 2**20:.1f}MiB stored for {logical / 2**20:.1f}MiB of revisions "
+            f"({stored / logical:.1%}), median save {statistics.median(timings):.1f}ms"
+        )
+
+        content_hashes = FileVersion.objects.filter(user=user).values_list("content_hash", flat=True)
+        depths = dict(Blob.objects.filter(pk__in=content_hashes).values_list("content_hash", "depth"))
+        timings = {}
+        for content_hash in content_hashes:
+            revision_cache.clear()
+            started = time.perf_counter()
+            with Blob.objects.open(content_hash) as blob_file:
+                blob_file.read()
+            timings[content_hash] = (time.perf_counter() - started) * 1000
+
+        worst = max(timings, key=timings.get)
+        self.stdout.write(
+            f"{'':>5}  cold read: median {statistics.median(timings.values()):.1f}ms, "
+            f"worst {timings[worst]:.1f}ms at delta depth {depths[worst]}"
+        )
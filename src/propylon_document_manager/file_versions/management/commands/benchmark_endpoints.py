@@ -0,0 +1,279 @@
+import json
+import math
+import platform
+import statistics
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+
+import django
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Q
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from propylon_document_manager.file_versions.models import FileAccess, FilePermissions, FileVersion, Folder
+
+from .generate_corpus import corpus_users
+
+ENDPOINTS = ("upload", "list", "download", "share", "cas_lookup")
+# Everything the benchmark writes goes below this folder of the corpus users and is deleted afterwards.
+SCRATCH_PATH = "benchmark-endpoints"
+# Readable versions loaded from the corpus to pick downloads and known hashes from.
+SAMPLE_SIZE = 100_000
+# Settings that change what is measured, recorded with the results.
+RECORDED_SETTINGS = (
+    "FILE_ASYNC_VIEWS",
+    "FILE_CHUNK_STORAGE",
+    "FILE_COMPRESSION",
+    "FILE_DELTA_STORAGE",
+    "FILE_JOBS_EAGER",
+    "FILE_SERVE_MODE",
+    "FILE_VERSION_CACHE",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure throughput, latency percentiles and database queries of the upload, list, "
+        "download, share and CAS lookup endpoints against a corpus made by generate_corpus. "
+        "Requests go through the full middleware and view stack in this process, picked at random "
+        "with a fixed seed so runs are repeatable. Results can be written as JSON and compared "
+        "with an earlier run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prefix", default="corpus", help="Prefix the corpus was generated with")
+        parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+        parser.add_argument("--requests", type=int, default=200, help="Measured requests per endpoint")
+        parser.add_argument("--warmup", type=int, default=20, help="Requests per endpoint before measuring")
+        parser.add_argument("--concurrency", type=int, default=1, help="Client threads sending requests")
+        parser.add_argument("--upload-size", type=int, default=64 * 1024, help="Bytes per uploaded file")
+        parser.add_argument("--cas-batch", type=int, default=100, help="Hashes per CAS lookup, half of them unknown")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+
+    def handle(self, *args, **options):
+        users = {user.pk: user for user in corpus_users(options["prefix"])}
+        if len(users) < 2:
+            raise CommandError(f"No corpus with prefix {options['prefix']!r}, create one with generate_corpus")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        random = Random(options["seed"])
+        results = {
+            "created_at": timezone.now().isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "settings": {name: getattr(settings, name, None) for name in RECORDED_SETTINGS},
+            "options": {
+                name: options[name]
+                for name in ("prefix", "requests", "warmup", "concurrency", "upload_size", "cas_batch", "seed")
+            },
+            "endpoints": {},
+        }
+        try:
+            corpus = self._load_corpus(users)
+            results["corpus"] = corpus["summary"]
+            with override_settings(ALLOWED_HOSTS=["testserver"]):
+                for endpoint in options["endpoints"]:
+                    make_request = getattr(self, f"_{endpoint}_request")
+                    warmup = options["warmup"]
+                    requests = [
+                        make_request(random, corpus, options, number) for number in range(warmup + options["requests"])
+                    ]
+                    _run_requests([requests[:warmup]])
+                    samples, seconds = _run_requests(_split(requests[warmup:], options["concurrency"]))
+                    results["endpoints"][endpoint] = _summarize(samples, seconds)
+                    self._report(endpoint, results["endpoints"][endpoint], baseline)
+        finally:
+            FileVersion.objects.filter(
+                Q(path=SCRATCH_PATH) | Q(path__startswith=f"{SCRATCH_PATH}/"), user__in=users.values()
+            ).delete()
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(results, output, indent=2, default=str)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def _load_corpus(self, users):
+        readable = list(
+            FileAccess.objects.filter(user__in=users.values())
+            .order_by("pk")
+            .values_list("user_id", "file_version__path", "file_version__file_name", "file_version__content_hash")[
+                :SAMPLE_SIZE
+            ]
+        )
+        folders = list(Folder.objects.filter(user__in=users.values()).order_by("pk").values_list("user_id", "path"))
+        if not readable:
+            raise CommandError("The corpus has no documents")
+
+        versions = FileVersion.objects.filter(user__in=users.values())
+        summary = {
+            "users": len(users),
+            "versions": versions.count(),
+            "documents": versions.values("user", "path", "file_name").distinct().count(),
+            "shares": FilePermissions.objects.filter(file__in=versions).count(),
+            "folders": len(folders),
+        }
+        hashes = {}
+        for user_id, _, _, content_hash in readable:
+            hashes.setdefault(user_id, []).append(content_hash)
+        user_ids = sorted(hashes)
+        # A version of its own per user to share, so the corpus shares are left alone.
+        shareable = {
+            user_id: FileVersion.objects.create(
+                user=users[user_id],
+                path=SCRATCH_PATH,
+                file_name="shared.txt",
+                revision=1,
+                file=SimpleUploadedFile("shared.txt", f"shared by {user_id}".encode()),
+            )
+            for user_id in user_ids
+        }
+        return {
+            "users": users,
+            "user_ids": user_ids,
+            "readable": readable,
+            "hashes": hashes,
+            "folders": folders,
+            "shareable": shareable,
+            "summary": summary,
+        }
+
+    def _upload_request(self, random, corpus, options, number):
+        user = corpus["users"][random.choice(corpus["user_ids"])]
+        upload = SimpleUploadedFile(f"upload-{number}.bin", random.randbytes(options["upload_size"]))
+        data = {"path": f"{SCRATCH_PATH}/uploads", "file": upload}
+        return user, "post", reverse("api:file_versions-list"), {"data": data, "format": "multipart"}
+
+    def _list_request(self, random, corpus, options, number):
+        user_id, path = random.choice(corpus["folders"])
+        url = reverse("serve_file", args=[path]) if path else reverse("serve_dir")
+        return corpus["users"][user_id], "get", url, {"data": {"list": ""}}
+
+    def _download_request(self, random, corpus, options, number):
+        user_id, path, file_name, _ = random.choice(corpus["readable"])
+        url = reverse("serve_file", args=[f"{path}/{file_name}" if path else file_name])
+        return corpus["users"][user_id], "get", url, {}
+
+    def _share_request(self, random, corpus, options, number):
+        owner_id = random.choice(corpus["user_ids"])
+        recipient_id = random.choice(sorted(corpus["users"].keys() - {owner_id}))
+        data = {
+            "email": corpus["users"][recipient_id].email,
+            "permission": random.choice([FilePermissions.READ, FilePermissions.READ_WRITE]),
+        }
+        url = reverse("api:file_versions-share", args=[corpus["shareable"][owner_id].pk])
+        return corpus["users"][owner_id], "post", url, {"data": data, "format": "json"}
+
+    def _cas_lookup_request(self, random, corpus, options, number):
+        user_id = random.choice(corpus["user_ids"])
+        known = options["cas_batch"] - options["cas_batch"] // 2
+        hashes = random.choices(corpus["hashes"][user_id], k=known)
+        hashes += [random.randbytes(32).hex() for _ in range(options["cas_batch"] - known)]
+        url = reverse("file_cas_lookup")
+        return corpus["users"][user_id], "post", url, {"data": {"hashes": hashes}, "format": "json"}
+
+    def _report(self, endpoint, result, baseline):
+        latency = result["latency_ms"]
+        line = (
+            f"{endpoint:>10}: {result['throughput']:7.1f} req/s, p50 {latency['p50']:.1f}ms, "
+            f"p90 {latency['p90']:.1f}ms, p99 {latency['p99']:.1f}ms, max {latency['max']:.1f}ms, "
+            f"{result['queries']['mean']:.1f} queries (max {result['queries']['max']}), {result['errors']} errors"
+        )
+        previous = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if previous:
+            line += (
+                f" | baseline p50 {previous['latency_ms']['p50']:.1f}ms "
+                f"({latency['p50'] / previous['latency_ms']['p50'] - 1:+.0%}), "
+                f"{previous['throughput']:.1f} req/s ({result['throughput'] / previous['throughput'] - 1:+.0%})"
+            )
+        self.stdout.write(self.style.ERROR(line) if result["errors"] else line)
+
+
+def _split(requests, concurrency):
+    """Deal the requests out to the client threads in turn."""
+    concurrency = max(1, concurrency)
+    return [requests[index::concurrency] for index in range(concurrency)]
+
+
+def _run_requests(batches):
+    """Send each batch from its own thread; return the samples and the seconds it took."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        samples = [sample for batch in executor.map(_send, batches) for sample in batch]
+    return samples, time.perf_counter() - started
+
+
+def _send(requests):
+    """Send requests with a client and database connection of this thread."""
+    client = APIClient()
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    samples = []
+    try:
+        with connection.execute_wrapper(count_queries):
+            for user, method, url, kwargs in requests:
+                client.force_authenticate(user=user)
+                queries = 0
+                started = time.perf_counter()
+                response = getattr(client, method)(url, **kwargs)
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+                response.close()
+                samples.append((time.perf_counter() - started, queries, response.status_code))
+    finally:
+        connections.close_all()
+    return samples
+
+
+def _summarize(samples, seconds):
+    latencies = sorted(duration * 1000 for duration, _, _ in samples)
+    queries = [count for _, count, _ in samples]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, status in samples if status >= 400),
+        "seconds": seconds,
+        "throughput": len(samples) / seconds,
+        "latency_ms": {
+            "mean": statistics.fmean(latencies),
+            "p50": _percentile(latencies, 0.5),
+            "p90": _percentile(latencies, 0.9),
+            "p99": _percentile(latencies, 0.99),
+            "max": latencies[-1],
+        },
+        "queries": {"mean": statistics.fmean(queries), "max": max(queries)},
+    }
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
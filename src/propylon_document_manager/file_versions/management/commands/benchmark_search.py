@@ -0,0 +1,100 @@
+import io
+import statistics
+import tempfile
+import time
+from random import Random
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from propylon_document_manager.file_versions.api.serializers import BulkFileVersionUploadSerializer
+from propylon_document_manager.file_versions.models import User
+from propylon_document_manager.file_versions.uploads import HashedUploadedFile
+
+TERMS = ["act", "finance", "appropriation", "schedule", "commencement", "levy", "amendment", "repeal"]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Index a generated corpus of legislative documents and report the latency of the search "
+        "endpoint for rare, common and combined terms. Files go to a temporary MEDIA_ROOT and the "
+        "rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", type=int, default=2000)
+        parser.add_argument("--revisions", type=int, default=3, help="Revisions of every document")
+        parser.add_argument("--words", type=int, default=2000, help="Words per document")
+        parser.add_argument("--repeat", type=int, default=20, help="Requests per query")
+
+    def handle(self, *args, **options):
+        with (
+            tempfile.TemporaryDirectory() as media_root,
+            override_settings(MEDIA_ROOT=media_root, ALLOWED_HOSTS=["testserver"], FILE_JOBS_EAGER=True),
+        ):
+            try:
+                with transaction.atomic():
+                    self._run(options)
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def _run(self, options):
+        user = User.objects.create_user(email="benchmark-search@example.com")
+        random = Random(0)
+        vocabulary = [random.randbytes(random.randint(2, 5)).hex() for _ in range(20_000)]
+        # Zipf-like word frequencies, with the query terms from very common to rare.
+        weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+        term_rates = dict(zip(TERMS, [0.9, 0.5, 0.01, 0.3, 0.05, 0.1, 0.2, 0.02]))
+
+        started = time.perf_counter()
+        for first in range(0, options["documents"], 200):
+            entries = []
+            for number in range(first, min(first + 200, options["documents"])):
+                path = f"title-{number % 50}/part-{number % 7}"
+                words = random.choices(vocabulary, weights, k=options["words"])
+                for revision in range(options["revisions"]):
+                    words[random.randrange(len(words))] = random.choice(vocabulary)
+                    terms = [term for term, rate in term_rates.items() if random.random() < rate]
+                    content = " ".join(words + terms).encode()
+                    upload = HashedUploadedFile.from_stream(io.BytesIO(content), f"document-{number}.txt")
+                    entries.append({"path": path, "file_name": upload.name, "upload": upload})
+            try:
+                BulkFileVersionUploadSerializer.create_versions(user, entries)
+            finally:
+                for entry in entries:
+                    entry["upload"].close()
+        versions = options["documents"] * options["revisions"]
+        self.stdout.write(f"Indexed {versions} versions in {time.perf_counter() - started:.1f}s")
+        # Autovacuum would have analyzed the new rows by now in a real deployment.
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        client = APIClient()
+        client.force_authenticate(user=user)
+        url = reverse("search")
+        queries = [
+            {"q": "appropriation"},
+            {"q": "finance"},
+            {"q": "finance levy -repeal"},
+            {"q": '"finance" schedule', "path": "title-3"},
+            {"q": "commencement", "all_revisions": "true"},
+        ]
+        for params in queries:
+            timings = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                response = client.get(url, params)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f"{params}: {len(response.data['results'])} results, median {statistics.median(timings):.1f}ms, "
+                f"p95 {timings[int(len(timings) * 0.95) - 1]:.1f}ms"
+            )
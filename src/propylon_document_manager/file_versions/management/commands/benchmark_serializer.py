@@ -0,0 +1,92 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.urls import reverse
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from propylon_document_manager.file_versions.api.serializers import FileVersionSerializer
+from propylon_document_manager.file_versions.models import FileVersion, User
+
+
+class Rollback(Exception):
+    pass
+
+
+class PerRowFileVersionSerializer(serializers.ModelSerializer):
+    """
+    The list output before FileVersionListSerializer: every row goes through the
+    ModelSerializer fields and resolves its own URL with reverse() and build_absolute_uri().
+    """
+
+    class Meta:
+        model = FileVersion
+        fields = "__all__"
+
+    def to_representation(self, instance):
+        ret = super().to_representation(instance)
+
+        folder_path = f"{instance.path}/" if instance.path else ""
+        file_path = f"{folder_path}{instance.file_name}?revision={instance.revision}"
+        ret["file"] = self.context["request"].build_absolute_uri(
+            reverse("serve_file", kwargs={"file_path": file_path})
+        )
+        return ret
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-row ModelSerializer output with the FileVersionSerializer list path. "
+        "The rows are created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options["rows"], options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _run(self, rows, repeat):
+        user = User.objects.create_user(email="benchmark-serializer@example.com")
+        FileVersion.objects.bulk_create(
+            [
+                FileVersion(
+                    user=user,
+                    file="blobs/benchmark",
+                    file_name=f"document-{index}.xml",
+                    path=f"benchmark/folder-{index % 100}",
+                    revision=1,
+                    content_hash=f"{index:064x}",
+                )
+                for index in range(rows)
+            ],
+            batch_size=1000,
+        )
+        instances = list(FileVersion.objects.filter(user=user))
+        request = Request(APIRequestFactory().get(reverse("api:file_versions-list"), HTTP_HOST="localhost"))
+        context = {"request": request}
+
+        candidates = {
+            "per-row": lambda: PerRowFileVersionSerializer(instances, many=True, context=context).data,
+            "list path": lambda: FileVersionSerializer(instances, many=True, context=context).data,
+        }
+        results = {}
+        for name, serialize in candidates.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                serialize()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = statistics.median(timings)
+            self.stdout.write(f"{name:>10}: median {results[name]:.1f}ms for {rows} rows")
+
+        self.stdout.write(self.style.SUCCESS(f"Speed-up: {results['per-row'] / results['list path']:.1f}x"))
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import socket
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+
+from propylon_document_manager.file_versions.models import FileVersion, User
+
+EMAIL = "benchmark-slow-clients@example.com"
+# Small receive buffers, so the server can not hand a whole download to the kernel
+# and has to keep writing for as long as the client reads.
+RECEIVE_BUFFER = 16 * 1024
+READ_SIZE = 16 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running server with many slow downloads at once, e.g. gunicorn (WSGI) "
+        "against uvicorn (ASGI) on the same database. Reports how many downloads started "
+        "streaming and the latency of small requests made meanwhile. A benchmark user and "
+        "file are created for the run and deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="Base URL of the server, e.g. http://127.0.0.1:8000")
+        parser.add_argument("--clients", type=int, default=1000, help="Concurrent slow downloads")
+        parser.add_argument("--rate", type=int, default=64 * 1024, help="Bytes per second read by each client")
+        parser.add_argument("--duration", type=float, default=20.0, help="Seconds to keep the clients reading")
+        parser.add_argument("--size", type=int, default=16 * 1024 * 1024, help="Size of the downloaded file")
+        parser.add_argument("--ramp", type=float, default=5.0, help="Seconds over which the clients connect")
+
+    def handle(self, *args, **options):
+        self._clean_up()  # After a run that was killed.
+        user = User.objects.create_user(email=EMAIL)
+        try:
+            token = Token.objects.create(user=user)
+            FileVersion.objects.create(
+                user=user,
+                path="benchmark",
+                file_name="large.bin",
+                revision=1,
+                file=SimpleUploadedFile("large.bin", os.urandom(options["size"])),
+            )
+            asyncio.run(self._run(options, token.key))
+        finally:
+            self._clean_up()
+
+    def _clean_up(self):
+        FileVersion.objects.filter(user__email=EMAIL).delete()
+        User.objects.filter(email=EMAIL).delete()
+
+    async def _run(self, options, token):
+        url = urlsplit(options["url"])
+        address = (url.hostname, url.port or 80)
+        request = (
+            f"GET {url.path.rstrip('/')}/api/dir/benchmark/large.bin HTTP/1.1\r\n"
+            f"Host: {url.netloc}\r\nAuthorization: Token {token}\r\nConnection: close\r\n"
+        )
+        deadline = time.monotonic() + options["duration"]
+        clients = options["clients"]
+        self.stdout.write(
+            f"{clients} clients reading {options['size'] / 2**20:.0f}MiB at "
+            f"{options['rate'] / 1024:.0f}KiB/s each for {options['duration']:.0f}s, "
+            f"connecting over {options['ramp']:.0f}s"
+        )
+
+        probe = asyncio.create_task(self._probe(address, request + "Range: bytes=0-1023\r\n\r\n", deadline))
+        results = await asyncio.gather(
+            *(
+                self._download(address, request + "\r\n", options["rate"], deadline, options["ramp"] * index / clients)
+                for index in range(clients)
+            )
+        )
+        latencies, failed_probes = await probe
+
+        started = sorted(first_byte for first_byte, _ in results if first_byte is not None)
+        received = sum(size for _, size in results)
+        summary = f"  streaming: {len(started)}/{len(results)} downloads started"
+        if started:
+            summary += f", time to first byte median {_ms(statistics.median(started))}, max {_ms(started[-1])}"
+        self.stdout.write(summary)
+        self.stdout.write(
+            f"  received:  {received / 2**20:.0f}MiB, {received / options['duration'] / 2**20:.1f}MiB/s in total"
+        )
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f"  probes:    {len(latencies)} answered, median {_ms(statistics.median(latencies))}, "
+                f"p99 {_ms(latencies[int(len(latencies) * 0.99)])}, {failed_probes} failed or timed out"
+            )
+        else:
+            self.stdout.write(f"  probes:    none answered, {failed_probes} failed or timed out")
+
+    async def _download(self, address, request, rate, deadline, delay):
+        """Download slowly until the deadline; return (time to first byte, bytes read)."""
+        first_byte, received = None, 0
+        await asyncio.sleep(delay)
+        started = time.monotonic()
+        try:
+            reader, writer = await _connect(address)
+        except OSError:
+            return first_byte, received
+        try:
+            writer.write(request.encode())
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), deadline - time.monotonic())
+            first_byte = time.monotonic() - started
+            while time.monotonic() < deadline:
+                data = await asyncio.wait_for(reader.read(READ_SIZE), deadline - time.monotonic())
+                if not data:
+                    break
+                received += len(data)
+                await asyncio.sleep(len(data) / rate)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+        return first_byte, received
+
+    async def _probe(self, address, request, deadline, interval=0.25, timeout=5.0):
+        """Make a small ranged request every ``interval`` seconds while the downloads run."""
+        latencies, failed = [], 0
+        await asyncio.sleep(interval)
+        while time.monotonic() + timeout < deadline:
+            started = time.monotonic()
+            try:
+                reader, writer = await asyncio.wait_for(_connect(address), timeout)
+                try:
+                    writer.write(request.encode())
+                    response = await asyncio.wait_for(reader.read(), timeout)
+                finally:
+                    writer.close()
+                if response.startswith(b"HTTP/1.1 206"):
+                    latencies.append(time.monotonic() - started)
+                else:
+                    failed += 1
+            except (OSError, asyncio.TimeoutError):
+                failed += 1
+            await asyncio.sleep(interval)
+        return latencies, failed
+
+
+async def _connect(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Set before connecting, as the TCP window scale is agreed on in the handshake.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return await asyncio.open_connection(sock=sock)
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}ms"
@@ -0,0 +1,56 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, Sum
+
+from propylon_document_manager.file_versions.models import Blob, Chunk, FileVersion
+from propylon_document_manager.file_versions.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Report how much storage whole-file and chunk deduplication save: the bytes of all "
+        "versions, of the distinct blobs they use and of the distinct chunks chunked blobs use."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--disk", action="store_true", help="Also measure the chunk files on disk")
+
+    def handle(self, *args, **options):
+        blob_size = Blob.objects.filter(pk=OuterRef("content_hash")).values("size")
+        logical = FileVersion.objects.annotate(blob_size=Subquery(blob_size)).aggregate(
+            count=Count("pk"), size=Sum("blob_size", default=0)
+        )
+        blobs = Blob.objects.aggregate(count=Count("pk"), size=Sum("size", default=0))
+        chunked = Blob.objects.filter(chunked=True).aggregate(count=Count("pk"), size=Sum("size", default=0))
+        chunks = Chunk.objects.aggregate(count=Count("pk"), size=Sum("size", default=0))
+
+        self.stdout.write(f"{logical['count']} versions, {_mib(logical['size'])} in total")
+        self.stdout.write(
+            f"{blobs['count']} distinct blobs, {_mib(blobs['size'])}: "
+            f"whole-file dedup ratio {_ratio(logical['size'], blobs['size'])}"
+        )
+        self.stdout.write(
+            f"{chunked['count']} chunked blobs, {_mib(chunked['size'])} in {chunks['count']} distinct chunks, "
+            f"{_mib(chunks['size'])}: chunk dedup ratio {_ratio(chunked['size'], chunks['size'])}"
+        )
+        stored = blobs["size"] - chunked["size"] + chunks["size"]
+        self.stdout.write(
+            f"{_mib(stored)} before compression and deltas: overall dedup ratio {_ratio(logical['size'], stored)}"
+        )
+
+        if options["disk"]:
+            on_disk = sum(
+                os.path.getsize(os.path.join(directory, name))
+                for directory, _, names in os.walk(blob_storage.path("chunks"))
+                for name in names
+            )
+            self.stdout.write(f"{_mib(on_disk)} of chunk files on disk")
+
+
+def _mib(size):
+    return f"{size / 2**20:.1f}MiB"
+
+
+def _ratio(logical, stored):
+    return f"{logical / stored:.2f}x" if stored else "n/a"
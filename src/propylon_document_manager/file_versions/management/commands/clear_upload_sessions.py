@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from propylon_document_manager.file_versions.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete resumable upload sessions that received no part for FILE_UPLOAD_SESSION_TIMEOUT "
+        "seconds, together with their partially written files. Meant to run periodically."
+    )
+
+    def handle(self, *args, **options):
+        # Parts being written hold a share lock on their session, so they finish first.
+        deleted = UploadSession.objects.expired().delete()[1].get(UploadSession._meta.label, 0)
+        self.stdout.write(f"Deleted {deleted} expired upload sessions")
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Min, OuterRef, Subquery
+
+from propylon_document_manager.file_versions.models import FilePermissions, FileVersion, Grant
+
+
+class Command(BaseCommand):
+    help = (
+        "Replace the per-version shares of documents shared with a user in every revision by "
+        "one document grant each, which also covers the revisions uploaded later. A document "
+        "with revisions shared at different levels gets a read grant and keeps its read/write "
+        "shares."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only count the documents that would be granted")
+
+    def handle(self, *args, **options):
+        revisions = (
+            FileVersion.objects.filter(
+                user=OuterRef("file__user"), path=OuterRef("file__path"), file_name=OuterRef("file__file_name")
+            )
+            .order_by()
+            .values("user")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        documents = (
+            FilePermissions.objects.exclude(user=F("file__user"))
+            .values("file__user", "user", "file__path", "file__file_name")
+            .annotate(shared=Count("file", distinct=True), level=Min("permissions"), revisions=Subquery(revisions))
+            .filter(shared=F("revisions"))
+            .order_by("file__user", "user", "file__path", "file__file_name")
+        )
+
+        shares_before = FilePermissions.objects.count()
+        granted = 0
+        for document in documents.iterator():
+            if options["dry_run"]:
+                granted += 1
+                continue
+            with transaction.atomic():
+                # Saving the grant deletes the shares it makes redundant.
+                _, created = Grant.objects.get_or_create(
+                    owner_id=document["file__user"],
+                    user_id=document["user"],
+                    path=document["file__path"],
+                    file_name=document["file__file_name"],
+                    defaults={"level": document["level"]},
+                )
+            granted += created
+
+        if options["dry_run"]:
+            self.stdout.write(f"{granted} documents are shared in every revision")
+            return
+        removed = shares_before - FilePermissions.objects.count()
+        self.stdout.write(f"Replaced {removed} shares with {granted} document grants")
@@ -0,0 +1,146 @@
+import io
+import math
+import time
+from itertools import accumulate, groupby
+from random import Random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from propylon_document_manager.file_versions.api.serializers import BulkFileVersionUploadSerializer
+from propylon_document_manager.file_versions.models import FilePermissions, FileVersion, User
+from propylon_document_manager.file_versions.uploads import HashedUploadedFile
+
+FOLDERS = ["acts", "bills", "amendments", "statutes", "regulations", "orders", "schedules", "reports", "drafts"]
+VOCABULARY_SIZE = 20_000
+# Documents passed to create_versions() at once, with all their revisions.
+BATCH_SIZE = 100
+
+
+def corpus_users(prefix):
+    return User.objects.filter(email__startswith=f"{prefix}-user-", email__endswith="@example.com")
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic corpus for benchmark_endpoints: users owning documents under deep "
+        "folder trees, chains of revisions that each edit the previous one, log-normal file sizes "
+        "and a share graph where a few users own and receive most documents. The same seed gives "
+        "the same corpus. It is committed; remove it with --delete."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prefix", default="corpus", help="Users are <prefix>-user-<n>@example.com")
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--documents", type=int, default=2000)
+        parser.add_argument("--revisions", type=float, default=3.0, help="Mean revisions per document")
+        parser.add_argument("--max-depth", type=int, default=6, help="Deepest folder level")
+        parser.add_argument("--branching", type=int, default=4, help="Subfolders per folder")
+        parser.add_argument("--median-size", type=int, default=32 * 1024, help="Median file size in bytes")
+        parser.add_argument("--size-sigma", type=float, default=1.5, help="Spread of the log-normal sizes")
+        parser.add_argument("--max-size", type=int, default=8 * 1024 * 1024)
+        parser.add_argument("--text-ratio", type=float, default=0.7, help="Share of text rather than binary files")
+        parser.add_argument("--shares", type=float, default=1.0, help="Mean users each document is shared with")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--delete", action="store_true", help="Delete the corpus with this prefix and exit")
+
+    def handle(self, *args, **options):
+        users = corpus_users(options["prefix"])
+        if options["delete"]:
+            # Versions first: their delete signals release the blobs and folder counts.
+            _, deleted = FileVersion.objects.filter(user__in=users).delete()
+            versions = deleted.get(FileVersion._meta.label, 0)
+            self.stdout.write(f"Deleted {users.delete()[1].get(User._meta.label, 0)} users and {versions} versions")
+            return
+        if users.exists():
+            raise CommandError(f"A corpus with prefix {options['prefix']!r} exists already, remove it with --delete")
+        if options["users"] < 1 or options["documents"] < 1:
+            raise CommandError("--users and --documents must be at least 1")
+
+        random = Random(options["seed"])
+        started = time.perf_counter()
+        vocabulary = [random.randbytes(random.randint(2, 5)).hex() for _ in range(VOCABULARY_SIZE)]
+        # Zipf-like word frequencies, as in natural language.
+        self._words = vocabulary, list(accumulate(1 / rank for rank in range(1, VOCABULARY_SIZE + 1)))
+        users = [
+            User.objects.create_user(email=f"{options['prefix']}-user-{number}@example.com")
+            for number in range(options["users"])
+        ]
+        # Zipf-like: a few users own most documents, and a different few receive most shares.
+        owner_weights = [1 / (rank + 1) ** 0.8 for rank in range(len(users))]
+        recipient_weights = random.sample(owner_weights, len(owner_weights))
+        owners = sorted(random.choices(range(len(users)), owner_weights, k=options["documents"]))
+
+        versions = total_size = 0
+        latest = []
+        for owner, numbers in groupby(range(len(owners)), key=owners.__getitem__):
+            numbers = list(numbers)
+            for first in range(0, len(numbers), BATCH_SIZE):
+                last = first + BATCH_SIZE
+                documents = [self._document(random, options, number) for number in numbers[first:last]]
+                entries = [entry for document in documents for entry in document]
+                try:
+                    created = BulkFileVersionUploadSerializer.create_versions(users[owner], entries)
+                finally:
+                    for entry in entries:
+                        entry["upload"].close()
+                versions += len(entries)
+                total_size += sum(entry["upload"].size for entry in entries)
+                latest.extend(created[id(document[-1])] for document in documents)
+
+        shares = 0
+        for file_version in latest:
+            count = round(random.expovariate(1 / options["shares"])) if options["shares"] > 0 else 0
+            recipients = {
+                users[index].pk
+                for index in random.choices(range(len(users)), recipient_weights, k=count)
+                if users[index].pk != file_version.user_id
+            }
+            for recipient in sorted(recipients):
+                FilePermissions.objects.create(
+                    user_id=recipient,
+                    file=file_version,
+                    owner_id=file_version.user_id,
+                    permissions=FilePermissions.READ if random.random() < 0.8 else FilePermissions.READ_WRITE,
+                )
+                shares += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated {len(users)} users, {options['documents']} documents with {versions} versions "
+                f"({total_size / 2**20:.1f}MiB) and {shares} shares in {time.perf_counter() - started:.1f}s"
+            )
+        )
+
+    def _document(self, random, options, number):
+        """The entries of every revision of one document, oldest first."""
+        depth = random.randint(1, options["max_depth"])
+        branches = FOLDERS[: max(1, options["branching"])]
+        path = "/".join(f"{random.choice(branches)}-{level}" for level in range(depth))
+        text = random.random() < options["text_ratio"]
+        file_name = f"document-{number}.{'txt' if text else 'pdf'}"
+        size = random.lognormvariate(math.log(options["median_size"]), options["size_sigma"])
+        content = self._content(random, min(options["max_size"], max(1, int(size))), text)
+
+        # Geometric, so most documents have few revisions and some have long chains.
+        revisions = 1
+        while random.random() > 1 / max(1.0, options["revisions"]):
+            revisions += 1
+        entries = []
+        for _ in range(revisions):
+            upload = HashedUploadedFile.from_stream(io.BytesIO(content), file_name)
+            entries.append({"path": path, "file_name": file_name, "upload": upload})
+            content = self._revise(random, content, text)
+        return entries
+
+    def _content(self, random, size, text):
+        if not text:
+            return random.randbytes(size)
+        vocabulary, cum_weights = self._words
+        return " ".join(random.choices(vocabulary, cum_weights=cum_weights, k=size // 6 + 1)).encode()[:size]
+
+    def _revise(self, random, content, text):
+        """Replace a stretch of up to 2% of the content, as an edit of a document would."""
+        span = max(1, len(content) // 50)
+        start = random.randrange(len(content) + 1)
+        end = min(len(content), start + random.randint(0, span))
+        return content[:start] + self._content(random, random.randint(1, span), text) + content[end:]
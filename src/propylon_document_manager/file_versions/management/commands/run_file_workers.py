@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import signal
+import socket
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from propylon_document_manager.file_versions.jobs import run_pending
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background jobs queued by uploads: packing, verification and text extraction "
+        "of new blobs. Any number of these commands can run against the same database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes to start")
+        parser.add_argument("--batch-size", type=int, default=10, help="Jobs claimed per query")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        stop = multiprocessing.get_context("fork").Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+
+        arguments = (stop, options["batch_size"], options["poll_interval"], options["burst"])
+        if options["processes"] == 1:
+            self.work(*arguments)
+            return
+
+        # Children must open their own database connections.
+        connections.close_all()
+        workers = [
+            multiprocessing.get_context("fork").Process(target=self.work, args=arguments)
+            for _ in range(options["processes"])
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, stop, batch_size, poll_interval, burst):
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        processed = 0
+        while not stop.is_set():
+            claimed = run_pending(name, batch_size)
+            processed += claimed
+            if not claimed:
+                if burst:
+                    break
+                stop.wait(poll_interval)
+        connections.close_all()
+        self.stdout.write(f"Worker {name} ran {processed} jobs")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from propylon_document_manager.file_versions.jobs import extract_blob_texts
+from propylon_document_manager.file_versions.models import Blob
+from propylon_document_manager.file_versions.search import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = (
+        "Extract the text of blobs stored before text extraction existed and compute missing "
+        "search vectors. Uploads keep the index up to date on their own afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200)
+        parser.add_argument(
+            "--rebuild", action="store_true", help="Recompute every search vector after changing FILE_SEARCH_CONFIG"
+        )
+
+    def handle(self, *args, **options):
+        # Binary blobs never get a text row, so they are read again on every run.
+        pending = Blob.objects.filter(text__isnull=True).order_by("pk").values_list("pk", flat=True)
+        after = ""
+        extracted = 0
+        while batch := list(pending.filter(pk__gt=after)[: options["batch_size"]]):
+            extract_blob_texts(batch)
+            extracted += len(batch)
+            after = batch[-1]
+        self.stdout.write(f"Extracted text of {extracted} blobs")
+
+        indexed = update_search_vectors(rebuild=options["rebuild"])
+        self.stdout.write(f"Indexed {indexed} texts")
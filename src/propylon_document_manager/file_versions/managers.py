@@ -1,6 +1,25 @@
+import hashlib
+import os
+import tempfile
+from collections import Counter
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
+from django.core.files.base import ContentFile
+from django.db import connections, models, transaction
+from django.db.models import Case, F, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .chunking import iter_chunks
+from .compression import CODEC_CHOICES, compress_bytes, compress_stream, is_compressible
+from .delta import apply_delta, encode_delta, revision_cache
+from .metrics import metrics
+from .storage import blob_path, blob_storage, chunk_path, delta_path
+
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -11,3 +30,752 @@ class UserManager(BaseUserManager):
         user.set_password(password)
         user.save(using=self._db)
         return user
+
+
+def grant_q(owner_id, path, file_name):
+    """Filter for the versions a grant covers: a whole document, or everything below a folder."""
+    if file_name:
+        return Q(user_id=owner_id, path=path, file_name=file_name)
+    if not path:
+        return Q(user_id=owner_id)
+    return Q(user_id=owner_id) & (Q(path=path) | Q(path__startswith=f"{path}/"))
+
+
+def grant_covers(grant_path, grant_file_name, path, file_name):
+    """Whether a grant of the version's owner covers the version at ``path/file_name``."""
+    if grant_file_name:
+        return grant_path == path and grant_file_name == file_name
+    return not grant_path or path == grant_path or path.startswith(f"{grant_path}/")
+
+
+class FileVersionQuerySet(models.QuerySet):
+    def accessible_by(self, user, grants=None):
+        """
+        Versions the user owns, that were shared with them one by one, or that one of
+        their grants covers. The user's level ("owner", "read" or "read_write") is
+        annotated as access_level.
+
+        FileAccess holds at most one row per (user, version), so without grants this is
+        a single indexed join with no DISTINCT. Grants are matched by owner and path
+        prefix on the versions table, through the (user, path) index, and their matches
+        are added to the FileAccess rows in a UNION that Postgres hashes for a semi-join.
+
+        ``grants`` are the user's grants as returned by cache.get_grants(), which is
+        called when they are not given; async code has to pass them.
+        """
+        if grants is None:
+            from .cache import get_grants
+
+            grants = get_grants(user)
+        if not grants:
+            return self.filter(access__user=user).annotate(access_level=F("access__level"))
+
+        from .models import FileAccess, FilePermissions
+
+        granted, writable = Q(), Q()
+        for owner_id, path, file_name, level in grants:
+            covered = grant_q(owner_id, path, file_name)
+            granted |= covered
+            if level == FilePermissions.READ_WRITE:
+                writable |= covered
+        shared = FileAccess.objects.filter(user=user)
+        ids = shared.values("file_version_id").union(
+            self.model.objects.filter(granted).order_by().values("id"), all=True
+        )
+
+        levels = [When(user=user, then=Value(FileAccess.OWNER))]
+        if writable:
+            levels.append(When(writable, then=Value(FilePermissions.READ_WRITE)))
+        # Versions reached only through read grants have no FileAccess row.
+        shared_level = Subquery(shared.filter(file_version=OuterRef("pk")).values("level")[:1])
+        return self.filter(pk__in=ids).annotate(
+            access_level=Case(*levels, default=Coalesce(shared_level, Value(FilePermissions.READ)))
+        )
+
+
+class BlobManager(models.Manager):
+    def acquire(self, content_hash, size=0):
+        """
+        Take a reference on the blob with the given hash, creating its row if needed,
+        and return (blob, created). The row stays locked until the surrounding
+        transaction commits, so the blob can not be released and removed from storage
+        while it is being written.
+        """
+        with transaction.atomic(using=self.db):
+            blob, created = self.select_for_update().get_or_create(
+                content_hash=content_hash,
+                defaults={"size": size, "ref_count": 1},
+            )
+            if not created:
+                self.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+        return blob, created
+
+    def acquire_many(self, blobs):
+        """
+        Take references on many blobs with a single upsert. ``blobs`` maps content
+        hashes to (size, number of references). Returns the set of hashes whose rows
+        were created. Like acquire(), the rows stay locked until the surrounding
+        transaction commits.
+        """
+        defaults = {"depth": "0", "codec": "''", "chunked": "false", "created_at": "now()"}
+        return _acquire_references(self, blobs, defaults)
+
+    def release(self, content_hash):
+        """
+        Drop a reference on the blob with the given hash. The row is deleted once the
+        last reference is gone, and its stored files after the transaction commits.
+        """
+        from .models import Chunk
+
+        with transaction.atomic(using=self.db):
+            blob = self.select_for_update().filter(content_hash=content_hash).first()
+            if blob is None:
+                return
+
+            if blob.ref_count > 1:
+                self.filter(pk=blob.pk).update(ref_count=F("ref_count") - 1)
+                return
+
+            released_chunks = Chunk.objects.release_blob(content_hash) if blob.chunked else []
+            blob.delete()
+            Chunk.objects.delete_unused(released_chunks)
+            # A pack job that was rolled back may have left a compressed file behind.
+            names = [blob_path(content_hash), *(blob_path(content_hash, codec) for codec, _ in CODEC_CHOICES)]
+            if blob.base_id is not None:
+                names.append(delta_path(content_hash))
+                self.release(blob.base_id)
+            # A rollback brings the row back, so its files may only go once it is committed.
+            transaction.on_commit(partial(_delete_stored, self.model, content_hash, names), using=self.db)
+
+    def store_delta(self, blob, upload, base_hash):
+        """
+        Write a freshly acquired blob as a delta against the blob ``base_hash``.
+
+        Nothing is stored and False is returned when the base would put the delta
+        FILE_DELTA_SNAPSHOT_INTERVAL or more steps from a full snapshot, or when the
+        delta is not smaller than FILE_DELTA_MAX_RATIO of the content. The caller must
+        then store the content in full.
+        """
+        with transaction.atomic(using=self.db):
+            base = self.select_for_update().filter(content_hash=base_hash).first()
+            if base is None or base.depth + 1 >= settings.FILE_DELTA_SNAPSHOT_INTERVAL:
+                return False
+
+            upload.seek(0)
+            content = upload.read()
+            delta = encode_delta(
+                self.read(base_hash), content, max_size=int(len(content) * settings.FILE_DELTA_MAX_RATIO)
+            )
+            if delta is None:
+                return False
+
+            blob_storage.save(delta_path(blob.content_hash), ContentFile(delta))
+            self.filter(pk=blob.pk).update(base=base, depth=base.depth + 1)
+            self.filter(pk=base.pk).update(ref_count=F("ref_count") + 1)
+        blob.base, blob.depth = base, base.depth + 1
+        revision_cache.set(blob.content_hash, content)
+        return True
+
+    def store_compressed(self, content_hash, upload):
+        """
+        Write the content of a freshly acquired blob compressed with FILE_COMPRESSION.
+
+        Nothing is stored and False is returned when the content looks compressed
+        already or does not shrink below FILE_COMPRESSION_MAX_RATIO of its size. The
+        caller must then store the content as it is.
+
+        The compressed file is written under its own name, so a raw file that readers
+        may still be using stays in place until the caller deletes it after commit.
+        """
+        codec = settings.FILE_COMPRESSION
+        upload.seek(0)
+        if not is_compressible(upload.read(16)):
+            return False
+
+        upload.seek(0)
+        fd, temporary_path = tempfile.mkstemp(dir=blob_storage.temporary_directory(), prefix=".compress-")
+        try:
+            with os.fdopen(fd, "wb") as compressed:
+                compress_stream(upload, compressed, codec)
+                compressed_size = compressed.tell()
+            metrics.increment("storage_written_bytes_total", compressed_size)
+            if compressed_size > upload.size * settings.FILE_COMPRESSION_MAX_RATIO:
+                return False
+            blob_storage.move_into_place(temporary_path, blob_path(content_hash, codec))
+        finally:
+            if os.path.exists(temporary_path):
+                os.unlink(temporary_path)
+
+        self.filter(pk=content_hash).update(codec=codec)
+        return True
+
+    def store_chunked(self, content_hash, upload):
+        """
+        Write the content of a freshly acquired blob as content-defined chunks of about
+        FILE_CHUNK_AVG_SIZE bytes, each stored once however many blobs contain it.
+        Chunks are compressed with FILE_COMPRESSION when that makes them smaller.
+
+        The content is cut and hashed in a first pass; only the chunks that were not
+        stored yet are then read again and written. Nothing is stored and False is
+        returned for content smaller than one average chunk.
+        """
+        from .models import BlobChunk, Chunk
+
+        average_size = settings.FILE_CHUNK_AVG_SIZE
+        if upload.size < average_size:
+            return False
+
+        upload.seek(0)
+        manifest = []
+        offset = 0
+        for data in iter_chunks(upload, average_size):
+            manifest.append((hashlib.sha256(data).hexdigest(), offset, len(data)))
+            offset += len(data)
+
+        references = Counter(chunk_hash for chunk_hash, _, _ in manifest)
+        sizes = {chunk_hash: size for chunk_hash, _, size in manifest}
+        new_chunks = Chunk.objects.acquire_many(
+            {chunk_hash: (sizes[chunk_hash], count) for chunk_hash, count in references.items()}
+        )
+
+        codec = settings.FILE_COMPRESSION
+        compressed_chunks = []
+        for chunk_hash, offset, size in manifest:
+            if chunk_hash not in new_chunks:
+                continue
+            new_chunks.discard(chunk_hash)
+            upload.seek(offset)
+            data = upload.read(size)
+            if codec and is_compressible(data[:16]):
+                compressed = compress_bytes(data, codec)
+                if len(compressed) <= size * settings.FILE_COMPRESSION_MAX_RATIO:
+                    data = compressed
+                    compressed_chunks.append(chunk_hash)
+            blob_storage.save(chunk_path(chunk_hash), ContentFile(data))
+
+        if compressed_chunks:
+            Chunk.objects.filter(pk__in=compressed_chunks).update(codec=codec)
+        BlobChunk.objects.bulk_create(
+            (
+                BlobChunk(blob_id=content_hash, position=position, offset=offset, chunk_id=chunk_hash)
+                for position, (chunk_hash, offset, _) in enumerate(manifest)
+            ),
+            batch_size=1000,
+        )
+        self.filter(pk=content_hash).update(chunked=True)
+        return True
+
+    def open(self, content_hash):
+        """Open the original content of a blob for reading."""
+        return self.get(content_hash=content_hash).open()
+
+    def read(self, content_hash):
+        """
+        Return the full content of a blob, applying the chain of deltas from the
+        nearest full snapshot or cached ancestor. Rebuilt contents are kept in an LRU
+        cache, so reading consecutive revisions only applies one delta each.
+        """
+        content = revision_cache.get(content_hash)
+        if content is not None:
+            return content
+
+        chain = []
+        blob = self.get(content_hash=content_hash)
+        while blob.base_id is not None:
+            chain.append(blob.content_hash)
+            content = revision_cache.get(blob.base_id)
+            if content is not None:
+                break
+            blob = self.get(content_hash=blob.base_id)
+        else:
+            with blob.open() as blob_file:
+                content = blob_file.read()
+
+        for delta_hash in reversed(chain):
+            with blob_storage.open(delta_path(delta_hash), "rb") as delta_file:
+                content = apply_delta(content, delta_file.read())
+            revision_cache.set(delta_hash, content)
+        return content
+
+
+class ChunkManager(models.Manager):
+    def acquire_many(self, chunks):
+        """
+        Take references on many chunks with a single upsert, like
+        BlobManager.acquire_many(). Returns the set of hashes whose rows were created.
+        """
+        return _acquire_references(self, chunks, {"codec": "''"})
+
+    def release_blob(self, content_hash):
+        """
+        Drop the references the manifest of a chunked blob holds and return the hashes
+        of the chunks no longer used. The chunks are locked in hash order, the order
+        acquire_many() takes them in, so concurrent uploads and releases can not
+        deadlock.
+        """
+        from .models import BlobChunk
+
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        manifest_table = connection.ops.quote_name(BlobChunk._meta.db_table)
+        sql = f"""
+            WITH released AS (
+                SELECT chunk_id, COUNT(*) AS count FROM {manifest_table} WHERE blob_id = %s GROUP BY chunk_id
+            ), locked AS (
+                SELECT chunk.content_hash FROM {table} AS chunk JOIN released ON released.chunk_id = chunk.content_hash
+                ORDER BY chunk.content_hash FOR UPDATE OF chunk
+            )
+            UPDATE {table} AS chunk SET ref_count = chunk.ref_count - released.count
+            FROM released JOIN locked ON locked.content_hash = released.chunk_id
+            WHERE chunk.content_hash = released.chunk_id
+            RETURNING chunk.content_hash, chunk.ref_count
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [content_hash])
+            return [chunk_hash for chunk_hash, ref_count in cursor.fetchall() if ref_count <= 0]
+
+    def delete_unused(self, content_hashes):
+        """Delete chunks returned by release_blob() and their files, once no manifest lists them."""
+        if not content_hashes:
+            return
+        self.filter(pk__in=content_hashes, ref_count=0).delete()
+        for content_hash in content_hashes:
+            transaction.on_commit(
+                partial(_delete_stored, self.model, content_hash, [chunk_path(content_hash)]), using=self.db
+            )
+
+
+def _delete_stored(model, content_hash, names):
+    """Delete the files of a released blob or chunk, unless it was stored again since."""
+    if model.objects.filter(pk=content_hash).exists():
+        return
+    for name in names:
+        blob_storage.delete(name)
+
+
+def _acquire_references(manager, rows, defaults):
+    """
+    Insert rows of a reference-counted, content-addressed model, or add to the
+    ``ref_count`` of existing ones, in a single statement. ``rows`` maps content hashes
+    to (size, number of references) and ``defaults`` the other columns to SQL values
+    for new rows. Returns the set of hashes whose rows were created.
+    """
+    if not rows:
+        return set()
+
+    connection = connections[manager.db]
+    table = connection.ops.quote_name(manager.model._meta.db_table)
+    content_hashes = sorted(rows)  # A stable lock order avoids deadlocks between uploads.
+    columns = ", ".join(["content_hash", "size", "ref_count", *defaults])
+    values = ", ".join([f"(%s, %s, %s, {', '.join(defaults.values())})"] * len(content_hashes))
+    sql = f"""
+        INSERT INTO {table} AS existing ({columns})
+        VALUES {values}
+        ON CONFLICT (content_hash) DO UPDATE SET ref_count = existing.ref_count + EXCLUDED.ref_count
+        RETURNING content_hash, xmax = 0
+    """
+    params = [param for content_hash in content_hashes for param in (content_hash, *rows[content_hash])]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        # xmax is only zero on rows the statement inserted rather than updated.
+        return {content_hash for content_hash, inserted in cursor.fetchall() if inserted}
+
+
+class DocumentManager(models.Manager):
+    def allocate_revision(self, user, path, file_name):
+        """
+        Hand out the next revision of a document in a single statement.
+
+        The upsert locks the document row until the surrounding transaction commits,
+        so concurrent uploads of the same document are serialised by the database
+        instead of colliding on the FileVersion unique constraint. The counter never
+        drops below the highest stored revision, which keeps it correct for versions
+        created without going through this method.
+        """
+        return self.allocate_revisions({(user.pk, path, file_name): 1})[(user.pk, path, file_name)]
+
+    def allocate_revisions(self, counts):
+        """
+        Reserve revisions for many documents at once with a single upsert.
+
+        ``counts`` maps (user_id, path, file_name) to the number of revisions needed.
+        Returns a mapping of the same keys to the first reserved revision; the
+        reserved revisions are consecutive from there.
+        """
+        from .models import FileVersion
+
+        if not counts:
+            return {}
+
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        versions_table = connection.ops.quote_name(FileVersion._meta.db_table)
+        keys = sorted(counts)  # A stable lock order avoids deadlocks between batches.
+        values = ", ".join(["(%s::bigint, %s::varchar, %s::varchar, %s::integer)"] * len(keys))
+        sql = f"""
+            WITH requested (user_id, path, file_name, count) AS (VALUES {values})
+            INSERT INTO {table} AS document (user_id, path, file_name, latest_revision)
+            SELECT requested.user_id, requested.path, requested.file_name, requested.count + COALESCE((
+                SELECT MAX(revision) FROM {versions_table} AS version
+                WHERE version.user_id = requested.user_id
+                AND version.path = requested.path
+                AND version.file_name = requested.file_name
+            ), 0)
+            FROM requested
+            ON CONFLICT (user_id, path, file_name) DO UPDATE
+            SET latest_revision = GREATEST(
+                document.latest_revision + (
+                    SELECT requested.count FROM requested
+                    WHERE requested.user_id = EXCLUDED.user_id
+                    AND requested.path = EXCLUDED.path
+                    AND requested.file_name = EXCLUDED.file_name
+                ),
+                EXCLUDED.latest_revision
+            )
+            RETURNING user_id, path, file_name, latest_revision
+        """
+        params = [param for key in keys for param in (*key, counts[key])]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return {
+                (user_id, path, file_name): latest_revision - counts[(user_id, path, file_name)] + 1
+                for user_id, path, file_name, latest_revision in cursor.fetchall()
+            }
+
+
+class FilePermissionsManager(models.Manager):
+    # Gives the users access to the versions at the level of their share, leaving the
+    # owner's rows alone, and returns the rows that were inserted rather than updated.
+    UPSERT_ACCESS_SQL = """
+        INSERT INTO {access} AS access (user_id, file_version_id, level)
+        SELECT user_id, file_version_id, %(level)s
+        FROM unnest(%(user_ids)s::bigint[], %(file_version_ids)s::bigint[]) AS share (user_id, file_version_id)
+        ON CONFLICT (user_id, file_version_id) DO UPDATE SET level = EXCLUDED.level
+        WHERE access.level <> %(owner)s
+        RETURNING access.user_id, access.file_version_id, access.xmax = 0
+    """
+    # Deletes the shares of every user in %(user_ids)s on every version in
+    # %(file_version_ids)s together with the access rows they gave, returning the
+    # revoked pairs and whether each had an access row.
+    REVOKE_SQL = """
+        WITH revoked AS (
+            DELETE FROM {permissions}
+            WHERE user_id = ANY(%(user_ids)s) AND file_id = ANY(%(file_version_ids)s)
+            RETURNING user_id, file_id
+        ), access AS (
+            DELETE FROM {access} AS access USING revoked
+            WHERE access.user_id = revoked.user_id AND access.file_version_id = revoked.file_id
+            AND access.level <> %(owner)s
+            RETURNING access.user_id, access.file_version_id
+        )
+        SELECT revoked.user_id, revoked.file_id, access.file_version_id IS NOT NULL
+        FROM revoked LEFT JOIN access
+        ON access.user_id = revoked.user_id AND access.file_version_id = revoked.file_id
+    """
+
+    def share_many(self, owner, user_ids, file_versions, level):
+        """
+        Share every version with every user at ``level``, with set-based writes in one
+        transaction. Shares are upserted with a single bulk_create(), and the access
+        rows, folder counts and cached lookups that the save signals keep in sync for
+        single shares are updated here. Versions the user owns are skipped. Return the
+        (user_id, file_version_id) pairs that were not shared before.
+        """
+        from .cache import invalidate_user
+        from .models import Folder, Grant
+
+        # Ordered, so concurrent calls lock the rows they share in the same order.
+        pairs = sorted(
+            {
+                (user_id, file_version.id)
+                for user_id in user_ids
+                for file_version in file_versions
+                if file_version.user_id != user_id
+            }
+        )
+        if not pairs:
+            return set()
+        file_version_ids = [file_version_id for _, file_version_id in pairs]
+        with transaction.atomic(using=self.db):
+            existing = set(
+                self.filter(user_id__in=user_ids, file_id__in=file_version_ids).values_list("user_id", "file_id")
+            )
+            self.bulk_create(
+                [
+                    self.model(user_id=user_id, file_id=file_version_id, owner=owner, permissions=level)
+                    for user_id, file_version_id in pairs
+                ],
+                update_conflicts=True,
+                unique_fields=["user", "file"],
+                update_fields=["owner", "permissions"],
+            )
+            inserted = {}
+            rows = self._execute(
+                self.UPSERT_ACCESS_SQL,
+                user_ids=[user_id for user_id, _ in pairs],
+                file_version_ids=file_version_ids,
+                level=level,
+            )
+            for user_id, file_version_id, created in rows:
+                if created:
+                    inserted.setdefault(user_id, set()).add(file_version_id)
+
+            # Versions a grant gives the user are counted in their folders already.
+            covered = Grant.objects.covering(list(file_versions))
+            for user_id, ids in inserted.items():
+                Folder.objects.add_file_versions(user_id, ids - covered.get(user_id, set()))
+            for user_id in {user_id for user_id, _ in pairs}:
+                invalidate_user(user_id)
+        return set(pairs) - existing
+
+    def revoke_many(self, user_ids, file_versions):
+        """
+        Revoke the shares of every version from every user with set-based deletes, the
+        counterpart of share_many(). Return the (user_id, file_version_id) pairs that
+        were shared.
+        """
+        from .cache import invalidate_user
+        from .models import Folder, Grant
+
+        if not user_ids or not file_versions:
+            return set()
+        with transaction.atomic(using=self.db):
+            rows = self._execute(
+                self.REVOKE_SQL,
+                user_ids=list(user_ids),
+                file_version_ids=[file_version.id for file_version in file_versions],
+            )
+            removed = {}
+            for user_id, file_version_id, had_access in rows:
+                if had_access:
+                    removed.setdefault(user_id, set()).add(file_version_id)
+
+            # Versions a grant still gives the user stay counted for the grant.
+            covered = Grant.objects.covering(list(file_versions))
+            for user_id, ids in removed.items():
+                Folder.objects.remove_file_versions(user_id, ids - covered.get(user_id, set()))
+            revoked = {(user_id, file_version_id) for user_id, file_version_id, _ in rows}
+            for user_id in {user_id for user_id, _ in revoked}:
+                invalidate_user(user_id)
+        return revoked
+
+    def _execute(self, sql, **params):
+        from .models import FileAccess
+
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        sql = sql.format(
+            permissions=quote_name(self.model._meta.db_table), access=quote_name(FileAccess._meta.db_table)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {**params, "owner": FileAccess.OWNER})
+            return cursor.fetchall()
+
+
+class GrantManager(models.Manager):
+    def covering(self, versions):
+        """
+        Map each user that a grant gives any of ``versions`` to the ids of the versions
+        it gives them, with one query for the grants of all their owners.
+        """
+        owner_ids = {version.user_id for version in versions}
+        grants = self.filter(owner_id__in=owner_ids).values_list("owner_id", "user_id", "path", "file_name")
+        covered = {}
+        for owner_id, user_id, path, file_name in grants:
+            for version in versions:
+                if version.user_id == owner_id and grant_covers(path, file_name, version.path, version.file_name):
+                    covered.setdefault(user_id, set()).add(version.id)
+        return covered
+
+    def covers(self, user_id, version):
+        """Whether any grant of the version's owner to the user covers the version."""
+        grants = self.filter(owner_id=version.user_id, user_id=user_id).values_list("path", "file_name")
+        return any(grant_covers(path, file_name, version.path, version.file_name) for path, file_name in grants)
+
+    def add_versions(self, versions):
+        """
+        Count new versions in the folders of the users that grants give them to and drop
+        those users' cached lookups. Nobody has a FileAccess row on a new version yet.
+        """
+        from .cache import invalidate_user
+        from .models import Folder
+
+        for user_id, ids in self.covering(versions).items():
+            Folder.objects.add_file_versions(user_id, ids)
+            invalidate_user(user_id)
+
+    def remove_versions(self, versions):
+        """
+        Uncount versions about to be deleted from the folders of the users that grants
+        give them to. Users who also have a FileAccess row on a version are uncounted
+        when that row is deleted.
+        """
+        from .cache import invalidate_user
+        from .models import FileAccess, Folder
+
+        for user_id, ids in self.covering(versions).items():
+            shared = FileAccess.objects.filter(user_id=user_id, file_version_id__in=ids)
+            Folder.objects.remove_file_versions(user_id, ids - set(shared.values_list("file_version_id", flat=True)))
+            invalidate_user(user_id)
+
+    def absorb_shares(self, grant):
+        """
+        Delete the grantee's per-version shares that the grant makes redundant: those
+        of versions it covers, at its level or below. Shares giving more than the grant
+        are kept.
+        """
+        from .models import FilePermissions, FileVersion
+
+        covered = FileVersion.objects.filter(grant_q(grant.owner_id, grant.path, grant.file_name))
+        shares = FilePermissions.objects.filter(user_id=grant.user_id, file__in=covered)
+        if grant.level != FilePermissions.READ_WRITE:
+            shares = shares.filter(permissions=grant.level)
+        shares.delete()
+
+    def update_folders(self, grant, added):
+        """
+        Count the versions a new grant covers in the grantee's folders, or uncount those
+        of a deleted grant, leaving out the versions the grantee reaches in another way.
+        One grant of a folder with thousands of files is a single row, so this is the
+        only place its versions are enumerated.
+        """
+        from .models import FileVersion, Folder
+
+        versions = (
+            FileVersion.objects.filter(grant_q(grant.owner_id, grant.path, grant.file_name))
+            .exclude(access__user=grant.user_id)
+            .values_list("id", "path", "file_name")
+        )
+        others = list(
+            self.filter(owner_id=grant.owner_id, user_id=grant.user_id)
+            .exclude(pk=grant.pk)
+            .values_list("path", "file_name")
+        )
+        ids = [
+            version_id
+            for version_id, path, file_name in versions
+            if not any(grant_covers(other_path, other_name, path, file_name) for other_path, other_name in others)
+        ]
+        if added:
+            Folder.objects.add_file_versions(grant.user_id, ids)
+        else:
+            Folder.objects.remove_file_versions(grant.user_id, ids)
+
+
+class FolderManager(models.Manager):
+    # Expands every version in %(file_version_ids)s into one row per ancestor folder of
+    # its path, from the root ("") down to the path itself, with the blob size.
+    ANCESTORS_SQL = """
+        SELECT
+            array_to_string(parts[1:segments], '/') AS path,
+            CASE WHEN segments > 0 THEN array_to_string(parts[1:segments - 1], '/') END AS parent,
+            COALESCE(parts[segments], '') AS name,
+            COUNT(*) AS file_count,
+            COALESCE(SUM(blob.size), 0) AS size
+        FROM {versions} AS version
+        LEFT JOIN {blobs} AS blob ON blob.content_hash = version.content_hash
+        CROSS JOIN LATERAL string_to_array(version.path, '/') AS parts
+        CROSS JOIN LATERAL generate_series(0, COALESCE(array_length(parts, 1), 0)) AS segments
+        WHERE version.id = ANY(%(file_version_ids)s)
+        GROUP BY 1, 2, 3
+    """
+
+    def add_file_versions(self, user_id, file_version_ids):
+        """Count newly accessible versions in the user's folders, creating folders as needed."""
+        if not file_version_ids:
+            return
+        sql = f"""
+            INSERT INTO {{folders}} AS folder (user_id, path, parent, name, file_count, size)
+            SELECT %(user_id)s, path, parent, name, file_count, size FROM ({self.ANCESTORS_SQL}) AS ancestor
+            ON CONFLICT (user_id, path) DO UPDATE
+            SET file_count = folder.file_count + EXCLUDED.file_count, size = folder.size + EXCLUDED.size
+        """
+        self._execute(sql, user_id, file_version_ids)
+
+    def remove_file_versions(self, user_id, file_version_ids):
+        """
+        Uncount versions the user lost access to and drop folders left empty. The
+        versions must still exist, which holds for FileAccess post_delete signals as
+        access rows are deleted before the versions they cascade from.
+        """
+        if not file_version_ids:
+            return
+        sql = f"""
+            UPDATE {{folders}} AS folder
+            SET file_count = folder.file_count - ancestor.file_count, size = folder.size - ancestor.size
+            FROM ({self.ANCESTORS_SQL}) AS ancestor
+            WHERE folder.user_id = %(user_id)s AND folder.path = ancestor.path;
+            DELETE FROM {{folders}} WHERE user_id = %(user_id)s AND file_count <= 0;
+        """
+        self._execute(sql, user_id, file_version_ids)
+
+    def _execute(self, sql, user_id, file_version_ids):
+        from .models import Blob, FileVersion
+
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        sql = sql.format(
+            folders=quote_name(self.model._meta.db_table),
+            versions=quote_name(FileVersion._meta.db_table),
+            blobs=quote_name(Blob._meta.db_table),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {"user_id": user_id, "file_version_ids": list(file_version_ids)})
+
+
+class JobManager(models.Manager):
+    def claim(self, worker, limit):
+        """
+        Lock up to ``limit`` due jobs for ``worker`` and return them, oldest first.
+
+        Rows locked by another worker's claim are skipped rather than waited on, so
+        any number of workers can poll the same table. Jobs left running for longer
+        than FILE_JOBS_LEASE seconds, by a worker that died, are claimed again;
+        handlers must therefore be safe to run twice.
+        """
+        now = timezone.now()
+        expired = now - timedelta(seconds=settings.FILE_JOBS_LEASE)
+        with transaction.atomic(using=self.db):
+            pending = Q(status=self.model.PENDING, run_after__lte=now)
+            abandoned = Q(status=self.model.RUNNING, locked_at__lt=expired)
+            ids = list(
+                self.filter(pending | abandoned)
+                .order_by("run_after", "id")
+                .select_for_update(skip_locked=True)
+                .values_list("id", flat=True)[:limit]
+            )
+            self.filter(pk__in=ids).update(
+                status=self.model.RUNNING, locked_by=worker, locked_at=now, attempts=F("attempts") + 1
+            )
+        return list(self.filter(pk__in=ids).order_by("run_after", "id"))
+
+    def retry_or_fail(self, job, error):
+        """Put a job that raised back in the queue with exponential backoff, or mark it failed."""
+        job.last_error = error
+        job.locked_by, job.locked_at = "", None
+        if job.attempts < settings.FILE_JOBS_MAX_ATTEMPTS:
+            job.status = self.model.PENDING
+            job.run_after = timezone.now() + timedelta(seconds=min(2**job.attempts, 3600))
+        else:
+            job.status = self.model.FAILED
+        job.save(update_fields=["status", "run_after", "locked_by", "locked_at", "last_error"])
+
+
+class UploadSessionManager(models.Manager):
+    def lock_for_part(self, session_id, user):
+        """
+        Return the user's session with a FOR SHARE lock, or None. Any number of parts
+        can be written under it side by side, while completing or deleting the
+        session, which locks it FOR UPDATE, waits for them to finish.
+        """
+        table = connections[self.db].ops.quote_name(self.model._meta.db_table)
+        sessions = self.raw(f"SELECT * FROM {table} WHERE id = %s AND user_id = %s FOR SHARE", [session_id, user.pk])
+        return next(iter(sessions), None)
+
+    def expired(self):
+        """Sessions that received no part for FILE_UPLOAD_SESSION_TIMEOUT seconds."""
+        cutoff = timezone.now() - timedelta(seconds=settings.FILE_UPLOAD_SESSION_TIMEOUT)
+        stale = self.alias(last_activity=Greatest("created_at", Max("parts__uploaded_at"))).filter(
+            last_activity__lt=cutoff
+        )
+        return self.filter(pk__in=stale.values("pk"))
@@ -0,0 +1,156 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+PREFIX = "file_versions"
+# Upper bounds of the request latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = {
+    "storage_read_bytes_total": "Bytes of stored blobs read for downloads, archives and verification.",
+    "storage_written_bytes_total": "Bytes written to the blob store, including uploads in progress.",
+    "hashed_bytes_total": "Bytes of uploaded content hashed with SHA-256.",
+    "hash_seconds_total": "Time spent hashing uploaded content.",
+}
+
+
+class RequestRecord:
+    """
+    Queries run on behalf of the request being handled. Views may run their queries
+    in other threads, so they are appended to a list rather than summed in place.
+    """
+
+    def __init__(self, keep_sql=False):
+        self.keep_sql = keep_sql
+        self.queries = []
+
+    def add_query(self, sql, duration):
+        self.queries.append((sql if self.keep_sql else None, duration))
+
+
+current_request = ContextVar("file_versions_current_request", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every database connection. It times the queries of
+    requests handled by RequestMetricsMiddleware, in whichever thread they run, and
+    only calls through otherwise.
+    """
+    record = current_request.get()
+    if record is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record.add_query(sql, time.perf_counter() - started)
+
+
+class Metrics:
+    """Request latencies and counters of this process, per endpoint where it applies."""
+
+    def __init__(self):
+        self._requests = {}
+        self._responses = {}
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def record_request(self, endpoint, method, status, duration, queries):
+        with self._lock:
+            stats = self._requests.get((endpoint, method))
+            if stats is None:
+                stats = self._requests[endpoint, method] = {
+                    "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                    "seconds": 0.0,
+                    "count": 0,
+                    "queries": 0,
+                    "query_seconds": 0.0,
+                }
+            stats["buckets"][bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            stats["seconds"] += duration
+            stats["count"] += 1
+            stats["queries"] += len(queries)
+            stats["query_seconds"] += sum(query_duration for _, query_duration in queries)
+            key = (endpoint, method, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def increment(self, name, value):
+        with self._lock:
+            self._counters[name] += value
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._responses.clear()
+            self._counters = dict.fromkeys(COUNTERS, 0)
+
+    def render(self):
+        """All metrics, and the lookup cache counters, in the Prometheus text format."""
+        with self._lock:
+            requests = {key: {**stats, "buckets": list(stats["buckets"])} for key, stats in self._requests.items()}
+            responses = dict(self._responses)
+            counters = dict(self._counters)
+
+        lines = []
+        family = _family(lines, "request_duration_seconds", "histogram", "Time until the response is returned.")
+        for (endpoint, method), stats in sorted(requests.items()):
+            labels = {"endpoint": endpoint, "method": method}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), stats["buckets"]):
+                cumulative += count
+                lines.append(_sample(f"{family}_bucket", {**labels, "le": str(bound)}, cumulative))
+            lines.append(_sample(f"{family}_sum", labels, stats["seconds"]))
+            lines.append(_sample(f"{family}_count", labels, stats["count"]))
+
+        family = _family(lines, "responses_total", "counter", "Responses by status code.")
+        for (endpoint, method, status), count in sorted(responses.items()):
+            lines.append(_sample(family, {"endpoint": endpoint, "method": method, "status": status}, count))
+
+        for name, key, help_text in (
+            ("db_queries_total", "queries", "Database queries run by requests."),
+            ("db_query_seconds_total", "query_seconds", "Time spent in database queries by requests."),
+        ):
+            family = _family(lines, name, "counter", help_text)
+            for (endpoint, method), stats in sorted(requests.items()):
+                lines.append(_sample(family, {"endpoint": endpoint, "method": method}, stats[key]))
+
+        for name, help_text in COUNTERS.items():
+            lines.append(_sample(_family(lines, name, "counter", help_text), {}, counters[name]))
+
+        # Imported here: uploads record their hashing here and are imported by the models.
+        from .cache import stats
+
+        cache_stats = sorted(stats.snapshot().items())
+        for name, key, metric_type, help_text in (
+            ("cache_hits_total", "hits", "counter", "Lookup cache hits."),
+            ("cache_misses_total", "misses", "counter", "Lookup cache misses."),
+            ("cache_hit_ratio", "hit_rate", "gauge", "Share of lookups answered by the cache."),
+        ):
+            family = _family(lines, name, metric_type, help_text)
+            for kind, counts in cache_stats:
+                lines.append(_sample(family, {"kind": kind}, counts[key]))
+
+        return "\n".join(lines) + "\n"
+
+
+def _family(lines, name, metric_type, help_text):
+    name = f"{PREFIX}_{name}"
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    return name
+
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+        name = f"{name}{{{label_text}}}"
+    return f"{name} {value}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
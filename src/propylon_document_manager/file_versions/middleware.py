@@ -0,0 +1,72 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from .metrics import RequestRecord, current_request, metrics
+
+logger = logging.getLogger(__name__)
+
+# Queries listed in the log entry of a slow request, in the order they ran.
+SLOW_REQUEST_MAX_QUERIES = 100
+
+
+@sync_and_async_middleware
+def RequestMetricsMiddleware(get_response):
+    """
+    Record the latency, status and database queries of every request under the name
+    of the view it resolved to. Latency runs until the response is returned, so the
+    body of a streamed download is not included. Requests taking longer than
+    FILE_METRICS_SLOW_REQUEST seconds are logged along with their SQL.
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            record, token, started = _start()
+            try:
+                response = await get_response(request)
+            finally:
+                current_request.reset(token)
+            _finish(request, response, record, started)
+            return response
+
+    else:
+
+        def middleware(request):
+            record, token, started = _start()
+            try:
+                response = get_response(request)
+            finally:
+                current_request.reset(token)
+            _finish(request, response, record, started)
+            return response
+
+    return middleware
+
+
+def _start():
+    record = RequestRecord(keep_sql=bool(settings.FILE_METRICS_SLOW_REQUEST))
+    return record, current_request.set(record), time.perf_counter()
+
+
+def _finish(request, response, record, started):
+    duration = time.perf_counter() - started
+    match = request.resolver_match
+    endpoint = match.view_name if match else "unmatched"
+    metrics.record_request(endpoint, request.method, response.status_code, duration, record.queries)
+
+    threshold = settings.FILE_METRICS_SLOW_REQUEST
+    if threshold and duration >= threshold:
+        query_seconds = sum(query_duration for _, query_duration in record.queries)
+        lines = [
+            f"Slow request: {request.method} {request.get_full_path()} ({endpoint}) returned "
+            f"{response.status_code} in {duration * 1000:.0f}ms, "
+            f"{len(record.queries)} queries in {query_seconds * 1000:.0f}ms"
+        ]
+        shown = record.queries[:SLOW_REQUEST_MAX_QUERIES]
+        lines.extend(f"  {query_duration * 1000:8.1f}ms  {sql}" for sql, query_duration in shown)
+        if len(record.queries) > len(shown):
+            lines.append(f"  ... {len(record.queries) - len(shown)} more")
+        logger.warning("\n".join(lines))
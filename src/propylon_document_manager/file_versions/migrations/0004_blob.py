@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:04
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+import propylon_document_manager.file_versions.models
+import propylon_document_manager.file_versions.storage
+
+
+def move_files_to_blob_storage(apps, schema_editor):
+    from propylon_document_manager.file_versions.storage import blob_path, blob_storage
+
+    FileVersion = apps.get_model("file_versions", "FileVersion")
+    Blob = apps.get_model("file_versions", "Blob")
+
+    for file_version in FileVersion.objects.exclude(content_hash__isnull=True).exclude(content_hash="").iterator():
+        name = blob_path(file_version.content_hash)
+        if file_version.file.name != name:
+            if default_storage.exists(file_version.file.name):
+                with default_storage.open(file_version.file.name, "rb") as legacy_file:
+                    blob_storage.save(name, legacy_file)
+                default_storage.delete(file_version.file.name)
+            FileVersion.objects.filter(pk=file_version.pk).update(file=name)
+
+        blob, created = Blob.objects.get_or_create(
+            content_hash=file_version.content_hash,
+            defaults={"size": blob_storage.size(name) if blob_storage.exists(name) else 0, "ref_count": 1},
+        )
+        if not created:
+            Blob.objects.filter(pk=blob.pk).update(ref_count=models.F("ref_count") + 1)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("file_versions", "0003_alter_filepermissions_permissions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Blob",
+            fields=[
+                ("content_hash", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("size", models.BigIntegerField(default=0)),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="fileversion",
+            name="file",
+            field=models.FileField(
+                storage=propylon_document_manager.file_versions.storage.ContentAddressedStorage(),
+                upload_to=propylon_document_manager.file_versions.models.content_addressed_path,
+            ),
+        ),
+        migrations.RunPython(move_files_to_blob_storage, migrations.RunPython.noop),
+    ]
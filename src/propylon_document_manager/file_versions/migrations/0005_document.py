@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:07
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_documents(apps, schema_editor):
+    FileVersion = apps.get_model("file_versions", "FileVersion")
+    Document = apps.get_model("file_versions", "Document")
+
+    latest_revisions = FileVersion.objects.values("user_id", "path", "file_name").annotate(
+        latest_revision=models.Max("revision")
+    )
+    Document.objects.bulk_create(
+        [Document(**latest_revision) for latest_revision in latest_revisions.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0004_blob"),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name="fileversion",
+            unique_together={("user", "path", "file_name", "revision")},
+        ),
+        migrations.CreateModel(
+            name="Document",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("path", models.CharField(blank=True, max_length=1024)),
+                ("file_name", models.CharField(max_length=512)),
+                ("latest_revision", models.IntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="documents",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "path", "file_name")},
+            },
+        ),
+        migrations.RunPython(create_documents, migrations.RunPython.noop),
+    ]
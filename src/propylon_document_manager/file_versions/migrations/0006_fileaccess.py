@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+BACKFILL_SQL = """
+    INSERT INTO file_versions_fileaccess (user_id, file_version_id, level)
+    SELECT user_id, id, 'owner' FROM file_versions_fileversion;
+
+    INSERT INTO file_versions_fileaccess (user_id, file_version_id, level)
+    SELECT permission.user_id, permission.file_id, MAX(permission.permissions)
+    FROM file_versions_filepermissions AS permission
+    JOIN file_versions_fileversion AS version ON version.id = permission.file_id
+    WHERE permission.user_id <> version.user_id
+    GROUP BY permission.user_id, permission.file_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0005_document"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FileAccess",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "level",
+                    models.CharField(
+                        choices=[("owner", "Owner"), ("read", "Read"), ("read_write", "Read / Write")], max_length=10
+                    ),
+                ),
+                (
+                    "file_version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="access",
+                        to="file_versions.fileversion",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="file_access",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "file_version")},
+            },
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0006_fileaccess"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="fileversion",
+            options={"ordering": ["-created_at", "-id"]},
+        ),
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(fields=["-created_at", "-id"], name="fileversion_created_id_idx"),
+        ),
+    ]
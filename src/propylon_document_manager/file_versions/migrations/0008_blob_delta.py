@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0007_fileversion_created_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blob",
+            name="base",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="deltas",
+                to="file_versions.blob",
+            ),
+        ),
+        migrations.AddField(
+            model_name="blob",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
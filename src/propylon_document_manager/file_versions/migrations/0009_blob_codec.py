@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0008_blob_delta"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blob",
+            name="codec",
+            field=models.CharField(blank=True, choices=[("gzip", "gzip"), ("zstd", "zstd")], max_length=8),
+        ),
+    ]
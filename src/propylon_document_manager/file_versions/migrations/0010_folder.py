@@ -0,0 +1,65 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BACKFILL_SQL = """
+    INSERT INTO file_versions_folder (user_id, path, parent, name, file_count, size)
+    SELECT
+        access.user_id,
+        array_to_string(parts[1:segments], '/'),
+        CASE WHEN segments > 0 THEN array_to_string(parts[1:segments - 1], '/') END,
+        COALESCE(parts[segments], ''),
+        COUNT(*),
+        COALESCE(SUM(blob.size), 0)
+    FROM file_versions_fileaccess AS access
+    JOIN file_versions_fileversion AS version ON version.id = access.file_version_id
+    LEFT JOIN file_versions_blob AS blob ON blob.content_hash = version.content_hash
+    CROSS JOIN LATERAL string_to_array(version.path, '/') AS parts
+    CROSS JOIN LATERAL generate_series(0, COALESCE(array_length(parts, 1), 0)) AS segments
+    GROUP BY 1, 2, 3, 4;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0009_blob_codec"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Folder",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("path", models.CharField(blank=True, max_length=1024)),
+                ("parent", models.CharField(blank=True, max_length=1024, null=True)),
+                ("name", models.CharField(blank=True, max_length=1024)),
+                ("file_count", models.IntegerField(default=0)),
+                ("size", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(
+                fields=["path"], name="fileversion_path_pattern_idx", opclasses=["varchar_pattern_ops"]
+            ),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, related_name="folders", to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="folder",
+            index=models.Index(fields=["user", "parent", "name"], name="folder_children_idx"),
+        ),
+        migrations.AlterUniqueTogether(
+            name="folder",
+            unique_together={("user", "path")},
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:38
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+
+def index_existing_texts(apps, schema_editor):
+    BlobText = apps.get_model("file_versions", "BlobText")
+    BlobText.objects.update(
+        search_vector=django.contrib.postgres.search.SearchVector("content", config=settings.FILE_SEARCH_CONFIG)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0011_job_blobtext"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="blobtext",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="blobtext",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="blobtext_search_idx"),
+        ),
+        migrations.RunPython(index_existing_texts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0012_blobtext_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Chunk",
+            fields=[
+                ("content_hash", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("size", models.PositiveIntegerField(default=0)),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("codec", models.CharField(blank=True, choices=[("gzip", "gzip"), ("zstd", "zstd")], max_length=8)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="blob",
+            name="chunked",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="BlobChunk",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("position", models.PositiveIntegerField()),
+                ("offset", models.BigIntegerField()),
+                (
+                    "blob",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="manifest", to="file_versions.blob"
+                    ),
+                ),
+                (
+                    "chunk",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, related_name="+", to="file_versions.chunk"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("blob", "position")},
+            },
+        ),
+    ]
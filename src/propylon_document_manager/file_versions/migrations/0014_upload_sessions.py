@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:23
+
+import django.db.models.deletion
+import propylon_document_manager.file_versions.models
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0013_chunks"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UploadSession",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                (
+                    "path",
+                    models.CharField(
+                        blank=True,
+                        max_length=1024,
+                        validators=[propylon_document_manager.file_versions.models.validate_path],
+                    ),
+                ),
+                ("file_name", models.CharField(max_length=512)),
+                ("size", models.BigIntegerField()),
+                ("part_size", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="upload_sessions",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="UploadPart",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("number", models.PositiveIntegerField()),
+                ("size", models.PositiveIntegerField()),
+                ("sha256", models.CharField(max_length=64)),
+                ("uploaded_at", models.DateTimeField(auto_now=True)),
+                (
+                    "session",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="parts",
+                        to="file_versions.uploadsession",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("session", "number")},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0014_upload_sessions"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(fields=["content_hash"], name="fileversion_content_hash_idx"),
+        ),
+    ]
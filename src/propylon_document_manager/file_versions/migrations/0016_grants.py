@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:03
+
+import django.db.models.deletion
+import propylon_document_manager.file_versions.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0015_fileversion_content_hash_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Grant",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "path",
+                    models.CharField(
+                        blank=True,
+                        max_length=1024,
+                        validators=[propylon_document_manager.file_versions.models.validate_path],
+                    ),
+                ),
+                ("file_name", models.CharField(blank=True, max_length=512)),
+                ("level", models.CharField(choices=[("read", "Read"), ("read_write", "Read / Write")], max_length=10)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="fileversion",
+            index=models.Index(
+                fields=["user", "path"],
+                name="fileversion_user_path_idx",
+                opclasses=["int8_ops", "varchar_pattern_ops"],
+            ),
+        ),
+        migrations.AddField(
+            model_name="grant",
+            name="owner",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, related_name="owned_grants", to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AddField(
+            model_name="grant",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, related_name="grants", to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="grant",
+            unique_together={("owner", "user", "path", "file_name")},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+
+def merge_duplicate_shares(apps, schema_editor):
+    """Keep one share per user and version, the read/write one where both exist."""
+    FilePermissions = apps.get_model("file_versions", "FilePermissions")
+    FileAccess = apps.get_model("file_versions", "FileAccess")
+
+    read_write = FilePermissions.objects.filter(
+        user_id=OuterRef("user_id"), file_id=OuterRef("file_id"), permissions="read_write"
+    )
+    duplicates = FilePermissions.objects.filter(Exists(read_write), permissions="read")
+    for user_id, file_id in duplicates.values_list("user_id", "file_id").iterator():
+        FileAccess.objects.filter(user_id=user_id, file_version_id=file_id, level="read").update(level="read_write")
+    duplicates.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0016_grants"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_shares, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name="filepermissions",
+            unique_together={("user", "file")},
+        ),
+    ]
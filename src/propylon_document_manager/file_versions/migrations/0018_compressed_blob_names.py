@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:40
+
+import os
+
+from django.db import migrations
+
+from propylon_document_manager.file_versions.storage import blob_path, blob_storage
+
+
+def move_compressed_blobs(apps, schema_editor, forwards=True):
+    """Move blobs that were compressed in place to the name of their codec, or back."""
+    Blob = apps.get_model("file_versions", "Blob")
+    for content_hash, codec in Blob.objects.exclude(codec="").values_list("content_hash", "codec").iterator():
+        names = (blob_path(content_hash), blob_path(content_hash, codec))
+        source, destination = names if forwards else reversed(names)
+        if blob_storage.exists(source):
+            os.replace(blob_storage.path(source), blob_storage.path(destination))
+
+
+def move_compressed_blobs_back(apps, schema_editor):
+    move_compressed_blobs(apps, schema_editor, forwards=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("file_versions", "0017_filepermissions_unique_user_file"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_compressed_blobs, move_compressed_blobs_back),
+    ]
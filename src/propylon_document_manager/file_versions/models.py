@@ -1,16 +1,35 @@
+import io
 import os
-import hashlib
 import re
+import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db.models import CharField, EmailField
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 
-from .managers import UserManager
+from .chunking import ChunkedFile
+from .compression import CODEC_CHOICES, DecompressedFile
+from .managers import (
+    BlobManager,
+    ChunkManager,
+    DocumentManager,
+    FilePermissionsManager,
+    FileVersionQuerySet,
+    FolderManager,
+    GrantManager,
+    JobManager,
+    UploadSessionManager,
+    UserManager,
+)
+from .storage import blob_path, blob_storage, chunk_path
+from .uploads import HashedUploadedFile
 
 
 def validate_path(value):
@@ -59,35 +78,243 @@ def user_directory_path(instance, filename):
     return os.path.join(path, filename)
 
 
+def content_addressed_path(instance, filename):
+    return blob_path(instance.content_hash)
+
+
+class Blob(models.Model):
+    """
+    Stored file content shared by every FileVersion with the same content hash.
+    The file is removed from storage when the last referencing version is deleted.
+
+    With FILE_DELTA_STORAGE a blob may be stored as a delta against ``base``, the
+    blob of the previous revision of the same document. ``depth`` counts the deltas
+    between it and the nearest full snapshot. A delta holds a reference on its base.
+
+    With FILE_COMPRESSION a full blob may be stored compressed with ``codec``, in the
+    file ``stored_name``; ``size`` is always the size of the original content.
+
+    With FILE_CHUNK_STORAGE a blob is ``chunked``: its content is the sequence of
+    chunks listed in its BlobChunk manifest and it has no file of its own.
+    """
+
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    base = models.ForeignKey("self", on_delete=models.PROTECT, null=True, blank=True, related_name="deltas")
+    depth = models.PositiveSmallIntegerField(default=0)
+    codec = models.CharField(max_length=8, choices=CODEC_CHOICES, blank=True)
+    chunked = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    @property
+    def name(self):
+        return blob_path(self.content_hash)
+
+    @property
+    def stored_name(self):
+        return blob_path(self.content_hash, self.codec)
+
+    def open(self):
+        """Open the original content for reading, decompressing or rebuilding it as needed."""
+        if self.base_id is not None:
+            return io.BytesIO(Blob.objects.read(self.content_hash))
+        if self.chunked:
+            manifest = self.manifest.order_by("position").values_list(
+                "offset", "chunk__size", "chunk_id", "chunk__codec"
+            )
+            chunks = [
+                (offset, size, blob_storage.path(chunk_path(content_hash)), codec)
+                for offset, size, content_hash, codec in manifest
+            ]
+            return ChunkedFile(chunks, self.size)
+        if self.codec:
+            return DecompressedFile(blob_storage.path(self.stored_name), self.codec, self.size)
+        return open(blob_storage.path(self.name), "rb")
+
+    def open_stored(self):
+        """Open the bytes as stored, compressed with ``codec`` if it is set."""
+        return open(blob_storage.path(self.stored_name), "rb")
+
+    def __str__(self):
+        return f"{self.content_hash} ({self.ref_count} refs)"
+
+
+class Chunk(models.Model):
+    """
+    A piece of blob content cut by content-defined chunking, stored once however many
+    chunked blobs contain it, compressed with ``codec`` when that is worthwhile.
+    ``ref_count`` counts the manifest entries pointing at it.
+    """
+
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    size = models.PositiveIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    codec = models.CharField(max_length=8, choices=CODEC_CHOICES, blank=True)
+
+    objects = ChunkManager()
+
+    @property
+    def name(self):
+        return chunk_path(self.content_hash)
+
+    def __str__(self):
+        return f"{self.content_hash} ({self.ref_count} refs)"
+
+
+class BlobChunk(models.Model):
+    """Manifest entry: the chunk found at ``offset`` in a chunked blob."""
+
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name="manifest")
+    position = models.PositiveIntegerField()
+    offset = models.BigIntegerField()
+    chunk = models.ForeignKey(Chunk, on_delete=models.PROTECT, related_name="+")
+
+    class Meta:
+        unique_together = ("blob", "position")
+
+
+class BlobText(models.Model):
+    """
+    Plain text extracted from a blob in the background, with its search vector in the
+    FILE_SEARCH_CONFIG text search configuration. Text is kept per blob, so identical
+    content is extracted and indexed once however many versions share it.
+    """
+
+    blob = models.OneToOneField(Blob, on_delete=models.CASCADE, primary_key=True, related_name="text")
+    content = models.TextField()
+    search_vector = SearchVectorField(null=True)
+
+    class Meta:
+        indexes = [GinIndex(fields=["search_vector"], name="blobtext_search_idx")]
+
+    def __str__(self):
+        return f"Text of {self.blob_id}"
+
+
 class FileVersion(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
         related_name="file_versions"
     )
-    file = models.FileField(upload_to=user_directory_path)
+    file = models.FileField(upload_to=content_addressed_path, storage=blob_storage)
     file_name = models.CharField(max_length=512)
     path = models.CharField(max_length=1024, validators=[validate_path], blank=True)
     revision = models.IntegerField(default=1)
     content_hash = models.CharField(max_length=64, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FileVersionQuerySet.as_manager()
+
     class Meta:
-        unique_together = ("path", "revision", "user")
-        ordering = ["-created_at"]
+        unique_together = ("user", "path", "file_name", "revision")
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            models.Index(fields=["-created_at", "-id"], name="fileversion_created_id_idx"),
+            # Serves both path = 'a/b' and path LIKE 'a/b/%' prefix lookups.
+            models.Index(fields=["path"], name="fileversion_path_pattern_idx", opclasses=["varchar_pattern_ops"]),
+            # Matches grants: user_id = owner AND (path = 'a/b' OR path LIKE 'a/b/%').
+            models.Index(
+                fields=["user", "path"],
+                name="fileversion_user_path_idx",
+                opclasses=["int8_ops", "varchar_pattern_ops"],
+            ),
+            models.Index(fields=["content_hash"], name="fileversion_content_hash_idx"),
+        ]
 
     def save(self, *args, **kwargs):
-        if not self.content_hash and self.file:
-            sha256 = hashlib.sha256()
-            for chunk in self.file.chunks():
-                sha256.update(chunk)
-            self.content_hash = sha256.hexdigest()
-        super().save(*args, **kwargs)
+        if not self.content_hash and self.file and not self.file._committed:
+            # Uploads coming through HashingFileUploadHandler are already hashed. Any
+            # other file is hashed while it is copied next to the blob store, so the
+            # bytes are still read only once.
+            upload = self.file.file
+            if not isinstance(upload, HashedUploadedFile):
+                upload = HashedUploadedFile.from_file(upload, name=self.file.name)
+                self.file = upload
+            self.content_hash = upload.content_hash
+        else:
+            upload = None
+
+        try:
+            with transaction.atomic():
+                created = False
+                if self._state.adding and self.content_hash:
+                    blob, created = Blob.objects.acquire(self.content_hash, size=self.file.size)
+                    if not created and upload is not None:
+                        # Stored already, possibly as chunks or a delta that a raw copy would undo.
+                        self.file.name = blob.name
+                        self.file._committed = True
+                    # Without eager jobs the upload is stored as it is and packed by a worker.
+                    elif created and upload is not None and settings.FILE_JOBS_EAGER:
+                        self.store_new_blob(blob, upload)
+                super().save(*args, **kwargs)
+                if created:
+                    from .jobs import enqueue_new_blobs
+
+                    enqueue_new_blobs([self])
+        finally:
+            if upload is not None:
+                upload.close()
+
+    def store_new_blob(self, blob, upload, allow_delta=True):
+        """
+        Store a new blob as chunks, as a delta against the previous revision of this
+        document, or compressed, in that order of preference, when enabled and
+        worthwhile. The field is then marked as committed, so the raw upload is never
+        written to the blob store. Returns whether the blob was stored in one of
+        those forms.
+        """
+        stored = False
+        if settings.FILE_CHUNK_STORAGE:
+            stored = blob.chunked = Blob.objects.store_chunked(blob.content_hash, upload)
+        if not stored and settings.FILE_DELTA_STORAGE and allow_delta:
+            previous_hash = (
+                FileVersion.objects.filter(
+                    user_id=self.user_id, path=self.path, file_name=self.file_name, revision__lt=self.revision
+                )
+                .order_by("-revision")
+                .values_list("content_hash", flat=True)
+                .first()
+            )
+            stored = bool(previous_hash) and Blob.objects.store_delta(blob, upload, previous_hash)
+        if not stored and settings.FILE_COMPRESSION:
+            stored = Blob.objects.store_compressed(blob.content_hash, upload)
+        if stored:
+            self.file.name = blob.name
+            self.file._committed = True
+        return stored
 
     def __str__(self):
         return f"{self.file_name} (v{self.revision}) by {self.user.email}"
 
 
+class Document(models.Model):
+    """
+    Revision counter for every (user, path, file_name). Allocating a revision is a
+    single upsert on this row instead of a read of all existing versions.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="documents"
+    )
+    path = models.CharField(max_length=1024, blank=True)
+    file_name = models.CharField(max_length=512)
+    latest_revision = models.IntegerField(default=0)
+
+    objects = DocumentManager()
+
+    class Meta:
+        unique_together = ("user", "path", "file_name")
+
+    def __str__(self):
+        return f"{self.path}/{self.file_name} (v{self.latest_revision}) by {self.user_id}"
+
+
 class FilePermissions(models.Model):
     READ = "read"
     READ_WRITE = "read_write"
@@ -112,5 +339,181 @@ class FilePermissions(models.Model):
     )
     permissions = models.CharField(max_length=10, choices=PERMISSION_CHOICES)
 
+    objects = FilePermissionsManager()
+
     class Meta:
-        unique_together = ("user", "file", "permissions")
+        # One share per user and version, which share_many() upserts on.
+        unique_together = ("user", "file")
+
+
+class Grant(models.Model):
+    """
+    Access for ``user`` to every version ``owner`` has below the folder ``path``, or
+    to every revision of the document ``path/file_name`` when a file name is set,
+    including versions uploaded later. Grants are matched against the versions by
+    path when they are queried, so a single row covers any number of them.
+    """
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="owned_grants"
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="grants"
+    )
+    path = models.CharField(max_length=1024, validators=[validate_path], blank=True)
+    file_name = models.CharField(max_length=512, blank=True)
+    level = models.CharField(max_length=10, choices=FilePermissions.PERMISSION_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = GrantManager()
+
+    class Meta:
+        unique_together = ("owner", "user", "path", "file_name")
+
+    def __str__(self):
+        target = f"{self.path}/{self.file_name}" if self.file_name else f"{self.path}/"
+        return f"{target} of {self.owner_id} for {self.user_id} ({self.level})"
+
+
+class FileAccess(models.Model):
+    """
+    Access index with one row per user and file version they can reach, either as
+    the owner or through a share. It is kept in sync with FileVersion and
+    FilePermissions by signals, so lookups never have to OR-join the two.
+    """
+
+    OWNER = "owner"
+    LEVEL_CHOICES = [(OWNER, "Owner")] + FilePermissions.PERMISSION_CHOICES
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="file_access"
+    )
+    file_version = models.ForeignKey(
+        FileVersion,
+        on_delete=models.CASCADE,
+        related_name="access"
+    )
+    level = models.CharField(max_length=10, choices=LEVEL_CHOICES)
+
+    class Meta:
+        unique_together = ("user", "file_version")
+
+
+class Folder(models.Model):
+    """
+    Folder tree of everything a user can access, with the number and total size of
+    the file versions below each folder. The root folder has an empty path and no
+    parent. It is kept in sync with FileAccess by signals, so listing a folder reads
+    its direct children instead of aggregating every path below it.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="folders"
+    )
+    path = models.CharField(max_length=1024, blank=True)
+    parent = models.CharField(max_length=1024, null=True, blank=True)
+    name = models.CharField(max_length=1024, blank=True)
+    file_count = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    objects = FolderManager()
+
+    class Meta:
+        unique_together = ("user", "path")
+        indexes = [models.Index(fields=["user", "parent", "name"], name="folder_children_idx")]
+
+    def __str__(self):
+        return f"{self.path or '/'} ({self.file_count} files) for {self.user_id}"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload of one file of ``size`` bytes, sent in parts of ``part_size``
+    bytes that clients may upload in any order, in parallel and more than once. Each
+    part is written straight to its offset in a file preallocated in the blob storage
+    temporary directory, so completing the session only hashes that file and renames
+    it into the blob store.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="upload_sessions"
+    )
+    path = models.CharField(max_length=1024, validators=[validate_path], blank=True)
+    file_name = models.CharField(max_length=512)
+    size = models.BigIntegerField()
+    part_size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = UploadSessionManager()
+
+    @property
+    def part_count(self):
+        return -(-self.size // self.part_size)
+
+    @property
+    def temporary_path(self):
+        return os.path.join(blob_storage.temporary_directory(), f"{self.pk}.session")
+
+    def part_range(self, number):
+        """(offset, size) of part ``number``, counted from 1; only the last part may be shorter."""
+        offset = (number - 1) * self.part_size
+        return offset, min(self.part_size, self.size - offset)
+
+    def __str__(self):
+        return f"{self.path}/{self.file_name} ({self.size} bytes) for {self.user_id}"
+
+
+class UploadPart(models.Model):
+    """A part received for an upload session, with the SHA-256 of its bytes."""
+
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name="parts")
+    number = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("session", "number")
+
+
+class Job(models.Model):
+    """
+    Background work queued by uploads and run by the run_file_workers command. Rows
+    are inserted in the uploading transaction, so a job is only visible to workers
+    once the version it refers to is committed. Finished jobs are deleted; failed
+    ones are kept with their last error.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (RUNNING, "Running"), (FAILED, "Failed")]
+
+    kind = models.CharField(max_length=32)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = JobManager()
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"], name="job_queue_idx")]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+from django.db.models import Exists, F, OuterRef, Q
+
+from .models import BlobText, FileVersion
+
+HEADLINE_OPTIONS = {
+    "start_sel": "<mark>",
+    "stop_sel": "</mark>",
+    "max_words": 30,
+    "min_words": 10,
+    "max_fragments": 2,
+    "fragment_delimiter": " … ",
+}
+
+
+def update_search_vectors(content_hashes=None, rebuild=False):
+    """
+    Compute the search vector of the given blob texts, or of every text that has none
+    yet, or of every text with ``rebuild``. Returns the number of texts updated.
+    """
+    texts = BlobText.objects.all()
+    if content_hashes is not None:
+        texts = texts.filter(pk__in=content_hashes)
+    elif not rebuild:
+        texts = texts.filter(search_vector__isnull=True)
+    return texts.update(search_vector=SearchVector("content", config=settings.FILE_SEARCH_CONFIG))
+
+
+def search_file_versions(user, text, path="", all_revisions=False, limit=20):
+    """
+    Return the file versions the user can read whose content matches ``text``, in
+    web search syntax, best match first. Only the latest accessible revision of each
+    document is considered unless ``all_revisions`` is set. Every result carries its
+    ``rank`` and a ``snippet`` with the matches marked.
+
+    Matching texts are ranked in the same scan that finds them, restricted to blobs
+    of the candidate versions, and only the ``limit`` best blobs are joined back to
+    their versions. Every blob has at least one candidate version, so those blobs hold
+    the best ``limit`` versions. Snippets are only built for the returned page.
+    """
+    query = SearchQuery(text, search_type="websearch", config=settings.FILE_SEARCH_CONFIG)
+
+    candidates = FileVersion.objects.accessible_by(user)
+    if path:
+        candidates = candidates.filter(Q(path=path) | Q(path__startswith=f"{path}/"))
+    if not all_revisions:
+        newer = FileVersion.objects.accessible_by(user).filter(
+            user_id=OuterRef("user_id"),
+            path=OuterRef("path"),
+            file_name=OuterRef("file_name"),
+            revision__gt=OuterRef("revision"),
+        )
+        candidates = candidates.exclude(Exists(newer))
+
+    ranks = dict(
+        BlobText.objects.filter(search_vector=query, pk__in=candidates.values("content_hash"))
+        .annotate(rank=SearchRank(F("search_vector"), query))
+        .order_by("-rank", "pk")
+        .values_list("pk", "rank")[:limit]
+    )
+    results = sorted(
+        candidates.filter(content_hash__in=ranks).order_by("-created_at", "-id"),
+        key=lambda version: ranks[version.content_hash],
+        reverse=True,
+    )[:limit]
+
+    snippets = dict(
+        BlobText.objects.filter(pk__in=ranks)
+        .annotate(snippet=SearchHeadline("content", query, config=settings.FILE_SEARCH_CONFIG, **HEADLINE_OPTIONS))
+        .values_list("pk", "snippet")
+    )
+    for result in results:
+        result.rank = ranks[result.content_hash]
+        result.snippet = snippets[result.content_hash]
+    return results
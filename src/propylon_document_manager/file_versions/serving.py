@@ -0,0 +1,260 @@
+import mimetypes
+import re
+import secrets
+import threading
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import content_disposition_header, http_date, parse_etags, quote_etag
+
+from .metrics import metrics
+from .models import Blob
+from .storage import blob_storage, stream_size
+
+SENDFILE = "sendfile"
+X_ACCEL_REDIRECT = "x-accel-redirect"
+X_SENDFILE = "x-sendfile"
+
+SERVE_MODES = (SENDFILE, X_ACCEL_REDIRECT, X_SENDFILE)
+
+# Revisions never change once written, so responses for an explicit revision can be
+# cached for as long as clients like.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+RANGE_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+# Bytes read per thread hop when streaming to an ASGI server.
+ASYNC_BLOCK_SIZE = 64 * 1024
+
+
+def serve_file_version(request, file_version, file_name, immutable=False, blob=None, asynchronous=False):
+    """
+    Build the download response for a file version the caller is allowed to read.
+    ``blob`` is looked up from the version's content hash unless it is given.
+
+    The response carries an ETag derived from the content hash and honours
+    ``If-None-Match``/``If-Modified-Since`` with 304 and ``Range`` with 206.
+
+    With ``x-accel-redirect`` (nginx) or ``x-sendfile`` (Apache, lighttpd) the transfer
+    is handed to the front proxy, which also takes care of ranges, and the worker is
+    released immediately. The default ``sendfile`` mode streams the blob's file
+    descriptor, which WSGI servers with a ``wsgi.file_wrapper`` (gunicorn, uWSGI) send
+    with ``os.sendfile``.
+
+    Compressed blobs are sent as stored, with ``Content-Encoding``, to clients that
+    accept their codec and decompressed on the fly for everyone else. They, chunked
+    and delta-encoded blobs are always streamed by the worker, since the proxy could
+    not decode them.
+
+    With ``asynchronous`` the body is an async iterator, as ASGI servers need: each
+    block is read in a worker thread and no thread is held while the client is slow
+    to receive it.
+    """
+    mode = settings.FILE_SERVE_MODE
+    if mode not in SERVE_MODES:
+        raise ValueError(f"Unknown FILE_SERVE_MODE {mode!r}, expected one of {', '.join(SERVE_MODES)}")
+
+    if blob is None:
+        blob = Blob.objects.get(content_hash=file_version.content_hash)
+    encoding = blob.codec if blob.codec and blob.base_id is None and accepts_encoding(request, blob.codec) else ""
+    # Each encoding is a different representation, so it needs its own validator.
+    etag = quote_etag(f"{blob.content_hash}-{encoding}" if encoding else blob.content_hash)
+    last_modified = file_version.created_at.timestamp()
+    cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if mode == SENDFILE or blob.base_id is not None or blob.codec or blob.chunked:
+            response = _stream_blob(request, blob, file_name, etag, encoding, asynchronous)
+        else:
+            response = _offload_blob(file_version, file_name, mode)
+
+    if blob.codec:
+        patch_vary_headers(response, ["Accept-Encoding"])
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    return response
+
+
+def _offload_blob(file_version, file_name, mode):
+    response = HttpResponse(content_type=_content_type(file_name))
+    response["Content-Disposition"] = content_disposition_header(True, file_name)
+    if mode == X_ACCEL_REDIRECT:
+        response["X-Accel-Redirect"] = settings.FILE_SERVE_ACCEL_PREFIX + quote(file_version.file.name)
+    else:
+        response["X-Sendfile"] = blob_storage.path(file_version.file.name)
+    return response
+
+
+def accepts_encoding(request, coding):
+    """Whether the request's Accept-Encoding lists ``coding`` with a non-zero quality."""
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, parameters = item.partition(";")
+        if name.strip().lower() != coding:
+            continue
+        parameters = parameters.strip().lower()
+        if not parameters.startswith("q="):
+            return True
+        try:
+            return float(parameters[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _stream_blob(request, blob, file_name, etag, encoding, asynchronous=False):
+    # With an encoding, ranges apply to the stored bytes, as they are what is sent.
+    blob_file = blob.open_stored() if encoding else blob.open()
+    size = stream_size(blob_file)
+
+    ranges = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    # A stale If-Range means the client's partial copy is outdated: send everything.
+    if range_header and (not if_range or etag in parse_etags(if_range)):
+        ranges = parse_range_header(range_header, size)
+        if ranges == []:
+            blob_file.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if not ranges and not asynchronous:
+        # Read by the file wrapper or the server from here on, so counted up front.
+        metrics.increment("storage_read_bytes_total", size)
+        response = FileResponse(blob_file, as_attachment=True, filename=file_name)
+        response["Accept-Ranges"] = "bytes"
+        if encoding:
+            response["Content-Encoding"] = encoding
+        return response
+
+    content_type = _content_type(file_name)
+    block_size = ASYNC_BLOCK_SIZE if asynchronous else FileResponse.block_size
+    if not ranges:
+        # ASGI has no file wrapper, so the whole file is sent as one range.
+        body = _read_ranges(blob_file, [(0, size - 1)] if size else [], block_size=block_size)
+        response = StreamingHttpResponse(aiterate(body), content_type=content_type)
+        response["Content-Length"] = size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        body = _read_ranges(blob_file, ranges, block_size=block_size)
+        response = StreamingHttpResponse(
+            aiterate(body) if asynchronous else body, status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = end - start + 1
+    else:
+        boundary = secrets.token_hex(16)
+        parts = [
+            (
+                f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode()
+            for start, end in ranges
+        ]
+        closing = f"\r\n--{boundary}--\r\n".encode()
+        body = _read_ranges(blob_file, ranges, parts, closing, block_size)
+        response = StreamingHttpResponse(
+            aiterate(body) if asynchronous else body,
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response["Content-Length"] = (
+            sum(len(part) for part in parts)
+            + sum(end - start + 1 for start, end in ranges)
+            + 2 * (len(ranges) - 1)
+            + len(closing)
+        )
+
+    response["Accept-Ranges"] = "bytes"
+    response["Content-Disposition"] = content_disposition_header(True, file_name)
+    if encoding:
+        response["Content-Encoding"] = encoding
+    return response
+
+
+def parse_range_header(header, size):
+    """
+    Parse a ``Range: bytes=...`` header into a list of inclusive (start, end) pairs.
+
+    Returns None when the header should be ignored (malformed or not in bytes) and
+    an empty list when none of the ranges can be satisfied.
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if first == "":
+            # Suffix range: the last N bytes.
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        if start < size and start <= end:
+            ranges.append((start, end))
+    return ranges
+
+
+def _read_ranges(blob_file, ranges, parts=None, closing=b"", block_size=FileResponse.block_size):
+    try:
+        for index, (start, end) in enumerate(ranges):
+            if parts:
+                yield (b"\r\n" if index else b"") + parts[index]
+            blob_file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = blob_file.read(min(block_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                metrics.increment("storage_read_bytes_total", len(chunk))
+                yield chunk
+        if closing:
+            yield closing
+    finally:
+        blob_file.close()
+
+
+async def aiterate(iterator, thread_sensitive=False):
+    """
+    Turn a blocking iterator into an async one, advancing it in a worker thread.
+
+    ``thread_sensitive`` runs it in the thread shared with the request's other sync
+    code, as the ORM needs; plain file reads can go to any thread. The iterator is
+    closed when the client goes away, releasing the files it holds, but only once a
+    read still running in its thread is done.
+    """
+    lock = threading.Lock()
+    done = object()
+
+    def advance():
+        with lock:
+            return next(iterator, done)
+
+    def close():
+        with lock:
+            iterator.close()
+
+    try:
+        while (chunk := await sync_to_async(advance, thread_sensitive=thread_sensitive)()) is not done:
+            yield chunk
+    finally:
+        if hasattr(iterator, "close"):
+            await sync_to_async(close, thread_sensitive=thread_sensitive)()
+
+
+def _content_type(file_name):
+    content_type, encoding = mimetypes.guess_type(file_name)
+    return content_type or "application/octet-stream"
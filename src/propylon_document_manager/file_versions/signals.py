@@ -0,0 +1,119 @@
+import os
+from functools import partial
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .cache import invalidate_user
+from .metrics import record_query
+from .models import Blob, FileAccess, FilePermissions, FileVersion, Folder, Grant, UploadSession, User
+
+
+@receiver(post_save, sender=FileVersion)
+def grant_owner_access(sender, instance, created, **kwargs):
+    if created:
+        FileAccess.objects.create(user_id=instance.user_id, file_version=instance, level=FileAccess.OWNER)
+        Grant.objects.add_versions([instance])
+
+
+@receiver(pre_delete, sender=FileVersion)
+def uncount_granted_version(sender, instance, **kwargs):
+    # Before the delete, while the version and the grants of a deleted owner still exist.
+    Grant.objects.remove_versions([instance])
+
+
+@receiver(post_delete, sender=FileVersion)
+def release_file_version_blob(sender, instance, **kwargs):
+    if instance.content_hash:
+        Blob.objects.release(instance.content_hash)
+
+
+@receiver(post_save, sender=FilePermissions)
+def grant_shared_access(sender, instance, **kwargs):
+    if instance.user_id == instance.file.user_id:
+        return
+    FileAccess.objects.update_or_create(
+        user_id=instance.user_id,
+        file_version_id=instance.file_id,
+        defaults={"level": instance.permissions},
+    )
+
+
+@receiver(post_delete, sender=FilePermissions)
+def revoke_shared_access(sender, instance, origin=None, **kwargs):
+    # When the version or a user is deleted, the access row is collected by the same
+    # cascade; deleting it here too would send its post_delete, and uncount it, twice.
+    if getattr(origin, "model", type(origin)) in (FileVersion, User):
+        return
+    FileAccess.objects.filter(user_id=instance.user_id, file_version_id=instance.file_id).exclude(
+        level=FileAccess.OWNER
+    ).delete()
+
+
+@receiver(post_save, sender=FileAccess)
+@receiver(post_delete, sender=FileAccess)
+def invalidate_cached_lookups(sender, instance, **kwargs):
+    # Uploads, shares, revocations and deletes all change FileAccess rows, including
+    # the rows removed by cascade when a version is deleted.
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=FileAccess)
+def count_folder_file(sender, instance, created, **kwargs):
+    if not created:
+        return
+    if instance.level != FileAccess.OWNER and Grant.objects.covers(instance.user_id, instance.file_version):
+        return  # Counted for the grant already.
+    Folder.objects.add_file_versions(instance.user_id, [instance.file_version_id])
+
+
+@receiver(post_delete, sender=FileAccess)
+def uncount_folder_file(sender, instance, origin=None, **kwargs):
+    # A revoked share of a version that a grant still covers stays counted. When the
+    # version or a user is deleted, origin is that and not the FileAccess rows, and the
+    # row is uncounted here rather than for the grant.
+    revoked = getattr(origin, "model", type(origin)) is FileAccess
+    if revoked and Grant.objects.covers(instance.user_id, instance.file_version):
+        return
+    Folder.objects.remove_file_versions(instance.user_id, [instance.file_version_id])
+
+
+@receiver(post_save, sender=Grant)
+def count_granted_versions(sender, instance, created, **kwargs):
+    if created:
+        Grant.objects.update_folders(instance, added=True)
+    # After counting: the versions of the absorbed shares are counted already and stay
+    # counted, as the grant covers them.
+    Grant.objects.absorb_shares(instance)
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_delete, sender=Grant)
+def uncount_granted_versions(sender, instance, origin=None, **kwargs):
+    # When the owner is deleted their versions are uncounted one by one, and the
+    # grantee's own folders go with them.
+    if getattr(origin, "model", type(origin)) is not User:
+        Grant.objects.update_folders(instance, added=False)
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_session_file(sender, instance, **kwargs):
+    transaction.on_commit(partial(_remove_file, instance.temporary_path))
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        # Completed sessions had their file moved into the blob store.
+        pass
+
+
+@receiver(connection_created)
+def time_request_queries(sender, connection, **kwargs):
+    # Wrappers outlive reconnections of the same connection object.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+from .metrics import metrics
+
+
+def blob_path(content_hash, codec=""):
+    name = os.path.join("blobs", content_hash[:2], content_hash[2:4], content_hash)
+    # Compressed content has a name of its own, so it never replaces a raw file in use.
+    return f"{name}.{codec}" if codec else name
+
+
+def delta_path(content_hash):
+    return os.path.join("deltas", content_hash[:2], content_hash[2:4], content_hash)
+
+
+def chunk_path(content_hash):
+    return os.path.join("chunks", content_hash[:2], content_hash[2:4], content_hash)
+
+
+def stream_size(stream):
+    """Size of a seekable file object, which is not always backed by a file on disk."""
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage where the name of every file is derived from its content hash.
+    Saving content under a name that already exists is a no-op, so identical uploads
+    are written to disk only once.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def temporary_directory(self):
+        """
+        Directory for in-flight uploads. It lives inside the storage location so a
+        finished upload can be renamed into place instead of copied.
+        """
+        directory = self.path(os.path.join("blobs", "tmp"))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            return name
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Uploads that were already streamed to disk are moved, not read again.
+        if hasattr(content, "temporary_file_path"):
+            return self.move_into_place(content.temporary_file_path(), name)
+
+        # Write to a temporary file next to the blob and rename it into place, so
+        # concurrent readers never see a partially written blob.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in content.chunks():
+                    tmp_file.write(chunk)
+                    metrics.increment("storage_written_bytes_total", len(chunk))
+            os.chmod(tmp_path, self.file_permissions_mode or 0o644)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        return name
+
+    def move_into_place(self, temporary_path, name):
+        """Move a finished file from temporary_directory() to ``name``."""
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        file_move_safe(temporary_path, full_path, allow_overwrite=True)
+        os.chmod(full_path, self.file_permissions_mode or 0o644)
+        return name
+
+
+blob_storage = ContentAddressedStorage()
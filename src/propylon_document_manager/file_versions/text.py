@@ -0,0 +1,29 @@
+import html
+
+from django.utils.html import strip_tags
+
+from .compression import is_compressible
+
+# Only the start of larger documents is extracted; Postgres caps a tsvector at 1MiB.
+TEXT_MAX_SIZE = 1024 * 1024
+
+
+def extract_text(blob_file):
+    """
+    Return the plain text of a document, or None when it is not UTF-8 text. Markup
+    of XML and HTML documents is stripped. At most TEXT_MAX_SIZE bytes are read.
+    """
+    data = blob_file.read(TEXT_MAX_SIZE)
+    if not is_compressible(data[:16]) or b"\0" in data:
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as error:
+        # A character cut in half by the size limit is dropped; any other error means binary content.
+        if len(data) < TEXT_MAX_SIZE or error.start < len(data) - 3:
+            return None
+        text = data[: error.start].decode("utf-8")
+
+    if text.lstrip().startswith("<"):
+        text = html.unescape(strip_tags(text))
+    return text.strip() or None
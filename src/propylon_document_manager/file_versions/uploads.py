@@ -0,0 +1,148 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .metrics import metrics
+from .storage import blob_storage
+
+
+class HashedUploadedFile(UploadedFile):
+    """
+    A file that is hashed while it is streamed into the blob storage temporary
+    directory. Once finished it carries its SHA-256 in ``content_hash`` and can be
+    renamed into the blob store without reading it again.
+    """
+
+    def __init__(self, name, content_type=None, size=0, charset=None, content_type_extra=None, temporary_path=None):
+        if temporary_path is None:
+            fd, temporary_path = tempfile.mkstemp(suffix=".upload", dir=blob_storage.temporary_directory())
+            file = os.fdopen(fd, "w+b")
+        else:
+            file = open(temporary_path, "rb")
+        self._temporary_path = temporary_path
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.content_hash = None
+        self._sha256 = hashlib.sha256()
+        self._hash_seconds = 0.0
+
+    @classmethod
+    def from_temporary_file(cls, temporary_path, name, chunk_size=1024 * 2**10):
+        """
+        Hash a file that was assembled in temporary_directory() by other means. It is
+        read once and then renamed into the blob store, never copied.
+        """
+        hashed_file = cls(name, temporary_path=temporary_path)
+        while chunk := hashed_file.file.read(chunk_size):
+            hashed_file._hash(chunk)
+            hashed_file.size += len(chunk)
+        hashed_file.finish()
+        return hashed_file
+
+    @classmethod
+    def from_file(cls, file, name=None):
+        """Copy an arbitrary file object into a hashed upload in a single pass."""
+        hashed_file = cls(name or file.name, getattr(file, "content_type", None))
+        for chunk in file.chunks():
+            hashed_file.write(chunk)
+        hashed_file.finish()
+        return hashed_file
+
+    @classmethod
+    def from_stream(cls, stream, name, chunk_size=64 * 2**10):
+        """
+        Copy a readable stream, such as an archive member, into a hashed upload. Its
+        file is closed once hashed, so a large batch does not hold a descriptor per
+        upload, and is reopened with open() to store it.
+        """
+        hashed_file = cls(name)
+        try:
+            while chunk := stream.read(chunk_size):
+                hashed_file.write(chunk)
+            hashed_file.finish()
+        except BaseException:
+            hashed_file.close()
+            raise
+        hashed_file.file.close()
+        return hashed_file
+
+    def write(self, chunk):
+        self._hash(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+        metrics.increment("storage_written_bytes_total", len(chunk))
+
+    def _hash(self, chunk):
+        started = time.perf_counter()
+        self._sha256.update(chunk)
+        self._hash_seconds += time.perf_counter() - started
+
+    def finish(self):
+        self.file.flush()
+        self.file.seek(0)
+        self.content_hash = self._sha256.hexdigest()
+        metrics.increment("hashed_bytes_total", self.size)
+        metrics.increment("hash_seconds_total", self._hash_seconds)
+
+    def temporary_file_path(self):
+        return self._temporary_path
+
+    def open(self, mode="rb"):
+        if self.file.closed:
+            self.file = open(self._temporary_path, mode)
+        else:
+            self.file.seek(0)
+        return self
+
+    def close(self):
+        self.file.close()
+        try:
+            os.unlink(self._temporary_path)
+        except FileNotFoundError:
+            # The file was moved into the blob store.
+            pass
+
+
+def write_upload_part(path, offset, size, stream, chunk_size=64 * 2**10):
+    """
+    Write ``size`` bytes read from ``stream`` at ``offset`` in the file at ``path`` and
+    return their SHA-256, or None when the stream ends early. Each part only touches
+    its own range, so the parts of a file can be written concurrently.
+    """
+    sha256 = hashlib.sha256()
+    written = 0
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while written < size and (chunk := stream.read(min(chunk_size, size - written))):
+            sha256.update(chunk)
+            os.pwrite(fd, chunk, offset + written)
+            written += len(chunk)
+    finally:
+        os.close(fd)
+        metrics.increment("storage_written_bytes_total", written)
+    return sha256.hexdigest() if written == size else None
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that hashes, counts and writes every chunk in one pass, so memory
+    use is capped at a single chunk and the upload is never read back for hashing.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.finish()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            self.file.close()
@@ -1,8 +1,24 @@
+from django.conf import settings
 from django.urls import path
-from propylon_document_manager.file_versions.api import views
+from propylon_document_manager.file_versions.api import async_views, views
+
+if settings.FILE_ASYNC_VIEWS:
+    # Served under ASGI: the hot read endpoints hold no thread while they wait.
+    FileServeView = async_views.AsyncFileServeView
+    FileCASView = async_views.AsyncFileCASView
+    FileCASLookupView = async_views.AsyncFileCASLookupView
+else:
+    FileServeView = views.FileServeView
+    FileCASView = views.FileCASView
+    FileCASLookupView = views.FileCASLookupView
 
 urlpatterns = [
     path("api/auth-token", views.EmailAuthToken.as_view(), name="auth-token"),
-    path("api/cas/<str:hash_value>", views.FileCASView.as_view(), name="file_cas"),
-    path("api/dir/<path:file_path>", views.FileServeView.as_view(), name="serve_file"),
+    path("api/cache-stats", views.CacheStatsView.as_view(), name="cache_stats"),
+    path("api/metrics", views.MetricsView.as_view(), name="metrics"),
+    path("api/cas", FileCASLookupView.as_view(), name="file_cas_lookup"),
+    path("api/cas/<str:hash_value>", FileCASView.as_view(), name="file_cas"),
+    path("api/search", views.SearchView.as_view(), name="search"),
+    path("api/dir/", FileServeView.as_view(), name="serve_dir"),
+    path("api/dir/<path:file_path>", FileServeView.as_view(), name="serve_file"),
 ]
@@ -1,7 +1,9 @@
 from django.conf import settings
+from django.urls import path
 from rest_framework.routers import DefaultRouter, SimpleRouter
 
-from propylon_document_manager.file_versions.api.views import FileVersionViewSet
+from propylon_document_manager.file_versions.api.async_views import AsyncFileVersionListView
+from propylon_document_manager.file_versions.api.views import FileVersionViewSet, GrantViewSet, UploadSessionViewSet
 
 if settings.DEBUG:
     router = DefaultRouter(trailing_slash=False)
@@ -9,6 +11,12 @@ else:
     router = SimpleRouter(trailing_slash=False)
 
 router.register("file-versions", FileVersionViewSet, basename="file_versions")
+router.register("uploads", UploadSessionViewSet, basename="uploads")
+router.register("grants", GrantViewSet, basename="grants")
 
 app_name = "api"
 urlpatterns = router.urls
+
+if settings.FILE_ASYNC_VIEWS:
+    # Served under ASGI, like the read endpoints in file_versions/urls.py.
+    urlpatterns = [path("file-versions", AsyncFileVersionListView.as_view(), name="file_versions-list"), *urlpatterns]
@@ -0,0 +1,18 @@
+"""
+ASGI entry point, e.g. ``uvicorn propylon_document_manager.site.asgi:application``.
+
+Downloads, listings and CAS lookups are served by async views here, so one process
+can stream to thousands of slow clients at once.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "propylon_document_manager.site.settings.production")
+os.environ.setdefault("DJANGO_FILE_ASYNC_VIEWS", "True")
+# Each request runs its sync code in a new thread, so a persistent connection would
+# never be reused.
+os.environ.setdefault("CONN_MAX_AGE", "0")
+
+application = get_asgi_application()
@@ -128,6 +128,7 @@ AUTH_PASSWORD_VALIDATORS = [
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/dev/ref/settings/#middleware
 MIDDLEWARE = [
+    "propylon_document_manager.file_versions.middleware.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
@@ -161,6 +162,10 @@ STATICFILES_FINDERS = [
 MEDIA_ROOT = str(APPS_DIR / "media")
 # https://docs.djangoproject.com/en/dev/ref/settings/#media-url
 MEDIA_URL = "/media/"
+# https://docs.djangoproject.com/en/dev/ref/settings/#file-upload-handlers
+FILE_UPLOAD_HANDLERS = [
+    "propylon_document_manager.file_versions.uploads.HashingFileUploadHandler",
+]
 
 # TEMPLATES
 # ------------------------------------------------------------------------------
@@ -290,3 +295,58 @@ CORS_ALLOW_ALL_ORIGINS = True
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# How FileServeView hands file contents to the client: "sendfile" streams the blob
+# from the worker, "x-accel-redirect" (nginx) and "x-sendfile" (Apache) offload the
+# transfer to the front proxy once permissions have been checked.
+FILE_SERVE_MODE = env("DJANGO_FILE_SERVE_MODE", default="sendfile")
+# Internal nginx location that aliases MEDIA_ROOT, used with "x-accel-redirect".
+FILE_SERVE_ACCEL_PREFIX = env("DJANGO_FILE_SERVE_ACCEL_PREFIX", default="/protected-media/")
+# Route downloads, listings and CAS lookups to their async views. Only worth it under
+# ASGI, which site/asgi.py turns this on for: a WSGI server buffers async responses.
+FILE_ASYNC_VIEWS = env.bool("DJANGO_FILE_ASYNC_VIEWS", default=False)
+# Requests an ASGI process handles at once, each with its own database connection.
+# Responses stream outside of the limit, so it does not cap concurrent downloads.
+FILE_ASYNC_CONCURRENCY = env.int("DJANGO_FILE_ASYNC_CONCURRENCY", default=20)
+# Store new revisions as binary deltas against the previous revision of the same
+# document, with a full snapshot at least every FILE_DELTA_SNAPSHOT_INTERVAL
+# revisions. A delta is only kept when it is below FILE_DELTA_MAX_RATIO of the
+# content size. Rebuilt revisions are cached per process up to FILE_DELTA_CACHE_SIZE bytes.
+FILE_DELTA_STORAGE = env.bool("DJANGO_FILE_DELTA_STORAGE", default=False)
+FILE_DELTA_SNAPSHOT_INTERVAL = env.int("DJANGO_FILE_DELTA_SNAPSHOT_INTERVAL", default=16)
+FILE_DELTA_MAX_RATIO = env.float("DJANGO_FILE_DELTA_MAX_RATIO", default=0.5)
+FILE_DELTA_CACHE_SIZE = env.int("DJANGO_FILE_DELTA_CACHE_SIZE", default=64 * 1024 * 1024)
+# Compress new blobs at rest with "gzip" or "zstd" (needs the zstandard package);
+# empty to store them as uploaded. Content that looks compressed already, or does not
+# shrink below FILE_COMPRESSION_MAX_RATIO of its size, is stored as it is.
+FILE_COMPRESSION = env("DJANGO_FILE_COMPRESSION", default="")
+FILE_COMPRESSION_MAX_RATIO = env.float("DJANGO_FILE_COMPRESSION_MAX_RATIO", default=0.9)
+# Split new blobs into content-defined chunks of about FILE_CHUNK_AVG_SIZE bytes, each
+# stored once across all blobs, so revisions and copies that share most of their
+# content share most of their storage. Takes precedence over delta storage; chunks are
+# compressed with FILE_COMPRESSION.
+FILE_CHUNK_STORAGE = env.bool("DJANGO_FILE_CHUNK_STORAGE", default=False)
+FILE_CHUNK_AVG_SIZE = env.int("DJANGO_FILE_CHUNK_AVG_SIZE", default=16 * 1024)
+# Uploads queue packing (chunks/delta/compression), verification and text extraction of new
+# blobs as jobs for "manage.py run_file_workers". With FILE_JOBS_EAGER they run inside
+# the upload request instead. A job running for longer than FILE_JOBS_LEASE seconds is
+# taken over by another worker, and a job is retried up to FILE_JOBS_MAX_ATTEMPTS times.
+FILE_JOBS_EAGER = env.bool("DJANGO_FILE_JOBS_EAGER", default=False)
+FILE_JOBS_LEASE = env.int("DJANGO_FILE_JOBS_LEASE", default=600)
+FILE_JOBS_MAX_ATTEMPTS = env.int("DJANGO_FILE_JOBS_MAX_ATTEMPTS", default=5)
+# Resumable uploads ("api/uploads") take files of up to FILE_UPLOAD_SESSION_MAX_SIZE
+# bytes in parts of FILE_UPLOAD_PART_SIZE bytes. Sessions that receive no part for
+# FILE_UPLOAD_SESSION_TIMEOUT seconds are removed by "manage.py clear_upload_sessions".
+FILE_UPLOAD_PART_SIZE = env.int("DJANGO_FILE_UPLOAD_PART_SIZE", default=8 * 1024 * 1024)
+FILE_UPLOAD_SESSION_MAX_SIZE = env.int("DJANGO_FILE_UPLOAD_SESSION_MAX_SIZE", default=100 * 1024**3)
+FILE_UPLOAD_SESSION_TIMEOUT = env.int("DJANGO_FILE_UPLOAD_SESSION_TIMEOUT", default=24 * 3600)
+# Bulk uploads ("api/file-versions/bulk") take archives of up to FILE_BULK_UPLOAD_MAX_FILES
+# files. Repeated "files" fields are capped by DATA_UPLOAD_MAX_NUMBER_FILES, as in any request.
+FILE_BULK_UPLOAD_MAX_FILES = env.int("DJANGO_FILE_BULK_UPLOAD_MAX_FILES", default=10_000)
+# Postgres text search configuration used to index and query extracted document text.
+# Run "manage.py update_search_index --rebuild" after changing it.
+FILE_SEARCH_CONFIG = env("DJANGO_FILE_SEARCH_CONFIG", default="english")
+# Cache alias and timeout (seconds) for per-user file version and access lookups.
+FILE_VERSION_CACHE = env("DJANGO_FILE_VERSION_CACHE", default="default")
+FILE_VERSION_CACHE_TIMEOUT = env.int("DJANGO_FILE_VERSION_CACHE_TIMEOUT", default=3600)
+# Log requests taking longer than this many seconds with the SQL they ran; 0 disables.
+FILE_METRICS_SLOW_REQUEST = env.float("DJANGO_FILE_METRICS_SLOW_REQUEST", default=0)
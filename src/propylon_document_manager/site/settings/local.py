@@ -56,3 +56,5 @@ INSTALLED_APPS += ["django_extensions"]  # noqa: F405
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Process uploads inline, so no worker is needed in development.
+FILE_JOBS_EAGER = env.bool("DJANGO_FILE_JOBS_EAGER", default=True)
@@ -0,0 +1,8 @@
+"""WSGI entry point, e.g. ``gunicorn propylon_document_manager.site.wsgi``."""
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "propylon_document_manager.site.settings.production")
+
+application = get_wsgi_application()
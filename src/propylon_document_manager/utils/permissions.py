@@ -1,24 +1,42 @@
 from rest_framework import permissions
 
+from propylon_document_manager.file_versions.cache import get_access_level
+from propylon_document_manager.file_versions.models import FileAccess, FilePermissions
+
 
 class FileVersionPermission(permissions.BasePermission):
     """
     Object-level permission for FileVersion:
     - Owner always has full access.
     - Users with read/write permissions in FilePermissions have access accordingly.
+
+    The level comes from the access_level annotation added by
+    FileVersion.objects.accessible_by(), so checking it costs no query. Objects
+    fetched some other way are looked up in the access cache once per request.
     """
 
     def has_object_permission(self, request, view, obj):
-        user = request.user
+        level = self.get_access_level(request, obj)
+        if level is None:
+            return False
 
-        if obj.user == user:
+        if level == FileAccess.OWNER:
             return True
 
-        permission_qs = obj.file_permissions.filter(user=user)
-        if not permission_qs.exists():
-            return False
-
         if request.method in permissions.SAFE_METHODS:
-            return permission_qs.filter(permissions__in=["read", "read_write"]).exists()
+            return level in [FilePermissions.READ, FilePermissions.READ_WRITE]
         else:
-            return permission_qs.filter(permissions="read_write").exists()
+            return level == FilePermissions.READ_WRITE
+
+    @staticmethod
+    def get_access_level(request, obj):
+        level = getattr(obj, "access_level", None)
+        if level is not None:
+            return level
+
+        cache = getattr(request, "_file_access_levels", None)
+        if cache is None:
+            cache = request._file_access_levels = {}
+        if obj.pk not in cache:
+            cache[obj.pk] = get_access_level(request.user, obj.pk)
+        return cache[obj.pk]
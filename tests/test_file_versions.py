@@ -1,13 +1,53 @@
+import gzip
 import hashlib
+import io
+import json
+import os
+import resource
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from datetime import timedelta
+from random import Random
+from unittest import mock
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 
-from propylon_document_manager.file_versions.models import FileVersion, FilePermissions
+from propylon_document_manager.file_versions import archives, jobs
+from propylon_document_manager.file_versions.api import async_views
+from propylon_document_manager.file_versions import cache as file_version_cache
+from propylon_document_manager.file_versions.chunking import iter_chunks
+from propylon_document_manager.file_versions.delta import apply_delta, encode_delta, revision_cache
+from propylon_document_manager.file_versions.metrics import metrics
+from propylon_document_manager.file_versions.models import (
+    Blob,
+    BlobText,
+    Chunk,
+    Document,
+    FileAccess,
+    FileVersion,
+    FilePermissions,
+    Folder,
+    Grant,
+    Job,
+    UploadSession,
+    User,
+)
+from propylon_document_manager.file_versions.storage import blob_path, blob_storage, chunk_path, delta_path
+from propylon_document_manager.file_versions.uploads import HashingFileUploadHandler
 from .factories import UserFactory
 
 
@@ -28,7 +68,7 @@ class TestFileVersionModelSave(TestCase):
 
         expected_hash = hashlib.sha256(self.file_content).hexdigest()
         self.assertEqual(file_version.revision, 1)
-        self.assertIn("test.txt", file_version.file.name)
+        self.assertEqual(file_version.file.name, blob_path(expected_hash))
         self.assertEqual(file_version.content_hash, expected_hash)
         self.assertTrue(file_version.created_at)
 
@@ -57,7 +97,8 @@ class TestFileVersionAPI(APITestCase):
         file_version = FileVersion.objects.get(pk=response.data["id"])
         self.assertEqual(file_version.user, self.user)
         self.assertEqual(file_version.path, self.path)
-        self.assertIn(self.file_name, file_version.file.name)
+        self.assertEqual(file_version.file_name, self.file_name)
+        self.assertEqual(file_version.file.name, blob_path(file_version.content_hash))
         self.assertEqual(file_version.revision, 1)
         self.assertIsNotNone(file_version.content_hash)
 
@@ -85,6 +126,224 @@ class TestFileVersionAPI(APITestCase):
         self.assertEqual(file_version_2.revision, 2)
 
 
+class TestStreamingUpload(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_handler_hashes_while_writing(self):
+        handler = HashingFileUploadHandler()
+        handler.new_file("file", "large.txt", "text/plain", None)
+        chunks = [b"a" * 1024, b"b" * 1024, b"c" * 10]
+        for chunk in chunks:
+            handler.receive_data_chunk(chunk, 0)
+        upload = handler.file_complete(sum(map(len, chunks)))
+
+        self.assertEqual(upload.content_hash, hashlib.sha256(b"".join(chunks)).hexdigest())
+        self.assertEqual(upload.size, 2058)
+        self.assertEqual(upload.read(), b"".join(chunks))
+        upload.close()
+
+    def test_upload_is_moved_into_blob_store(self):
+        content = b"x" * (256 * 1024)
+        data = {"path": "large", "file": SimpleUploadedFile("large.txt", content)}
+
+        with mock.patch("django.core.files.base.File.chunks", side_effect=AssertionError("file read twice")):
+            response = self.client.post(reverse("api:file_versions-list"), data, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file_version = FileVersion.objects.get(pk=response.data["id"])
+        self.assertEqual(file_version.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(blob_storage.open(file_version.file.name).read(), content)
+        self.assertEqual(blob_storage.listdir("blobs/tmp"), ([], []))
+
+
+class TestBlobDeduplication(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.second_user = UserFactory(email="some_random@user.com")
+        self.content = b"Statute text"
+        self.content_hash = hashlib.sha256(self.content).hexdigest()
+
+    def create_version(self, user, path):
+        return FileVersion.objects.create(
+            file_name="statute.txt",
+            path=path,
+            user=user,
+            file=SimpleUploadedFile("statute.txt", self.content, content_type="text/plain"),
+        )
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.create_version(self.user, "documents")
+        second = self.create_version(self.second_user, "other")
+
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(Blob.objects.get(pk=self.content_hash).ref_count, 2)
+        self.assertEqual(len(blob_storage.listdir(blob_path(self.content_hash)[:-64])[1]), 1)
+
+    def test_blob_is_deleted_with_last_reference(self):
+        first = self.create_version(self.user, "documents")
+        second = self.create_version(self.user, "other")
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.delete(reverse("api:file_versions-detail", args=[first.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Blob.objects.get(pk=self.content_hash).ref_count, 1)
+        self.assertTrue(blob_storage.exists(blob_path(self.content_hash)))
+
+        # Files are deleted once the transaction that released the blob commits.
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse("api:file_versions-detail", args=[second.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Blob.objects.filter(pk=self.content_hash).exists())
+        self.assertFalse(blob_storage.exists(blob_path(self.content_hash)))
+
+    def test_rolled_back_delete_keeps_the_blob_file(self):
+        version = self.create_version(self.user, "documents")
+
+        with transaction.atomic():
+            version.delete()
+            transaction.set_rollback(True)
+
+        self.assertEqual(Blob.objects.get(pk=self.content_hash).ref_count, 1)
+        self.assertTrue(blob_storage.exists(blob_path(self.content_hash)))
+
+
+class TestBulkUpload(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("api:file_versions-bulk")
+
+    @override_settings(FILE_JOBS_EAGER=False)
+    def test_bulk_upload_of_files(self):
+        FileVersion.objects.create(
+            file_name="bill.txt", path="bills", user=self.user, file=SimpleUploadedFile("bill.txt", b"v1")
+        )
+        files = [
+            SimpleUploadedFile("bill.txt", b"v2"),
+            SimpleUploadedFile("bill.txt", b"v3"),
+            SimpleUploadedFile("act.txt", b"v2"),
+        ]
+
+        # Including the lookup of the owner's grants, which cover new revisions too.
+        with self.assertNumQueries(9):
+            response = self.client.post(self.url, {"path": "bills", "files": files}, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [(item["file_name"], item["revision"]) for item in response.data],
+            [("bill.txt", 2), ("bill.txt", 3), ("act.txt", 1)],
+        )
+        self.assertEqual(Blob.objects.get(pk=hashlib.sha256(b"v2").hexdigest()).ref_count, 2)
+        self.assertEqual(FileAccess.objects.filter(user=self.user, level=FileAccess.OWNER).count(), 4)
+        act = FileVersion.objects.get(file_name="act.txt")
+        self.assertEqual(act.file.read(), b"v2")
+
+    def test_bulk_upload_of_archive_reports_each_file(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("acts/2024/act.xml", b"<act/>")
+            archive.writestr("bad folder/notes.txt", b"notes")
+        archive_file = SimpleUploadedFile("batch.zip", buffer.getvalue(), content_type="application/zip")
+
+        response = self.client.post(self.url, {"path": "import", "archive": archive_file}, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        created, failed = response.data
+        self.assertEqual(
+            (created["path"], created["file_name"], created["status"]), ("import/acts/2024", "act.xml", 201)
+        )
+        self.assertEqual((failed["path"], failed["status"]), ("import/bad folder", 400))
+        self.assertEqual(FileVersion.objects.get(pk=created["id"]).file.read(), b"<act/>")
+
+    def test_bulk_upload_of_tar_archive(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            member = tarfile.TarInfo("statutes/statute.txt")
+            member.size = 7
+            archive.addfile(member, io.BytesIO(b"statute"))
+        archive_file = SimpleUploadedFile("batch.tar.gz", buffer.getvalue())
+
+        response = self.client.post(self.url, {"archive": archive_file}, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data[0]["path"], "statutes")
+
+    def test_bulk_upload_needs_files(self):
+        response = self.client.post(self.url, {"path": "empty"}, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_upload_of_archive_with_more_files_than_descriptors(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = len(os.listdir("/proc/self/fd")) + 64
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for number in range(limit + 100):
+                archive.writestr(f"acts/act-{number}.txt", f"act {number}".encode())
+        archive_file = SimpleUploadedFile("batch.zip", buffer.getvalue(), content_type="application/zip")
+
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            response = self.client.post(self.url, {"archive": archive_file}, format="multipart")
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), limit + 100)
+        self.assertEqual(FileVersion.objects.get(file_name="act-7.txt").file.read(), b"act 7")
+
+    @override_settings(FILE_BULK_UPLOAD_MAX_FILES=2)
+    def test_bulk_upload_rejects_archive_with_too_many_files(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as archive:
+            for number in range(3):
+                member = tarfile.TarInfo(f"acts/act-{number}.txt")
+                member.size = 5
+                archive.addfile(member, io.BytesIO(f"act {number}".encode()))
+        archive_file = SimpleUploadedFile("batch.tar", buffer.getvalue())
+
+        response = self.client.post(self.url, {"archive": archive_file}, format="multipart")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("archive", response.data)
+        self.assertFalse(FileVersion.objects.exists())
+
+
+class TestConcurrentRevisionAllocation(TransactionTestCase):
+    uploads = 20
+
+    def setUp(self):
+        self.user = UserFactory()
+
+    def upload(self, index):
+        try:
+            client = APIClient()
+            client.force_authenticate(user=self.user)
+            data = {
+                "path": "documents/bills",
+                "file": SimpleUploadedFile("bill.txt", f"draft {index}".encode(), content_type="text/plain"),
+            }
+            response = client.post(reverse("api:file_versions-list"), data, format="multipart")
+            return response.status_code, response.data.get("revision")
+        finally:
+            connection.close()
+
+    def test_parallel_uploads_get_distinct_revisions(self):
+        with ThreadPoolExecutor(max_workers=self.uploads) as executor:
+            results = list(executor.map(self.upload, range(self.uploads)))
+
+        self.assertEqual([code for code, _ in results], [status.HTTP_201_CREATED] * self.uploads)
+        self.assertEqual(sorted(revision for _, revision in results), list(range(1, self.uploads + 1)))
+        self.assertEqual(
+            Document.objects.get(user=self.user, path="documents/bills", file_name="bill.txt").latest_revision,
+            self.uploads,
+        )
+
+
 class TestFileVersionAPIGet(APITestCase):
     def setUp(self):
         self.user = UserFactory()
@@ -106,8 +365,31 @@ class TestFileVersionAPIGet(APITestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]["file_name"], self.file_name)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["file_name"], self.file_name)
+        self.assertIsNone(response.data["next"])
+
+    def test_list_rows_match_single_representation(self):
+        FileVersion.objects.create(
+            file_name="second file.txt",
+            path="",
+            user=self.user,
+            file=SimpleUploadedFile("second file.txt", b"Second"),
+        )
+        response = self.client.get(reverse("api:file_versions-list"))
+
+        for item in response.data["results"]:
+            url = reverse("api:file_versions-detail", args=[item["id"]])
+            self.assertEqual(item, self.client.get(url).data)
+
+    def test_listed_file_url_downloads_the_revision(self):
+        response = self.client.get(reverse("api:file_versions-list"))
+        file_url = response.data["results"][0]["file"]
+
+        self.assertTrue(file_url.startswith("http://testserver/api/dir/documents/test/test.txt?revision=1"))
+        response = self.client.get(file_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("immutable", response["Cache-Control"])
 
     def test_retrieve_single_file_version(self):
         url = reverse("api:file_versions-detail", args=[self.file_version.id])
@@ -131,7 +413,7 @@ class TestFileVersionAPIGet(APITestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data["results"]), 0)
 
     def test_get_by_directory_and_file_name(self):
         url = reverse("file_cas", args=[self.file_version.content_hash])
@@ -142,6 +424,363 @@ class TestFileVersionAPIGet(APITestCase):
         self.assertEqual(response.data[0]["file_name"], "test.txt")
 
 
+class TestFileAccessIndex(APITestCase):
+    def setUp(self):
+        self.owner = UserFactory()
+        self.reader = UserFactory(email="reader@user.com")
+        self.file_version = FileVersion.objects.create(
+            file_name="act.txt",
+            path="acts",
+            user=self.owner,
+            file=SimpleUploadedFile("act.txt", b"Act text", content_type="text/plain"),
+        )
+        self.client = APIClient()
+
+    def share(self, permission="read"):
+        self.client.force_authenticate(user=self.owner)
+        url = reverse("api:file_versions-share", args=[self.file_version.id])
+        return self.client.post(url, {"email": self.reader.email, "permission": permission})
+
+    def test_owner_access_is_indexed_on_upload(self):
+        access = FileAccess.objects.get(file_version=self.file_version)
+        self.assertEqual((access.user, access.level), (self.owner, FileAccess.OWNER))
+
+    def test_share_is_indexed_and_listed(self):
+        self.assertEqual(self.share("read").status_code, status.HTTP_200_OK)
+        self.assertEqual(self.share("read_write").status_code, status.HTTP_200_OK)
+
+        access = FileAccess.objects.get(user=self.reader, file_version=self.file_version)
+        self.assertEqual(access.level, FilePermissions.READ_WRITE)
+
+        self.client.force_authenticate(user=self.reader)
+        response = self.client.get(reverse("api:file_versions-list"))
+        self.assertEqual([item["id"] for item in response.data["results"]], [self.file_version.id])
+
+    def test_removing_share_revokes_access(self):
+        self.share()
+        FilePermissions.objects.filter(user=self.reader).delete()
+
+        self.assertFalse(FileAccess.objects.filter(user=self.reader).exists())
+        self.client.force_authenticate(user=self.reader)
+        response = self.client.get(reverse("serve_file", args=["acts/act.txt"]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_retrieve_checks_permission_in_the_lookup_query(self):
+        self.share("read")
+        self.client.force_authenticate(user=self.reader)
+
+        # The lookup and the reader's grants, which are cached once looked up.
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("api:file_versions-detail", args=[self.file_version.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_read_share_can_not_delete(self):
+        self.share("read")
+        self.client.force_authenticate(user=self.reader)
+
+        response = self.client.delete(reverse("api:file_versions-detail", args=[self.file_version.id]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_read_write_share_can_delete(self):
+        self.share("read_write")
+        self.client.force_authenticate(user=self.reader)
+
+        response = self.client.delete(reverse("api:file_versions-detail", args=[self.file_version.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_sharing_back_to_owner_keeps_owner_access(self):
+        FilePermissions.objects.create(
+            user=self.owner, file=self.file_version, owner=self.reader, permissions=FilePermissions.READ
+        )
+
+        self.assertEqual(FileAccess.objects.get(user=self.owner).level, FileAccess.OWNER)
+
+
+class TestGrants(APITestCase):
+    def setUp(self):
+        self.owner = UserFactory()
+        self.reader = UserFactory(email="reader@user.com")
+        self.act = self.create_version("acts", "act.txt", b"v1", revision=1)
+        self.act_v2 = self.create_version("acts", "act.txt", b"v2", revision=2)
+        self.nested = self.create_version("acts/2024", "b.txt", b"b", revision=1)
+        self.sibling = self.create_version("acts-old", "c.txt", b"c", revision=1)
+
+    def create_version(self, path, file_name, content, revision):
+        return FileVersion.objects.create(
+            user=self.owner,
+            path=path,
+            file_name=file_name,
+            revision=revision,
+            file=SimpleUploadedFile(file_name, content),
+        )
+
+    def grant(self, path, file_name="", permission="read"):
+        self.client.force_authenticate(user=self.owner)
+        data = {"email": self.reader.email, "path": path, "file_name": file_name, "permission": permission}
+        return self.client.post(reverse("api:grants-list"), data, format="json")
+
+    def accessible(self):
+        return set(FileVersion.objects.accessible_by(self.reader).values_list("pk", flat=True))
+
+    def assertFolderCount(self, count):
+        self.assertEqual(Folder.objects.get(user=self.reader, path="").file_count, count)
+        self.assertEqual(len(self.accessible()), count)
+
+    def test_folder_grant_covers_existing_and_later_versions(self):
+        response = self.grant("/acts/")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data["path"], response.data["email"]), ("acts", self.reader.email))
+        self.assertEqual(self.accessible(), {self.act.pk, self.act_v2.pk, self.nested.pk})
+
+        later = self.create_version("acts/2025", "d.txt", b"d", revision=1)
+        self.assertIn(later.pk, self.accessible())
+        self.assertFolderCount(4)
+        self.assertFalse(FilePermissions.objects.exists())
+
+        self.client.force_authenticate(user=self.reader)
+        response = self.client.get(reverse("serve_file", args=["acts/2025/d.txt"]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse("serve_file", args=["acts"]), {"list": ""})
+        self.assertEqual([folder["name"] for folder in response.data["folders"]], ["2024", "2025"])
+
+    def test_document_scope_share_replaces_version_shares(self):
+        self.client.force_authenticate(user=self.owner)
+        url = reverse("api:file_versions-share", args=[self.act.pk])
+        self.client.post(url, {"email": self.reader.email, "permission": "read"})
+        self.assertFolderCount(1)
+
+        response = self.client.post(url, {"email": self.reader.email, "permission": "read", "scope": "document"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(FilePermissions.objects.exists())
+        grant = Grant.objects.get()
+        self.assertEqual((grant.path, grant.file_name, grant.level), ("acts", "act.txt", FilePermissions.READ))
+        self.assertEqual(self.accessible(), {self.act.pk, self.act_v2.pk})
+        self.assertFolderCount(2)
+
+    def test_grant_level_decides_write_access(self):
+        self.grant("acts", "act.txt")
+        self.client.force_authenticate(user=self.reader)
+        response = self.client.delete(reverse("api:file_versions-detail", args=[self.act.pk]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.assertEqual(self.grant("acts", "act.txt", permission="read_write").status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Grant.objects.get().level, FilePermissions.READ_WRITE)
+        self.client.force_authenticate(user=self.reader)
+        response = self.client.delete(reverse("api:file_versions-detail", args=[self.act.pk]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFolderCount(1)
+
+    def test_only_the_owner_shares_wider_scopes(self):
+        FilePermissions.objects.create(
+            user=self.reader, file=self.act, owner=self.owner, permissions=FilePermissions.READ_WRITE
+        )
+        self.client.force_authenticate(user=self.reader)
+        url = reverse("api:file_versions-share", args=[self.act.pk])
+        response = self.client.post(url, {"email": "someone@user.com", "permission": "read", "scope": "folder"})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Grant.objects.exists())
+
+    def test_revoking_a_grant_keeps_wider_version_shares(self):
+        FilePermissions.objects.create(
+            user=self.reader, file=self.nested, owner=self.owner, permissions=FilePermissions.READ_WRITE
+        )
+        grant = self.grant("").data
+        self.assertFolderCount(4)
+        self.assertTrue(FilePermissions.objects.exists())
+
+        response = self.client.get(reverse("api:grants-list"))
+        self.assertEqual([item["id"] for item in response.data], [grant["id"]])
+        self.client.force_authenticate(user=self.reader)
+        self.assertEqual(self.client.get(reverse("api:grants-list")).data, [])
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.delete(reverse("api:grants-detail", args=[grant["id"]]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.accessible(), {self.nested.pk})
+        self.assertFolderCount(1)
+
+    def test_deleting_granted_versions_and_the_owner(self):
+        self.grant("acts")
+        FilePermissions.objects.create(user=self.reader, file=self.act, owner=self.owner, permissions="read_write")
+        self.act_v2.delete()
+        self.assertFolderCount(2)
+
+        self.owner.delete()
+        self.assertFalse(Folder.objects.filter(user=self.reader).exclude(file_count=0).exists())
+
+    def test_grant_validation(self):
+        self.assertEqual(self.grant("acts/../x").status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=self.owner)
+        data = {"email": self.owner.email, "path": "acts", "permission": "read"}
+        response = self.client.post(reverse("api:grants-list"), data, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_collapse_shares_command(self):
+        for version in (self.act, self.act_v2):
+            FilePermissions.objects.create(user=self.reader, file=version, owner=self.owner, permissions="read")
+        # Only one of two revisions of another document is shared, so it is left alone.
+        other = self.create_version("acts/2024", "b.txt", b"b2", revision=2)
+        FilePermissions.objects.create(user=self.reader, file=other, owner=self.owner, permissions="read")
+
+        output = io.StringIO()
+        call_command("collapse_shares", stdout=output)
+
+        self.assertIn("Replaced 2 shares with 1 document grants", output.getvalue())
+        grant = Grant.objects.get()
+        self.assertEqual((grant.user, grant.path, grant.file_name), (self.reader, "acts", "act.txt"))
+        self.assertEqual(list(FilePermissions.objects.values_list("file", flat=True)), [other.pk])
+        self.assertEqual(self.accessible(), {self.act.pk, self.act_v2.pk, other.pk})
+        self.assertFolderCount(3)
+
+
+class TestBulkShare(APITestCase):
+    def setUp(self):
+        self.owner = UserFactory()
+        self.alice = UserFactory(email="alice@user.com")
+        self.bob = UserFactory(email="bob@user.com")
+        self.act = self.create_version(self.owner, "acts", "act.txt", b"v1", revision=1)
+        self.act_v2 = self.create_version(self.owner, "acts", "act.txt", b"v2", revision=2)
+        self.bill = self.create_version(self.owner, "bills", "bill.txt", b"bill", revision=1)
+        self.foreign = self.create_version(self.alice, "notes", "note.txt", b"note", revision=1)
+        FilePermissions.objects.create(user=self.owner, file=self.foreign, owner=self.alice, permissions="read")
+        self.client.force_authenticate(user=self.owner)
+
+    def create_version(self, user, path, file_name, content, revision):
+        return FileVersion.objects.create(
+            user=user, path=path, file_name=file_name, revision=revision, file=SimpleUploadedFile(file_name, content)
+        )
+
+    def post(self, action, **data):
+        return self.client.post(reverse(f"api:file_versions-bulk-{action}"), data, format="json")
+
+    def outcomes(self, response):
+        return {
+            (result.get("email"), result.get("file", result.get("path"))): result["status"] for result in response.data
+        }
+
+    def assertAccess(self, user, versions):
+        self.assertEqual(set(FileVersion.objects.accessible_by(user).values_list("pk", flat=True)), versions)
+        folder = Folder.objects.filter(user=user, path="").first()
+        self.assertEqual(folder.file_count if folder else 0, len(versions))
+
+    def test_share_many_files_with_many_users(self):
+        emails = [self.alice.email, self.bob.email, "nobody@user.com", self.owner.email]
+        files = [self.bill.pk, 0, self.foreign.pk]
+        response = self.post("share", emails=emails, files=files, paths=["/acts/act.txt"], permission="read")
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            self.outcomes(response),
+            {
+                (self.owner.email, None): status.HTTP_400_BAD_REQUEST,
+                ("nobody@user.com", None): status.HTTP_400_BAD_REQUEST,
+                (None, 0): status.HTTP_404_NOT_FOUND,
+                (None, self.foreign.pk): status.HTTP_403_FORBIDDEN,
+                (self.alice.email, self.bill.pk): status.HTTP_201_CREATED,
+                (self.alice.email, "acts/act.txt"): status.HTTP_201_CREATED,
+                (self.bob.email, self.bill.pk): status.HTTP_201_CREATED,
+                (self.bob.email, "acts/act.txt"): status.HTTP_201_CREATED,
+            },
+        )
+        self.assertAccess(self.bob, {self.bill.pk, self.act_v2.pk})
+
+        response = self.post("share", emails=[self.bob.email], files=[self.bill.pk], permission="read_write")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]["status"], status.HTTP_200_OK)
+        self.assertEqual(FileAccess.objects.get(user=self.bob, file_version=self.bill).level, "read_write")
+        self.assertEqual(FilePermissions.objects.filter(owner=self.owner).count(), 4)
+        self.assertAccess(self.bob, {self.bill.pk, self.act_v2.pk})
+
+    def test_queries_do_not_grow_with_the_files(self):
+        counts = []
+        for files in ([self.bill.pk], [self.bill.pk, self.act.pk, self.act_v2.pk]):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.post("share", emails=[self.bob.email], files=files, permission="read")
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_revoke_many(self):
+        emails = [self.alice.email, self.bob.email]
+        self.post("share", emails=emails, files=[self.bill.pk, self.act.pk], permission="read")
+        self.client.force_authenticate(user=self.bob)
+        self.assertEqual(self.client.get(reverse("serve_file", args=["bills/bill.txt"])).status_code, 200)
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.post("revoke", emails=[self.bob.email], files=[self.bill.pk, self.act_v2.pk])
+
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(
+            self.outcomes(response),
+            {(self.bob.email, self.bill.pk): status.HTTP_200_OK, (self.bob.email, self.act_v2.pk): 404},
+        )
+        self.assertAccess(self.bob, {self.act.pk})
+        self.assertAccess(self.alice, {self.bill.pk, self.act.pk, self.foreign.pk})
+        self.client.force_authenticate(user=self.bob)
+        self.assertEqual(self.client.get(reverse("serve_file", args=["bills/bill.txt"])).status_code, 404)
+
+    def test_revoke_keeps_access_given_by_a_grant(self):
+        Grant.objects.create(owner=self.owner, user=self.bob, path="acts", level="read")
+        self.post("share", emails=[self.bob.email], files=[self.act.pk, self.bill.pk], permission="read_write")
+        self.assertAccess(self.bob, {self.act.pk, self.act_v2.pk, self.bill.pk})
+
+        response = self.post("revoke", emails=[self.bob.email], files=[self.act.pk, self.bill.pk])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertAccess(self.bob, {self.act.pk, self.act_v2.pk})
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post("share", emails=[self.bob.email], permission="read").status_code, 400)
+        self.assertEqual(self.post("share", emails=[], files=[self.bill.pk], permission="read").status_code, 400)
+        self.assertEqual(self.post("share", emails=[self.bob.email], files=[self.bill.pk]).status_code, 400)
+        emails = [f"user-{number}@user.com" for number in range(101)]
+        files = list(range(1, 101))
+        self.assertEqual(self.post("revoke", emails=emails, files=files).status_code, 400)
+
+
+class TestFileVersionListPagination(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.file_versions = [
+            FileVersion.objects.create(
+                file_name=f"page-{index}.txt",
+                user=self.user,
+                file=SimpleUploadedFile(f"page-{index}.txt", f"page {index}".encode()),
+            )
+            for index in range(5)
+        ]
+        # Identical timestamps must not make rows disappear between pages.
+        FileVersion.objects.filter(pk__in=[fv.pk for fv in self.file_versions[1:4]]).update(
+            created_at=self.file_versions[1].created_at
+        )
+
+    def test_pages_cover_every_version_once(self):
+        url = reverse("api:file_versions-list") + "?page_size=2"
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(item["id"] for item in response.data["results"])
+            url = response.data["next"]
+
+        expected = FileVersion.objects.order_by("-created_at", "-id").values_list("id", flat=True)
+        self.assertEqual(seen, list(expected))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("api:file_versions-list") + "?cursor=not-a-cursor")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sparse_fieldset(self):
+        response = self.client.get(reverse("api:file_versions-list") + "?fields=id,file_name")
+
+        self.assertEqual(set(response.data["results"][0]), {"id", "file_name"})
+
+
 class TestFileDownloadAPI(APITestCase):
     def setUp(self):
         self.user = UserFactory()
@@ -170,8 +809,1091 @@ class TestFileDownloadAPI(APITestCase):
         self.assertEqual(response["Content-Type"], "text/plain")
         self.assertIn(b"Hello World!", response.streaming_content)
 
+    def test_download_offloaded_with_x_accel_redirect(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+
+        with self.settings(FILE_SERVE_MODE="x-accel-redirect", FILE_SERVE_ACCEL_PREFIX="/protected-media/"):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.file_version.file.name}")
+        self.assertEqual(response["Content-Type"], "text/plain")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="download.txt"')
+        self.assertEqual(response.content, b"")
+
+    def test_download_offloaded_with_x_sendfile(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+
+        with self.settings(FILE_SERVE_MODE="x-sendfile"):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["X-Sendfile"], blob_storage.path(self.file_version.file.name))
+        self.assertEqual(response.content, b"")
+
+    def test_download_carries_etag_and_revalidates(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+
+        response = self.client.get(url)
+        self.assertEqual(response["ETag"], f'"{self.file_version.content_hash}"')
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{self.file_version.content_hash}"')
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], f'"{self.file_version.content_hash}"')
+
+    def test_download_explicit_revision_is_immutable(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"]) + "?revision=1"
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_download_single_range(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+
+        response = self.client.get(url, HTTP_RANGE="bytes=6-10")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response["Content-Range"], "bytes 6-10/12")
+        self.assertEqual(b"".join(response.streaming_content), b"World")
+
+        response = self.client.get(url, HTTP_RANGE="bytes=-6")
+        self.assertEqual(b"".join(response.streaming_content), b"World!")
+
+    def test_download_multiple_ranges(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+        response = self.client.get(url, HTTP_RANGE="bytes=0-4,6-")
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        boundary = response["Content-Type"].split("boundary=")[1]
+        body = b"".join(response.streaming_content)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(b"Content-Range: bytes 0-4/12\r\n\r\nHello\r\n", body)
+        self.assertIn(b"Content-Range: bytes 6-11/12\r\n\r\nWorld!\r\n", body)
+        self.assertTrue(body.endswith(f"--{boundary}--\r\n".encode()))
+
+    def test_download_unsatisfiable_range(self):
+        url = reverse("serve_file", args=[f"{self.file_path}/{self.file_name}"])
+        response = self.client.get(url, HTTP_RANGE="bytes=100-200")
+
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response["Content-Range"], "bytes */12")
+
     def test_download_nonexistent_file(self):
         url = reverse("serve_file", args=[f"{self.user.id}/does/not/exist.txt"])
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TestDirectoryArchive(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.first = self.create_version("reports", "a.txt", b"first draft", revision=1)
+        self.create_version("reports", "a.txt", b"final", revision=2)
+        self.create_version("reports/2024", "b.txt", b"final", revision=1)
+        self.create_version("reports-old", "c.txt", b"elsewhere", revision=1)
+        self.create_version("reports", "secret.txt", b"secret", revision=1, user=UserFactory())
+
+    def create_version(self, path, file_name, content, revision, user=None):
+        return FileVersion.objects.create(
+            user=user or self.user,
+            path=path,
+            file_name=file_name,
+            revision=revision,
+            file=SimpleUploadedFile(file_name, content),
+        )
+
+    def get_archive(self, directory, **params):
+        response = self.client.get(reverse("serve_file", args=[directory]), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b"".join(response.streaming_content)
+
+    def test_zip_archive_of_latest_revisions(self):
+        with mock.patch(
+            "propylon_document_manager.file_versions.archives.open_blob",
+            wraps=archives.open_blob,
+        ) as open_blob:
+            body = self.get_archive("reports", archive="zip")
+
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["2024/b.txt", "a.txt"])
+            self.assertEqual(archive.read("a.txt"), b"final")
+            self.assertEqual(archive.read("2024/b.txt"), b"final")
+        # Both entries share a blob, which is read from storage once.
+        self.assertEqual(open_blob.call_count, 1)
+
+    def test_tar_archive_links_shared_blobs(self):
+        body = self.get_archive("reports", archive="tar")
+
+        with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+            members = {member.name: member for member in archive.getmembers()}
+            self.assertEqual(sorted(members), ["2024/b.txt", "a.txt"])
+            self.assertEqual(sum(member.islnk() for member in members.values()), 1)
+            self.assertEqual(archive.extractfile("a.txt").read(), b"final")
+            self.assertEqual(archive.extractfile("2024/b.txt").read(), b"final")
+
+    def test_archive_as_of(self):
+        FileVersion.objects.filter(path="reports", revision=2).update(
+            created_at=self.first.created_at + timedelta(hours=1)
+        )
+        as_of = (self.first.created_at + timedelta(minutes=1)).isoformat()
+
+        body = self.get_archive("reports", archive="zip", as_of=as_of)
+
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.read("a.txt"), b"first draft")
+
+    def test_archive_of_everything(self):
+        response = self.client.get(reverse("serve_dir"), {"archive": "tar"})
+
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="files.tar"')
+        with tarfile.open(fileobj=io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual(sorted(archive.getnames()), ["reports-old/c.txt", "reports/2024/b.txt", "reports/a.txt"])
+
+    def test_invalid_archive_requests(self):
+        url = reverse("serve_file", args=["reports"])
+
+        self.assertEqual(self.client.get(url, {"archive": "rar"}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get(url, {"archive": "zip", "as_of": "yesterday"}).status_code, status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(
+            self.client.get(reverse("serve_file", args=["missing"]), {"archive": "zip"}).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+
+@override_settings(FILE_DELTA_STORAGE=True, FILE_DELTA_SNAPSHOT_INTERVAL=3)
+class TestDeltaStorage(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        revision_cache.clear()
+
+        random = Random(7)
+        paragraphs = [b"<p id='%d'>%s</p>\n" % (i, random.randbytes(40).hex().encode()) for i in range(500)]
+        self.contents = [b"".join(paragraphs)]
+        for revision in range(2, 6):
+            paragraphs[revision * 10] = b"<p>edited in revision %d</p>\n" % revision
+            self.contents.append(b"".join(paragraphs))
+        self.versions = [
+            FileVersion.objects.create(
+                user=self.user,
+                path="drafts",
+                file_name="bill.xml",
+                revision=revision,
+                file=SimpleUploadedFile("bill.xml", content),
+            )
+            for revision, content in enumerate(self.contents, start=1)
+        ]
+
+    def test_revisions_are_stored_as_deltas_between_snapshots(self):
+        blobs = [Blob.objects.get(pk=version.content_hash) for version in self.versions]
+
+        self.assertEqual([blob.depth for blob in blobs], [0, 1, 2, 0, 1])
+        self.assertEqual(blobs[1].base_id, blobs[0].pk)
+        self.assertEqual(blobs[0].ref_count, 2)
+        self.assertFalse(blob_storage.exists(blob_path(blobs[2].pk)))
+        self.assertLess(blob_storage.size(delta_path(blobs[2].pk)), 200)
+
+    def test_every_revision_is_rebuilt_on_download(self):
+        revision_cache.clear()
+        url = reverse("serve_file", args=["drafts/bill.xml"])
+
+        for revision, content in enumerate(self.contents, start=1):
+            response = self.client.get(url, {"revision": revision})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b"".join(response.streaming_content), content)
+
+        with self.settings(FILE_SERVE_MODE="x-accel-redirect"):
+            response = self.client.get(url, {"revision": 3})
+        self.assertNotIn("X-Accel-Redirect", response)
+        self.assertEqual(b"".join(response.streaming_content), self.contents[2])
+
+    def test_deleting_versions_releases_the_delta_chain(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for version in reversed(self.versions[:3]):
+                version.delete()
+
+        self.assertFalse(Blob.objects.filter(pk__in=[version.content_hash for version in self.versions[:3]]).exists())
+        self.assertFalse(blob_storage.exists(delta_path(self.versions[1].content_hash)))
+        self.assertFalse(blob_storage.exists(blob_path(self.versions[0].content_hash)))
+
+    def test_unrelated_content_is_stored_in_full(self):
+        version = FileVersion.objects.create(
+            user=self.user,
+            path="drafts",
+            file_name="bill.xml",
+            revision=6,
+            file=SimpleUploadedFile("bill.xml", Random(8).randbytes(20_000)),
+        )
+
+        self.assertIsNone(Blob.objects.get(pk=version.content_hash).base_id)
+        self.assertTrue(blob_storage.exists(version.file.name))
+
+    def test_delta_round_trip(self):
+        random = Random(9)
+        base = random.randbytes(50_000)
+        target = base[:10_000] + b"inserted" + base[10_000:30_000] + base[30_500:] + b"appended"
+
+        delta = encode_delta(base, target)
+
+        self.assertLess(len(delta), 200)
+        self.assertEqual(apply_delta(base, delta), target)
+        self.assertIsNone(encode_delta(base, random.randbytes(50_000), max_size=25_000))
+
+
+@override_settings(FILE_COMPRESSION="gzip")
+class TestCompressionAtRest(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        self.content = b"".join(b"<section id='%d'>Text of the act.</section>\n" % i for i in range(1000))
+        self.version = self.create_version("act.xml", self.content)
+        self.url = reverse("serve_file", args=["acts/act.xml"])
+
+    def create_version(self, file_name, content, revision=1):
+        return FileVersion.objects.create(
+            user=self.user,
+            path="acts",
+            file_name=file_name,
+            revision=revision,
+            file=SimpleUploadedFile(file_name, content),
+        )
+
+    def test_text_is_stored_compressed(self):
+        blob = Blob.objects.get(pk=self.version.content_hash)
+
+        self.assertEqual(blob.codec, "gzip")
+        self.assertEqual(blob.size, len(self.content))
+        with blob.open_stored() as stored:
+            self.assertEqual(gzip.decompress(stored.read()), self.content)
+        self.assertLess(blob_storage.size(blob.stored_name), len(self.content) // 5)
+
+    def test_compressing_a_stored_blob_leaves_its_raw_file_alone(self):
+        content = self.content.replace(b"act", b"bill")
+        with self.settings(FILE_COMPRESSION=""):
+            version = self.create_version("bill.xml", content)
+        blob = Blob.objects.get(pk=version.content_hash)
+
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            with File(blob.open_stored()) as stored:
+                self.assertTrue(Blob.objects.store_compressed(blob.content_hash, stored))
+            raise RuntimeError("rolled back")
+
+        blob.refresh_from_db()
+        self.assertEqual(blob.codec, "")
+        with blob.open() as blob_file:
+            self.assertEqual(blob_file.read(), content)
+
+    def test_compressed_formats_are_stored_as_they_are(self):
+        version = self.create_version("scan.png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 10_000)
+
+        self.assertEqual(Blob.objects.get(pk=version.content_hash).codec, "")
+
+    def test_download_is_decompressed_for_other_clients(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", response)
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(int(response["Content-Length"]), len(self.content))
+        self.assertEqual(b"".join(response.streaming_content), self.content)
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=20000-20099")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), self.content[20000:20100])
+
+    def test_download_passes_compressed_bytes_through(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="br, gzip;q=0.8")
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.content)
+        self.assertNotEqual(response["ETag"], self.client.get(self.url)["ETag"])
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertNotIn("Content-Encoding", response)
+
+    def test_bulk_upload_and_archive_round_trip(self):
+        upload = SimpleUploadedFile("bulk.xml", self.content + b"<end/>")
+        response = self.client.post(reverse("api:file_versions-bulk"), {"path": "acts", "files": [upload]})
+        self.assertEqual(Blob.objects.get(pk=response.data[0]["content_hash"]).codec, "gzip")
+
+        response = self.client.get(reverse("serve_file", args=["acts"]), {"archive": "zip"})
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read("act.xml"), self.content)
+            self.assertEqual(archive.read("bulk.xml"), self.content + b"<end/>")
+
+    @override_settings(FILE_DELTA_STORAGE=True)
+    def test_deltas_apply_to_compressed_snapshots(self):
+        revision_cache.clear()
+        version = self.create_version("act.xml", self.content.replace(b"id='500'", b"id='new'"), revision=2)
+
+        self.assertEqual(Blob.objects.get(pk=version.content_hash).base_id, self.version.content_hash)
+        revision_cache.clear()
+        response = self.client.get(self.url, {"revision": 2}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(b"".join(response.streaming_content), self.content.replace(b"id='500'", b"id='new'"))
+
+
+class TestLookupCache(APITestCase):
+    def setUp(self):
+        cache.clear()
+        file_version_cache.stats.reset()
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        self.version = self.create_version(b"first", revision=1)
+        self.url = reverse("serve_file", args=["laws/act.txt"])
+
+    def create_version(self, content, revision):
+        return FileVersion.objects.create(
+            user=self.user,
+            path="laws",
+            file_name="act.txt",
+            revision=revision,
+            file=SimpleUploadedFile("act.txt", content),
+        )
+
+    def download(self, **params):
+        response = self.client.get(self.url, params)
+        return response.status_code, b"".join(getattr(response, "streaming_content", []))
+
+    def test_revision_zero_is_not_the_latest_revision(self):
+        self.assertEqual(self.download(revision=0)[0], status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+
+        cache.clear()
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+        self.assertEqual(self.download(revision=0)[0], status.HTTP_404_NOT_FOUND)
+
+    def test_hot_document_resolves_without_queries(self):
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+        self.assertEqual(self.download(revision=1), (status.HTTP_200_OK, b"first"))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+            self.assertEqual(self.download(revision=1), (status.HTTP_200_OK, b"first"))
+        self.assertEqual(file_version_cache.stats.snapshot()["version"]["hits"], 2)
+
+    def test_upload_and_delete_invalidate_latest_revision(self):
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+
+        second = self.create_version(b"second", revision=2)
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"second"))
+
+        second.delete()
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+        self.assertEqual(self.download(revision=2)[0], status.HTTP_404_NOT_FOUND)
+
+    def test_share_and_revoke_invalidate_recipient(self):
+        self.client.force_authenticate(user=self.other_user)
+        self.assertEqual(self.download()[0], status.HTTP_404_NOT_FOUND)
+
+        permission = FilePermissions.objects.create(
+            user=self.other_user, file=self.version, owner=self.user, permissions=FilePermissions.READ
+        )
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+
+        permission.delete()
+        self.assertEqual(self.download()[0], status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_upload_invalidates_owner(self):
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"first"))
+
+        upload = SimpleUploadedFile("act.txt", b"bulk")
+        self.client.post(reverse("api:file_versions-bulk"), {"path": "laws", "files": [upload]})
+
+        self.assertEqual(self.download(), (status.HTTP_200_OK, b"bulk"))
+
+    def test_stats_are_admin_only(self):
+        self.download()
+        self.assertEqual(self.client.get(reverse("cache_stats")).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=UserFactory(is_staff=True))
+        response = self.client.get(reverse("cache_stats"))
+        self.assertEqual(response.data["version"], {"hits": 0, "misses": 1, "hit_rate": 0.0})
+
+
+class TestDirectoryListing(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+
+        self.create_version(self.user, "laws", "act.txt", b"v1", revision=1)
+        self.create_version(self.user, "laws", "act.txt", b"v2 longer", revision=2)
+        self.create_version(self.user, "laws/2024", "a.txt", b"12345", revision=1)
+        self.create_version(self.user, "laws/2024/q1", "b.txt", b"123", revision=1)
+        self.create_version(self.user, "laws-old", "c.txt", b"1", revision=1)
+        self.shared = self.create_version(self.other_user, "laws/shared", "d.txt", b"1234567", revision=1)
+
+    def create_version(self, user, path, file_name, content, revision):
+        return FileVersion.objects.create(
+            user=user, path=path, file_name=file_name, revision=revision, file=SimpleUploadedFile(file_name, content)
+        )
+
+    def list(self, directory=None):
+        url = reverse("serve_file", args=[directory]) if directory else reverse("serve_dir")
+        return self.client.get(url, {"list": ""})
+
+    def test_list_folder_children(self):
+        response = self.list("laws")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["file_count"], response.data["size"]), (4, 2 + 9 + 5 + 3))
+        folders = [(folder["name"], folder["file_count"], folder["size"]) for folder in response.data["folders"]]
+        self.assertEqual(folders, [("2024", 2, 8)])
+        self.assertEqual(response.data["folders"][0]["path"], "laws/2024")
+        files = [(file["file_name"], file["revision"], file["size"]) for file in response.data["files"]]
+        self.assertEqual(files, [("act.txt", 2, 9)])
+
+    def test_list_root(self):
+        response = self.list()
+
+        self.assertEqual([folder["name"] for folder in response.data["folders"]], ["laws", "laws-old"])
+        self.assertEqual(response.data["files"], [])
+
+    def test_shares_and_deletes_update_the_tree(self):
+        FilePermissions.objects.create(
+            user=self.user, file=self.shared, owner=self.other_user, permissions=FilePermissions.READ
+        )
+        response = self.list("laws")
+        self.assertEqual(response.data["file_count"], 5)
+        self.assertEqual([folder["name"] for folder in response.data["folders"]], ["2024", "shared"])
+
+        FileVersion.objects.filter(path="laws/2024/q1").delete()
+        self.shared.delete()
+        response = self.list("laws/2024")
+        self.assertEqual((response.data["file_count"], response.data["size"]), (1, 5))
+        self.assertEqual(response.data["folders"], [])
+        self.assertEqual(self.list("laws/shared").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_deleting_a_shared_version_uncounts_it_once(self):
+        other = self.create_version(self.other_user, "laws/shared", "e.txt", b"12", revision=1)
+        for file_version in (self.shared, other):
+            FilePermissions.objects.create(
+                user=self.user, file=file_version, owner=self.other_user, permissions=FilePermissions.READ
+            )
+
+        self.shared.delete()
+
+        response = self.list("laws/shared")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["file_count"], response.data["size"]), (1, 2))
+        self.assertEqual(self.list("laws").data["file_count"], 5)
+
+    def test_bulk_upload_updates_the_tree(self):
+        files = [SimpleUploadedFile("e.txt", b"12"), SimpleUploadedFile("f.txt", b"1")]
+        self.client.post(reverse("api:file_versions-bulk"), {"path": "laws/2025", "files": files})
+
+        folders = {folder["name"]: folder for folder in self.list("laws").data["folders"]}
+        self.assertEqual((folders["2025"]["file_count"], folders["2025"]["size"]), (2, 3))
+        self.assertEqual(self.list().data["file_count"], 7)
+
+
+@override_settings(FILE_JOBS_EAGER=False, FILE_COMPRESSION="gzip", FILE_DELTA_STORAGE=True)
+class TestBackgroundJobs(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        revision_cache.clear()
+        section = b"<section id='%d'>Text of the act &amp; schedule.</section>\n"
+        self.content = b"".join(section % i for i in range(1000))
+
+    def upload(self, content, revision=1):
+        upload = SimpleUploadedFile("act.xml", content)
+        return FileVersion.objects.create(
+            user=self.user, path="acts", file_name="act.xml", revision=revision, file=upload
+        )
+
+    def test_upload_only_stores_the_content_and_queues_jobs(self):
+        version = self.upload(self.content)
+
+        blob = Blob.objects.get(pk=version.content_hash)
+        self.assertEqual((blob.codec, blob.base_id), ("", None))
+        with blob.open_stored() as stored:
+            self.assertEqual(stored.read(), self.content)
+        self.assertEqual(
+            list(Job.objects.order_by("id").values_list("kind", "status")),
+            [(jobs.PACK, Job.PENDING), (jobs.VERIFY, Job.PENDING), (jobs.EXTRACT_TEXT, Job.PENDING)],
+        )
+
+    def test_workers_pack_verify_and_extract_text(self):
+        first = self.upload(self.content)
+        second = self.upload(self.content.replace(b"id='500'", b"id='new'"), revision=2)
+        self.client.get(reverse("serve_file", args=["acts/act.xml"]))  # Caches the raw blob.
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(jobs.run_pending("test", limit=100), 6)
+
+        self.assertFalse(Job.objects.exists())
+        self.assertEqual(Blob.objects.get(pk=first.content_hash).codec, "gzip")
+        delta = Blob.objects.get(pk=second.content_hash)
+        self.assertEqual(delta.base_id, first.content_hash)
+        self.assertFalse(blob_storage.exists(delta.name))
+        text = BlobText.objects.get(pk=first.content_hash).content
+        self.assertTrue(text.startswith("Text of the act & schedule.\nText of"))
+
+        response = self.client.get(reverse("serve_file", args=["acts/act.xml"]))
+        self.assertEqual(b"".join(response.streaming_content), self.content.replace(b"id='500'", b"id='new'"))
+
+    def test_packing_replaces_the_raw_file_after_commit(self):
+        version = self.upload(self.content)
+        self.client.get(reverse("serve_file", args=["acts/act.xml"]))  # Caches the raw blob.
+        Job.objects.exclude(kind=jobs.PACK).delete()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            jobs.run_pending("test")
+        blob = Blob.objects.get(pk=version.content_hash)
+        self.assertEqual(blob.codec, "gzip")
+        self.assertTrue(blob_storage.exists(blob.name))
+        response = self.client.get(reverse("serve_file", args=["acts/act.xml"]), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn("Content-Encoding", response)
+
+        for callback in callbacks:
+            callback()
+        self.assertFalse(blob_storage.exists(blob.name))
+        response = self.client.get(reverse("serve_file", args=["acts/act.xml"]), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.content)
+
+    @override_settings(FILE_JOBS_MAX_ATTEMPTS=2)
+    def test_failed_jobs_are_retried_then_kept(self):
+        version = self.upload(b"\x89PNG original")
+        Job.objects.exclude(kind=jobs.VERIFY).delete()
+        with open(blob_storage.path(blob_path(version.content_hash)), "wb") as stored:
+            stored.write(b"\x89PNG corrupted")
+
+        with self.assertLogs("propylon_document_manager.file_versions.jobs", "ERROR"):
+            jobs.run_pending("test")
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn("BlobVerificationError", job.last_error)
+        self.assertEqual(jobs.run_pending("test"), 0)
+
+        Job.objects.update(run_after=timezone.now())
+        with self.assertLogs("propylon_document_manager.file_versions.jobs", "ERROR"):
+            jobs.run_pending("test")
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    def test_expired_claims_are_taken_over(self):
+        self.upload(self.content)
+        claimed = Job.objects.claim("crashed", 1)
+        self.assertEqual(Job.objects.claim("other", 10)[0].kind, jobs.VERIFY)
+
+        Job.objects.filter(pk=claimed[0].pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.run_pending("other"), 1)
+        self.assertEqual(Blob.objects.get().codec, "gzip")
+
+
+class TestTextExtraction(TestCase):
+    def test_markup_is_stripped(self):
+        upload = SimpleUploadedFile("bill.html", b"<p>Finance &amp; Bill</p>")
+        version = FileVersion.objects.create(user=UserFactory(), file_name="bill.html", file=upload)
+
+        self.assertEqual(BlobText.objects.get(pk=version.content_hash).content, "Finance & Bill")
+
+    def test_binary_content_has_no_text(self):
+        upload = SimpleUploadedFile("scan.bin", b"\x00\x01\xfe" * 100)
+        version = FileVersion.objects.create(user=UserFactory(), file_name="scan.bin", file=upload)
+
+        self.assertFalse(BlobText.objects.filter(pk=version.content_hash).exists())
+
+
+class TestSearch(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("search")
+
+        self.act_v1 = self.create_version(self.user, "acts", "finance.txt", b"The finance act puts a levy on banks.")
+        self.act_v2 = self.create_version(
+            self.user, "acts", "finance.txt", b"The finance act abolishes the levy.", revision=2
+        )
+        self.bill = self.create_version(self.user, "bills", "health.txt", b"<p>A bill on hospital levies.</p>")
+        self.private = self.create_version(self.other_user, "private", "notes.txt", b"Notes on the levy for banks.")
+
+    def create_version(self, user, path, file_name, content, revision=1):
+        upload = SimpleUploadedFile(file_name, content)
+        return FileVersion.objects.create(user=user, path=path, file_name=file_name, revision=revision, file=upload)
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data["results"]
+
+    def test_latest_revisions_are_ranked_with_snippets(self):
+        results = self.search(q="finance levy")
+
+        self.assertEqual([result["id"] for result in results], [self.act_v2.id])
+        self.assertEqual(results[0]["snippet"], "<mark>finance</mark> act abolishes the <mark>levy</mark>")
+        self.assertEqual({result["id"] for result in self.search(q="levy")}, {self.act_v2.id, self.bill.id})
+        self.assertEqual(self.search(q="banks"), [])
+
+    def test_all_revisions(self):
+        results = self.search(q="banks", all_revisions=True)
+
+        self.assertEqual([(result["file_name"], result["revision"]) for result in results], [("finance.txt", 1)])
+
+    def test_results_are_limited_to_readable_files_under_the_path(self):
+        self.assertEqual([result["file_name"] for result in self.search(q="levy", path="bills")], ["health.txt"])
+
+        FilePermissions.objects.create(
+            user=self.user, file=self.private, owner=self.other_user, permissions=FilePermissions.READ
+        )
+        self.assertEqual(self.search(q="banks")[0]["id"], self.private.id)
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_search_index_backfills_missing_texts(self):
+        BlobText.objects.all().delete()
+
+        call_command("update_search_index", stdout=io.StringIO())
+
+        self.assertEqual(self.search(q="hospital")[0]["id"], self.bill.id)
+
+
+@override_settings(FILE_CHUNK_STORAGE=True, FILE_CHUNK_AVG_SIZE=1024, FILE_COMPRESSION="gzip")
+class TestChunkStorage(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        random = Random(11)
+        words = [random.randbytes(4).hex().encode() for _ in range(300)]
+        self.original = b" ".join(random.choices(words, k=6000))
+        middle = len(self.original) // 2
+        self.edited = self.original[:middle] + b" inserted paragraph " + self.original[middle:]
+        self.versions = [
+            FileVersion.objects.create(
+                user=self.user,
+                path="drafts",
+                file_name="bill.txt",
+                revision=revision,
+                file=SimpleUploadedFile("bill.txt", content),
+            )
+            for revision, content in enumerate([self.original, self.edited], start=1)
+        ]
+
+    def test_chunks_are_shared_between_revisions(self):
+        manifests = [
+            list(Blob.objects.get(pk=version.content_hash).manifest.values_list("chunk_id", flat=True))
+            for version in self.versions
+        ]
+
+        self.assertTrue(Blob.objects.get(pk=self.versions[1].content_hash).chunked)
+        self.assertFalse(blob_storage.exists(blob_path(self.versions[1].content_hash)))
+        self.assertLessEqual(len(set(manifests[1]) - set(manifests[0])), 3)
+        self.assertEqual(Chunk.objects.count(), len(set(manifests[0]) | set(manifests[1])))
+        self.assertEqual(Chunk.objects.exclude(codec="gzip").count(), 0)
+
+    def test_uploading_existing_content_writes_no_copy(self):
+        copy = FileVersion.objects.create(
+            user=self.user, path="copies", file_name="copy.txt", file=SimpleUploadedFile("copy.txt", self.original)
+        )
+
+        self.assertEqual(copy.content_hash, self.versions[0].content_hash)
+        self.assertEqual(Blob.objects.get(pk=copy.content_hash).ref_count, 2)
+        self.assertFalse(blob_storage.exists(blob_path(copy.content_hash)))
+        self.assertTrue(all(blob_storage.exists(chunk.name) for chunk in Chunk.objects.all()))
+
+    def test_bulk_upload_of_existing_content_writes_no_copy(self):
+        files = [SimpleUploadedFile("copy.txt", self.original), SimpleUploadedFile("other.txt", self.original)]
+        response = self.client.post(reverse("api:file_versions-bulk"), {"path": "copies", "files": files})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        content_hash = self.versions[0].content_hash
+        self.assertEqual(Blob.objects.get(pk=content_hash).ref_count, 3)
+        self.assertFalse(blob_storage.exists(blob_path(content_hash)))
+        response = self.client.get(reverse("serve_file", args=["copies/other.txt"]))
+        self.assertEqual(b"".join(response.streaming_content), self.original)
+
+    def test_boundaries_are_content_defined(self):
+        chunks = list(iter_chunks(io.BytesIO(self.original), 1024))
+
+        self.assertEqual(b"".join(chunks), self.original)
+        self.assertTrue(all(256 <= len(chunk) <= 4096 for chunk in chunks[:-1]))
+        self.assertEqual(list(iter_chunks(io.BytesIO(b"x" + self.original), 1024))[1:], chunks[1:])
+
+    def test_download_and_ranges(self):
+        url = reverse("serve_file", args=["drafts/bill.txt"])
+
+        response = self.client.get(url)
+        self.assertEqual(b"".join(response.streaming_content), self.edited)
+
+        response = self.client.get(url, {"revision": 1}, HTTP_RANGE="bytes=3000-9999")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), self.original[3000:10000])
+
+    def test_deleting_versions_releases_chunks(self):
+        self.versions[0].delete()
+        shared = list(Chunk.objects.values_list("pk", "ref_count"))
+        self.assertTrue(all(ref_count >= 1 for _, ref_count in shared))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.versions[1].delete()
+        self.assertFalse(Chunk.objects.exists())
+        self.assertFalse(any(blob_storage.exists(chunk_path(chunk_hash)) for chunk_hash, _ in shared))
+
+    def test_small_files_are_not_chunked(self):
+        version = FileVersion.objects.create(
+            user=self.user, path="drafts", file_name="note.txt", file=SimpleUploadedFile("note.txt", b"short")
+        )
+
+        self.assertFalse(Blob.objects.get(pk=version.content_hash).chunked)
+
+    def test_chunk_report(self):
+        output = io.StringIO()
+        call_command("chunk_report", "--disk", stdout=output)
+
+        self.assertIn("2 versions", output.getvalue())
+        self.assertIn("2 chunked blobs", output.getvalue())
+        self.assertIn("chunk dedup ratio 1.9", output.getvalue())
+
+
+@override_settings(FILE_UPLOAD_PART_SIZE=1000)
+class TestResumableUpload(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        self.content = Random(12).randbytes(2500)
+        response = self.client.post(
+            reverse("api:uploads-list"), {"path": "large", "file_name": "scan.bin", "size": len(self.content)}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.session_id = response.data["id"]
+        self.session_url = reverse("api:uploads-detail", args=[self.session_id])
+
+    def put_part(self, number, data):
+        url = reverse("api:uploads-part", args=[self.session_id, number])
+        return self.client.put(url, data, content_type="application/octet-stream")
+
+    def complete(self):
+        return self.client.post(reverse("api:uploads-complete", args=[self.session_id]))
+
+    def test_parts_in_any_order_are_assembled_into_a_revision(self):
+        for number in (3, 1, 2):
+            start = (number - 1) * 1000
+            end = start + 1000
+            response = self.put_part(number, self.content[start:end])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data["sha256"], hashlib.sha256(self.content[start:end]).hexdigest())
+
+        response = self.complete()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["revision"], 1)
+        self.assertEqual(response.data["content_hash"], hashlib.sha256(self.content).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+        download = self.client.get(reverse("serve_file", args=["large/scan.bin"]))
+        self.assertEqual(b"".join(download.streaming_content), self.content)
+
+    def test_resuming_after_a_failed_part(self):
+        self.put_part(1, self.content[:1000])
+        self.assertEqual(self.put_part(2, self.content[1000:1500]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.put_part(4, b"x").status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(self.session_url)
+        self.assertEqual([part["number"] for part in response.data["parts"]], [1])
+        self.assertEqual(response.data["part_count"], 3)
+        response = self.complete()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["missing_parts"], [2, 3])
+
+        self.put_part(2, b"\0" * 1000)
+        self.put_part(2, self.content[1000:2000])
+        self.put_part(3, self.content[2000:])
+        self.assertEqual(self.complete().data["content_hash"], hashlib.sha256(self.content).hexdigest())
+
+    def test_sessions_are_private(self):
+        self.client.force_authenticate(user=UserFactory())
+
+        self.assertEqual(self.put_part(1, self.content[:1000]).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.complete().status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(self.session_url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_sessions_are_cleared(self):
+        session = UploadSession.objects.get()
+        self.put_part(1, self.content[:1000])
+        call_command("clear_upload_sessions", stdout=io.StringIO())
+        self.assertTrue(UploadSession.objects.exists())
+
+        with self.settings(FILE_UPLOAD_SESSION_TIMEOUT=0), self.captureOnCommitCallbacks(execute=True):
+            call_command("clear_upload_sessions", stdout=io.StringIO())
+
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(session.temporary_path))
+
+
+@override_settings(FILE_UPLOAD_PART_SIZE=1000)
+class TestParallelUploadParts(TransactionTestCase):
+    parts = 8
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.content = Random(13).randbytes(self.parts * 1000)
+        self.session = UploadSession.objects.create(
+            user=self.user, path="large", file_name="scan.bin", size=len(self.content), part_size=1000
+        )
+        with open(self.session.temporary_path, "xb") as session_file:
+            session_file.truncate(self.session.size)
+
+    def put_part(self, number):
+        try:
+            client = APIClient()
+            client.force_authenticate(user=self.user)
+            start = (number - 1) * 1000
+            end = start + 1000
+            url = reverse("api:uploads-part", args=[self.session.pk, number])
+            return client.put(url, self.content[start:end], content_type="application/octet-stream").status_code
+        finally:
+            connection.close()
+
+    def test_parts_are_written_concurrently(self):
+        with ThreadPoolExecutor(max_workers=self.parts) as executor:
+            results = list(executor.map(self.put_part, range(1, self.parts + 1)))
+
+        self.assertEqual(results, [status.HTTP_200_OK] * self.parts)
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.post(reverse("api:uploads-complete", args=[self.session.pk]))
+        self.assertEqual(response.data["content_hash"], hashlib.sha256(self.content).hexdigest())
+
+
+class TestCASLookup(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory()
+        self.other_user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse("file_cas_lookup")
+        self.first = self.create_version(self.user, "notes.txt", b"same content", revision=1)
+        self.copy = self.create_version(self.user, "copy.txt", b"same content", revision=1)
+        self.private = self.create_version(self.other_user, "secret.txt", b"private content", revision=1)
+
+    def create_version(self, user, file_name, content, revision):
+        return FileVersion.objects.create(
+            user=user, path="sync", file_name=file_name, revision=revision, file=SimpleUploadedFile(file_name, content)
+        )
+
+    def test_found_and_missing_hashes(self):
+        unknown = hashlib.sha256(b"unknown").hexdigest()
+        hashes = [self.first.content_hash, self.private.content_hash, unknown, self.first.content_hash]
+
+        # The lookup and the user's grants.
+        with self.assertNumQueries(2):
+            response = self.client.post(self.url, {"hashes": hashes}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        found = response.data["found"][self.first.content_hash]
+        self.assertEqual([version["file_name"] for version in found], ["copy.txt", "notes.txt"])
+        self.assertEqual(response.data["missing"], [self.private.content_hash, unknown])
+
+    def test_repeated_lookups_are_answered_from_the_cache(self):
+        hashes = [self.first.content_hash, self.private.content_hash]
+        self.client.post(self.url, {"hashes": hashes}, format="json")
+
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, {"hashes": hashes}, format="json")
+        self.assertEqual(list(response.data["found"]), [self.first.content_hash])
+
+        FilePermissions.objects.create(
+            user=self.user, file=self.private, owner=self.other_user, permissions=FilePermissions.READ
+        )
+        response = self.client.post(self.url, {"hashes": hashes}, format="json")
+        self.assertEqual(response.data["missing"], [])
+
+    def test_invalid_hashes_are_rejected(self):
+        response = self.client.post(self.url, {"hashes": ["not-a-hash"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.url, {"hashes": [self.first.content_hash] * 10_001}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestAsyncViews(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory()
+        self.factory = AsyncRequestFactory()
+        self.headers = {"Authorization": f"Token {Token.objects.create(user=self.user)}"}
+        self.file_version = FileVersion.objects.create(
+            user=self.user,
+            path="laws/2024",
+            file_name="act.txt",
+            revision=1,
+            file=SimpleUploadedFile("act.txt", b"Hello asynchronous world!"),
+        )
+
+    def serve(self, file_path, data=None, **headers):
+        request = self.factory.get(f"/api/dir/{file_path}", data, headers={**self.headers, **headers})
+        return async_views.AsyncFileServeView.as_view()(request, file_path=file_path)
+
+    async def read(self, response):
+        self.assertTrue(response.is_async)
+        return b"".join([chunk async for chunk in response.streaming_content])
+
+    async def test_download_streams_asynchronously(self):
+        response = await self.serve("laws/2024/act.txt")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Length"], "25")
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="act.txt"')
+        self.assertEqual(await self.read(response), b"Hello asynchronous world!")
+
+        response = await self.serve("laws/2024/act.txt", Range="bytes=6-17")
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(await self.read(response), b"asynchronous")
+
+        response = await self.serve("laws/act.txt")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_listing_and_archive(self):
+        response = await self.serve("laws/2024", {"list": ""})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        listing = json.loads(response.content)
+        self.assertEqual([(file["file_name"], file["size"]) for file in listing["files"]], [("act.txt", 25)])
+
+        response = await self.serve("laws", {"archive": "zip"})
+        with zipfile.ZipFile(io.BytesIO(await self.read(response))) as archive:
+            self.assertEqual(archive.read("2024/act.txt"), b"Hello asynchronous world!")
+
+    async def test_cas_lookup(self):
+        content_hash = self.file_version.content_hash
+        unknown = hashlib.sha256(b"unknown").hexdigest()
+        request = self.factory.post(
+            "/api/cas", {"hashes": [content_hash, unknown]}, content_type="application/json", headers=self.headers
+        )
+
+        response = await async_views.AsyncFileCASLookupView.as_view()(request)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual([version["id"] for version in data["found"][content_hash]], [self.file_version.id])
+        self.assertEqual(data["missing"], [unknown])
+
+        request = self.factory.post(
+            "/api/cas", {"hashes": ["not-a-hash"]}, content_type="application/json", headers=self.headers
+        )
+        response = await async_views.AsyncFileCASLookupView.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_list_and_upload(self):
+        view = async_views.AsyncFileVersionListView.as_view()
+        upload = SimpleUploadedFile("bill.txt", b"Hello upload!")
+        request = self.factory.post("/api/file-versions", {"path": "bills", "file": upload}, headers=self.headers)
+
+        response = await view(request)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = await view(self.factory.get("/api/file-versions", {"page_size": 1}, headers=self.headers))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual([version["file_name"] for version in data["results"]], ["bill.txt"])
+        response = await view(self.factory.get(data["next"], headers=self.headers))
+        data = json.loads(response.content)
+        self.assertEqual([version["id"] for version in data["results"]], [self.file_version.id])
+
+    async def test_authentication_is_required(self):
+        request = self.factory.get(f"/api/cas/{self.file_version.content_hash}")
+
+        response = await async_views.AsyncFileCASView.as_view()(request, hash_value=self.file_version.content_hash)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response["WWW-Authenticate"], "Token")
+
+
+class TestMetrics(APITestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        file_version_cache.stats.reset()
+        self.user = UserFactory()
+        self.client.force_authenticate(user=self.user)
+        FileVersion.objects.create(
+            user=self.user,
+            path="laws",
+            file_name="act.txt",
+            revision=1,
+            file=SimpleUploadedFile("act.txt", b"Hello metrics!"),
+        )
+
+    def scrape(self):
+        self.client.force_authenticate(user=UserFactory(is_staff=True))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                samples[name] = float(value)
+        return samples
+
+    def test_requests_storage_and_cache_are_measured(self):
+        response = self.client.get(reverse("serve_file", args=["laws/act.txt"]))
+        self.assertEqual(b"".join(response.streaming_content), b"Hello metrics!")
+        self.client.get(reverse("serve_file", args=["laws/missing.txt"]))
+
+        samples = self.scrape()
+
+        labels = 'endpoint="serve_file",method="GET"'
+        self.assertEqual(samples[f"file_versions_request_duration_seconds_count{{{labels}}}"], 2)
+        self.assertEqual(samples[f'file_versions_request_duration_seconds_bucket{{{labels},le="+Inf"}}'], 2)
+        self.assertEqual(samples[f'file_versions_responses_total{{{labels},status="200"}}'], 1)
+        self.assertEqual(samples[f'file_versions_responses_total{{{labels},status="404"}}'], 1)
+        self.assertGreater(samples[f"file_versions_db_queries_total{{{labels}}}"], 0)
+        self.assertEqual(samples["file_versions_hashed_bytes_total"], 14)
+        self.assertEqual(samples["file_versions_storage_written_bytes_total"], 14)
+        # Read once by the eager verification job, then downloaded.
+        self.assertEqual(samples["file_versions_storage_read_bytes_total"], 28)
+        self.assertEqual(samples['file_versions_cache_misses_total{kind="version"}'], 2)
+
+    def test_metrics_are_admin_only(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(FILE_METRICS_SLOW_REQUEST=1e-9)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.assertLogs("propylon_document_manager.file_versions.middleware", "WARNING") as logs:
+            self.client.get(reverse("serve_file", args=["laws/act.txt"]))
+
+        self.assertIn("GET /api/dir/laws/act.txt (serve_file) returned 200", logs.output[0])
+        self.assertIn('FROM "file_versions_fileversion"', logs.output[0])
+
+
+class TestBenchmarkSuite(TransactionTestCase):
+    def test_corpus_and_endpoint_benchmark(self):
+        call_command(
+            "generate_corpus", "--users", "3", "--documents", "12", "--median-size", "2048", stdout=io.StringIO()
+        )
+        corpus_versions = FileVersion.objects.filter(user__email__startswith="corpus-user-")
+        self.assertEqual(User.objects.filter(email__startswith="corpus-user-").count(), 3)
+        self.assertEqual(corpus_versions.values("user", "path", "file_name").distinct().count(), 12)
+        version_count = corpus_versions.count()
+        with self.assertRaises(CommandError):
+            call_command("generate_corpus", stdout=io.StringIO())
+
+        with tempfile.NamedTemporaryFile("r", suffix=".json") as output:
+            call_command(
+                "benchmark_endpoints",
+                *("--requests", "4", "--warmup", "1", "--concurrency", "2", "--output", output.name),
+                stdout=io.StringIO(),
+            )
+            results = json.load(output)
+
+        self.assertEqual(list(results["endpoints"]), ["upload", "list", "download", "share", "cas_lookup"])
+        for result in results["endpoints"].values():
+            self.assertEqual((result["requests"], result["errors"]), (4, 0))
+            self.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+        self.assertEqual(results["corpus"]["versions"], version_count)
+        # The uploads and shared versions of the benchmark are removed again.
+        self.assertEqual(corpus_versions.count(), version_count)
+
+        call_command("generate_corpus", "--delete", stdout=io.StringIO())
+        self.assertFalse(User.objects.filter(email__startswith="corpus-user-").exists())